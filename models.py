@@ -40,6 +40,12 @@ class User(db.Model):
 #No Changes
 class Form(db.Model):
     __tablename__ = 'form'
+    __table_args__ = (
+        # a user's form list, newest first
+        db.Index('ix_form_user_last_access', 'form_user_id', 'last_access_date', 'form_id'),
+        # the admin listing, keyset-paged newest first
+        db.Index('ix_form_last_access', 'last_access_date', 'form_id'),
+    )
 
     # Define fields
     form_id = db.Column(db.Integer, primary_key=True, autoincrement=True)
@@ -59,6 +65,9 @@ class Form(db.Model):
     next_review_date = db.Column(db.DateTime, nullable=True)
     status = db.Column(db.Integer, default=False, nullable=True)
     division_ref = db.relationship('Division', backref='forms')
+    # Read-only views of the form tree for loading it with selectinload; rows
+    # are still written and deleted through their own tables
+    processes = db.relationship('Process', order_by='Process.process_id', viewonly=True)
 
     
 class Process(db.Model):
@@ -70,6 +79,7 @@ class Process(db.Model):
     process_number = db.Column(db.Integer, nullable=False) 
     process_title = db.Column(db.String(124), nullable=False)
     process_location = db.Column(db.String(255), nullable=True)
+    activities = db.relationship('Activity', order_by='Activity.activity_id', viewonly=True)
     
 class Hazard(db.Model):
     __tablename__ = 'hazard'
@@ -86,6 +96,9 @@ class Hazard(db.Model):
     hazard_due_date = db.Column(db.DateTime, nullable=True)
     # ai column added to mirror DB change; using String for permissive storage
     ai = db.Column(db.String(100), nullable=True)
+    # one risk row per hazard (the lowest risk_id if there are more)
+    risk = db.relationship('Risk', order_by='Risk.risk_id', uselist=False, viewonly=True)
+    hazard_type = db.relationship('HazardType', viewonly=True)
     
 class HazardType(db.Model):
     __tablename__ = 'hazard_type'
@@ -122,6 +135,7 @@ class Activity(db.Model):
     activity_number = db.Column(db.Integer, nullable=False)
     activity_remarks = db.Column(db.String(255), nullable=True)
     activity_tag = db.Column(db.String(45), nullable=True)
+    hazards = db.relationship('Hazard', order_by='Hazard.hazard_id', viewonly=True)
     
 class RA_team(db.Model):
     __tablename__ = 'RA_team'
@@ -160,3 +174,45 @@ class Audit(db.Model):
     audit_actiontype = db.Column(db.String(45), nullable=True)
     audit_targetuser = db.Column(db.String(255), nullable=True)  # Changed to String to store user name
     audit_time = db.Column(db.DateTime, nullable=False)  # Removed default, will be set explicitly with Singapore time (GMT+8)
+
+class AIJob(db.Model):
+    __tablename__ = 'ai_job'
+
+    # uuid hex, so job ids cannot be guessed from one another
+    job_id = db.Column(db.String(32), primary_key=True)
+    job_user_id = db.Column(db.Integer, db.ForeignKey('user.user_id'), nullable=True)
+    kind = db.Column(db.String(32), nullable=False)  # "hazards" or "activities"
+    status = db.Column(db.String(16), nullable=False)  # queued, running, done, failed, cancelled
+    payload = db.Column(db.Text, nullable=False)  # JSON
+    result = db.Column(db.Text, nullable=True)  # JSON, once done
+    error = db.Column(db.Text, nullable=True)
+    created_at = db.Column(db.DateTime, nullable=False)
+    started_at = db.Column(db.DateTime, nullable=True)
+    finished_at = db.Column(db.DateTime, nullable=True)
+
+# RAG knowledge base phrases (activity, hazard, titleprocess, control, injury)
+class KBEntry(db.Model):
+    __tablename__ = 'kb_entry'
+    __table_args__ = (
+        db.UniqueConstraint('kind', 'text_hash', name='uq_kb_entry_kind_text'),
+        db.Index('ix_kb_entry_kind_version', 'kind', 'version'),
+    )
+
+    entry_id = db.Column(db.Integer, primary_key=True, autoincrement=True)
+    kind = db.Column(db.String(32), nullable=False)
+    text = db.Column(db.Text, nullable=False)
+    normalised_text = db.Column(db.Text, nullable=False)
+    text_hash = db.Column(db.String(64), nullable=False)  # sha256 of normalised_text
+    embedding = db.Column(db.LargeBinary, nullable=True)  # unit-length float32 row
+    model = db.Column(db.String(255), nullable=True)  # embedding provider name
+    version = db.Column(db.Integer, nullable=False)  # kb_version.version that added it
+    created_at = db.Column(db.DateTime, nullable=False)
+
+# One row per knowledge base kind; version goes up on every change
+class KBVersion(db.Model):
+    __tablename__ = 'kb_version'
+
+    kind = db.Column(db.String(32), primary_key=True)
+    version = db.Column(db.Integer, nullable=False, default=0)
+    rebuilt_version = db.Column(db.Integer, nullable=False, default=0)  # last full re-embed
+    updated_at = db.Column(db.DateTime, nullable=True)
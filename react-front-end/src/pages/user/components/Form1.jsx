@@ -468,7 +468,9 @@ const Form1 = forwardRef(({ sample, sessionData, updateFormData, formData, onNav
               headers: {
                 'Content-Type': 'application/json',
               },
-              body: JSON.stringify({ title, processName }),
+              // prefetch: the server starts on the hazards for these activities right away
+              // (ignored unless the server has AI_PREFETCH_ENABLED set)
+              body: JSON.stringify({ title, processName, prefetch: true }),
             });
 
             if (!response.ok) {
@@ -0,0 +1,31 @@
+import os
+import sys
+
+import pytest
+from flask import Flask
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+os.environ.setdefault("OPEN_AI_API_KEY", "test")
+
+from models import db  # noqa: E402
+
+
+# The user and admin blueprints on a throwaway SQLite database. create_app
+# itself is not used because its engine options are MySQL-specific.
+@pytest.fixture
+def app(tmp_path):
+    from website.admin_routes import admin
+    from website.user_routes import user
+
+    app = Flask(__name__)
+    app.config["SQLALCHEMY_DATABASE_URI"] = f"sqlite:///{tmp_path / 'test.db'}"
+    app.config["SECRET_KEY"] = "test"
+    app.config["TESTING"] = True
+    db.init_app(app)
+    app.register_blueprint(admin, url_prefix="/admin")
+    app.register_blueprint(user, url_prefix="/user")
+    with app.app_context():
+        db.create_all()
+        yield app
+        db.session.remove()
+        db.drop_all()
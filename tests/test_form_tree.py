@@ -0,0 +1,103 @@
+from contextlib import contextmanager
+
+from sqlalchemy import event
+
+from models import db, User, HazardType, Form, Process, Activity, Hazard, Risk
+from website.form_tree import load_form_tree
+
+
+def seed_form(form_id, processes, activities, hazards):
+    form = Form(form_id=form_id, form_user_id=1, form_RA_team_id=1, title=f"Form {form_id}", division=1)
+    db.session.add(form)
+    db.session.flush()
+    for p in range(processes):
+        process = Process(process_form_id=form_id, process_number=p + 1, process_title=f"P{p}", process_location="Lab")
+        db.session.add(process)
+        db.session.flush()
+        for a in range(activities):
+            activity = Activity(activity_process_id=process.process_id, work_activity=f"A{p}.{a}", activity_number=a + 1)
+            db.session.add(activity)
+            db.session.flush()
+            for h in range(hazards):
+                hazard = Hazard(
+                    hazard_activity_id=activity.activity_id, hazard=f"H{p}.{a}.{h}",
+                    hazard_type_id=1 + h % 2, injury="Cut", hazard_implementation_person="Tech",
+                )
+                db.session.add(hazard)
+                db.session.flush()
+                db.session.add(Risk(risk_hazard_id=hazard.hazard_id, severity=2, likelihood=3, RPN=6))
+    db.session.commit()
+
+
+@contextmanager
+def count_queries():
+    counter = {"queries": 0}
+
+    def before_cursor_execute(*args):
+        counter["queries"] += 1
+
+    event.listen(db.engine, "before_cursor_execute", before_cursor_execute)
+    try:
+        yield counter
+    finally:
+        event.remove(db.engine, "before_cursor_execute", before_cursor_execute)
+
+
+def setup_forms():
+    db.session.add(User(user_id=1, user_name="owner", user_email="owner@example.com", user_role=1, password="x"))
+    db.session.add_all([HazardType(hazard_type_id=1, hazard_type="Physical"), HazardType(hazard_type_id=2, hazard_type="Chemical")])
+    db.session.flush()
+    seed_form(1, processes=2, activities=3, hazards=2)
+    seed_form(2, processes=4, activities=5, hazards=3)
+
+
+def test_load_form_tree_loads_every_level(app):
+    setup_forms()
+    db.session.expire_all()
+
+    form = load_form_tree(1)
+    assert [process.process_title for process in form.processes] == ["P0", "P1"]
+    assert [len(process.activities) for process in form.processes] == [3, 3]
+    hazard = form.processes[1].activities[2].hazards[1]
+    assert hazard.hazard == "H1.2.1"
+    assert hazard.risk.RPN == 6
+    assert hazard.hazard_type.hazard_type == "Chemical"
+    assert load_form_tree(999) is None
+
+
+def test_load_form_tree_query_count_does_not_grow_with_form(app):
+    setup_forms()
+
+    counts = []
+    for form_id in (1, 2):
+        db.session.expire_all()
+        with count_queries() as counter:
+            form = load_form_tree(form_id)
+            for process in form.processes:
+                for activity in process.activities:
+                    for hazard in activity.hazards:
+                        hazard.risk, hazard.hazard_type
+        counts.append(counter["queries"])
+
+    assert counts[0] == counts[1]
+    # form, processes, activities, hazards, risks, hazard types
+    assert counts[0] <= 6
+
+
+def test_get_form2_data_query_count_does_not_grow_with_form(app):
+    setup_forms()
+    client = app.test_client()
+    with client.session_transaction() as session:
+        session["user_id"] = 1
+
+    counts = []
+    for form_id, hazards in ((1, 2 * 3 * 2), (2, 4 * 5 * 3)):
+        db.session.expire_all()
+        with count_queries() as counter:
+            response = client.get(f"/user/get_form2_data/{form_id}")
+        assert response.status_code == 200
+        data = response.get_json()
+        assert sum(len(activity["hazards"]) for process in data["processes"] for activity in process["activities"]) == hazards
+        counts.append(counter["queries"])
+
+    assert counts[0] == counts[1]
@@ -56,6 +56,41 @@ def create_app():
     app.register_blueprint(admin, url_prefix='/admin')  
     app.register_blueprint(user, url_prefix='/user')
 
+    # Load the RAG knowledge base indexes once per process; the knowledge
+    # bases live in the kb_entry table (see kb_entries.py)
+    from .kb_entries import ensure_kb_tables
+    from .rag import init_kb_indexes
+    try:
+        ensure_kb_tables(app)
+        with app.app_context():
+            init_kb_indexes()
+    except Exception as e:
+        # built on first use instead
+        print(f"Could not load knowledge bases: {e}")
+
+    # Keep known_data in memory for the AI lookups (see known_data_index.py)
+    from .known_data_index import load_known_data_index
+    try:
+        with app.app_context():
+            load_known_data_index()
+    except Exception as e:
+        # loaded on first use instead
+        print(f"Could not preload known_data: {e}")
+
+    # Indexes behind the paged form listings (see form_listing.py)
+    from .form_listing import ensure_form_indexes
+    try:
+        ensure_form_indexes(app)
+    except Exception as e:
+        print(f"Could not create form indexes: {e}")
+
+    # Table for background AI generation jobs (see ai_jobs.py)
+    from .ai_jobs import ensure_job_table
+    try:
+        ensure_job_table(app)
+    except Exception as e:
+        print(f"Could not prepare AI job table: {e}")
+
     # print("Registered routes:")
     # for rule in app.url_map.iter_rules():
     #     print(f"{rule.methods} {rule.rule}")
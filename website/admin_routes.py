@@ -9,6 +9,13 @@ from flask_cors import CORS, cross_origin
 from math import ceil
 from datetime import datetime, timezone, timedelta
 from .rag import *
+from .known_data_index import add_known_data
+from .embedding_dispatcher import dispatcher_stats
+from .form_listing import (
+    NEWEST_FIRST, count_forms, encode_cursor, form_status_case, form_status_condition, seek_after,
+    invalidate_form_counts
+)
+from .form_tree import delete_forms
 
 # Define Singapore timezone (GMT+8)
 SINGAPORE_TZ = timezone(timedelta(hours=8))
@@ -85,14 +92,11 @@ def create_audit_log(audit_user_id, action, target_user_id):
 @admin.route('/notification', methods=['GET'])
 def notification():
     try:
-        knowledge_base, kb_embeddings = load_hazard_kb_and_embeddings()
         hazards = Hazard.query.filter(Hazard.approval == None).all()
-        for hazard in hazards:
-            if not hazard.hazard or not hazard.hazard.strip():
-                continue
-            if get_hazard_match(hazard.hazard, knowledge_base, kb_embeddings):
-                return jsonify(True)
-        return jsonify(False)
+        hazard_texts = [hazard.hazard for hazard in hazards if hazard.hazard and hazard.hazard.strip()]
+        if not hazard_texts:
+            return jsonify(False)
+        return jsonify(any(get_hazard_matches({"hazard": hazard_texts})["hazard"]))
     except Exception as e:
         print("Error in /notification:", str(e))
         return jsonify({"success": False, "error": str(e)}), 500
@@ -188,80 +192,95 @@ def approve_hazard():
         )
         db.session.add(new_known_data)
         db.session.commit()
+        add_known_data([new_known_data])
         print("Success: New known data added to KnownData table")
     except Exception as e:
         db.session.rollback()
         print(f"Error adding known data: {e}")
         return jsonify({"success": False, "message": "Failed to add known data"}), 500
 
-    # add activity name into kb.txt and reembed it
-    try:
-        with open(os.path.join(os.path.dirname(__file__), 'kb.txt'), 'a') as f:
-            # f.write(f"&&{data.get('work_activity')}")
-            f.write(f"&&{activity.work_activity if activity else 'Unknown activity'}")
-        reembed_kb()
-        print("Success: reembed_kb() called")
-    except Exception as e:
-        print(f"Error updating kb.txt or reembedding: {e}")
-        return jsonify({"success": False, "message": "Failed to update kb.txt"}), 500
-
-    # add hazard des into kbhazard.txt and reembed it
-    try:
-        with open(os.path.join(os.path.dirname(__file__), 'kbhazard.txt'), 'a') as f:
-            # f.write(f"&&{data.get('hazard')}")
-            f.write(f"&&{hazard.hazard or 'No hazard description'}")
-        print("Success: Hazard description appended to kbhazard.txt")
-        reembed_kbhazard()
-        print("Success: reembed_kbhazard() called")
-    except Exception as e:
-        print(f"Error updating kbhazard.txt or reembedding: {e}")
-        return jsonify({"success": False, "message": "Failed to update kbhazard.txt"}), 500
-    
-    # add form and process into kbtitleprocess.txt and reembed it
-    try:
-        with open(os.path.join(os.path.dirname(__file__), 'kbtitleprocess.txt'), 'a') as f:
-            # f.write(f"&&{data.get('form_title')}%%{data.get('process')}")
-            f.write(f"&&{form.title if form else 'Unknown form'}%%{process.process_title if process else 'Unknown Process'}")
-        print("Success: appended to kbtitleprocess.txt")
-        reembed_kbtitleprocess()
-        print("Success: reembed_kbtitleprocess() called")
-    except Exception as e:
-        print(f"Error updating kbtitleprocess.txt or reembedding: {e}")
-        return jsonify({"success": False, "message": "Failed to update kbtitleprocess.txt"}), 500
+    # add the approved phrases to each knowledge base; only the new phrases are embedded
+    # existing_risk_control and injury may contain multiple parts concatenated with '&&'
+    control_parts = [p for p in ((risk.existing_risk_control or "") if risk else "").split('&&') if p.strip()]
+    injury_parts = [p for p in (hazard.injury or "").split('&&') if p.strip()]
+    kb_updates = [
+        ("activity", [activity.work_activity if activity else 'Unknown activity']),
+        ("hazard", [hazard.hazard or 'No hazard description']),
+        ("titleprocess", [f"{form.title if form else 'Unknown form'}%%{process.process_title if process else 'Unknown Process'}"]),
+        ("control", control_parts),
+        ("injury", injury_parts),
+    ]
+    for kind, phrases in kb_updates:
+        try:
+            added = append_to_knowledge_base(kind, phrases)
+            print(f"Success: {added} phrase(s) added to the {kind} knowledge base")
+        except Exception as e:
+            print(f"Error updating the {kind} knowledge base or embedding: {e}")
+            return jsonify({"success": False, "message": f"Failed to update the {kind} knowledge base"}), 500
 
     print("Hazard approval process completed successfully")
     return jsonify({"success": True, "message": "Hazard approved", "hazard_id": data.get("hazard_id")})
 
-    # add existing controls into kbcontrol.txt and reembed it
-    try:
-        with open(os.path.join(os.path.dirname(__file__), 'kbcontrol.txt'), 'a') as f:
-            f.write(f"&&{data.get('existing_risk_control')}")
-        print("Success: Control appended to kbcontrol.txt")
-        reembed_kbcontrol() # need to create
-        print("Success: reembed_kbcontrol() called")
-    except Exception as e:
-        print(f"Error updating kbcontrol.txt or reembedding: {e}")
-        return jsonify({"success": False, "message": "Failed to update kbcontrol.txt"}), 500
+# Full re-embed of one knowledge base (or all of them) on demand (admin only)
+@admin.route('/rebuild_kb', methods=['POST'])
+def rebuild_kb():
+    if 'user_id' not in session:
+        return jsonify({"success": False, "error": "Not authenticated"}), 401
+    if session.get('user_role') != 0:  # 0 = admin
+        return jsonify({"success": False, "error": "Not authorized"}), 403
+
+    data = request.get_json(silent=True) or {}
+    kinds = [data['kind']] if data.get('kind') else list(KB_SOURCES)
+    unknown = [kind for kind in kinds if kind not in KB_SOURCES]
+    if unknown:
+        return jsonify({"success": False, "error": f"Unknown knowledge base: {', '.join(unknown)}"}), 400
 
-    # add injury into kbinjury.txt and reembed it
     try:
-        with open(os.path.join(os.path.dirname(__file__), 'kbinjury.txt'), 'a') as f:
-            f.write(f"&&{data.get('injury')}")
-        print("Success: Injury appended to kbinjury.txt")
-        reembed_kbinjury() # need to create
-        print("Success: reembed_kbinjury() called")
+        for kind in kinds:
+            reembed_knowledge_base(kind)
+            print(f"Success: {kind} knowledge base rebuilt")
+        return jsonify({"success": True, "rebuilt": kinds})
     except Exception as e:
-        print(f"Error updating kbinjury.txt or reembedding: {e}")
-        return jsonify({"success": False, "message": "Failed to update kbinjury.txt"}), 500
+        print(f"Error rebuilding knowledge base: {e}")
+        return jsonify({"success": False, "error": "Failed to rebuild knowledge base"}), 500
+
+@admin.route('/ai_cache', methods=['GET'])
+def ai_cache_stats():
+    if 'user_id' not in session:
+        return jsonify({"success": False, "error": "Not authenticated"}), 401
+    if session.get('user_role') != 0:  # 0 = admin
+        return jsonify({"success": False, "error": "Not authorized"}), 403
+
+    return jsonify({
+        "success": True,
+        "completions": completion_cache.stats(),
+        "embeddings": embedding_cache.stats(),
+        "embedding_batches": dispatcher_stats(),
+        "single_flight": ai_flights.stats(),
+        "retrieval": {"mode": RETRIEVAL_MODE, **retrieval_stats},
+    })
+
+# Drop cached GPT completions, e.g. after the prompts or the knowledge base change
+@admin.route('/ai_cache/invalidate', methods=['POST'])
+def invalidate_ai_cache():
+    if 'user_id' not in session:
+        return jsonify({"success": False, "error": "Not authenticated"}), 401
+    if session.get('user_role') != 0:  # 0 = admin
+        return jsonify({"success": False, "error": "Not authorized"}), 403
+
+    data = request.get_json(silent=True) or {}
+    namespace = data.get('namespace')
+    if namespace and namespace not in COMPLETION_NAMESPACES:
+        return jsonify({"success": False, "error": f"Unknown cache namespace: {namespace}"}), 400
+
+    removed = invalidate_completion_cache(namespace)
+    print(f"Success: {removed} cached completions removed")
+    return jsonify({"success": True, "removed": removed})
 
 #db management gold mine
 @admin.route('/get_new_hazard', methods=['GET', 'POST'])
 def get_new_hazard():
     # Query all hazards where approval is NULL
-    knowledge_base, kb_embeddings = load_hazard_kb_and_embeddings()
-    knowledge_base_control, kb_embeddings_control = load_control_kb_and_embeddings()
-    knowledge_base_activity, kb_embeddings_activity = load_activity_kb_and_embeddings()
-    knowledge_base_injury, kb_embeddings_injury = load_injury_kb_and_embeddings()
     hazards = Hazard.query.filter(Hazard.approval == None).all()
     # hazards = Hazard.query.filter(Hazard.approval.is_(None), Hazard.ai == 'ai').all()
     matched_hazards = []
@@ -272,20 +291,15 @@ def get_new_hazard():
         else:
             matched_hazards.append(hazard)
 
-        # if get_hazard_match(hazard.hazard, knowledge_base, kb_embeddings):
-        #     matched_hazards.append(hazard)
-        # else:
-        #     hazard.approval = 0
-        #     db.session.commit()
-    
-    results = []
-    hazard_type_lookup = {ht.hazard_type_id: getattr(ht, 'hazard_type', None) or "Unknown type" for ht in HazardType.query.all()}
+    # First pass: look up the related rows and collect every string that needs
+    # a novelty check so they can all be embedded and scored in one batch
+    hazard_rows = []
+    queries = {"hazard": [], "control": [], "activity": [], "injury": []}
     for hazard in matched_hazards:
         try:
             # Get the related activity and hazard type using relationships
             activity = Activity.query.get(hazard.hazard_activity_id) if hazard.hazard_activity_id else None
-            # hazard_type = HazardType.query.get(hazard.hazard_type_id) if hazard.hazard_type_id else None
-            
+
             # More robust form lookup
             form = None
             process = None
@@ -293,79 +307,79 @@ def get_new_hazard():
                 process = Process.query.get(activity.activity_process_id)
                 if process and process.process_form_id:
                     form = Form.query.get(process.process_form_id)
-            
-            # user = User.query.get(form.form_user_id) if form and form.form_user_id else None
+
             risk = Risk.query.filter_by(risk_hazard_id=hazard.hazard_id).first() if hazard.hazard_id else None
-            # process = Process.query.get(activity.activity_process_id)
-            
-            def format_date(date_obj):
-                return date_obj.isoformat() if date_obj else None
-            
-            # form.last_access_date = format_date(form.last_access_date)
-            # FIX THIS LATER !!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!
 
-            #THIS PART HERE
-            # for each hazard from ai, check if it exists in db
-            # for each control in that hazard check if it exists in db
-            # return new or old for both hazard and control
-            # hazard matching
-            try:
-                is_new = bool(get_hazard_match(hazard.hazard, knowledge_base, kb_embeddings))
-            except Exception as me:
-                print(f"Error matching hazard {getattr(hazard, 'hazard_id', None)}: {me}")
-                is_new = False
+            # existing_risk_control and injury may contain multiple parts concatenated with '&&'
+            raw_controls = (risk.existing_risk_control or "") if risk else ""
+            control_parts = [p.strip() for p in raw_controls.split('&&') if p and p.strip()]
+            raw_injuries = hazard.injury or ""
+            injury_parts = [p.strip() for p in raw_injuries.split('&&') if p and p.strip()]
+        except Exception as e:
+            print(f"Error processing hazard {getattr(hazard, 'hazard_id', None)}: {e}")
+            continue
+
+        hazard_rows.append({
+            'hazard': hazard,
+            'activity': activity,
+            'process': process,
+            'form': form,
+            'risk': risk,
+            'control_parts': control_parts,
+            'injury_parts': injury_parts,
+            # offsets into the per-kind query lists
+            'hazard_at': len(queries["hazard"]),
+            'control_at': len(queries["control"]),
+            'activity_at': len(queries["activity"]),
+            'injury_at': len(queries["injury"]),
+        })
+        queries["hazard"].append(hazard.hazard)
+        queries["control"].extend(control_parts)
+        queries["activity"].append(activity.work_activity if activity else "")
+        queries["injury"].extend(injury_parts)
 
-            hazard_field = [hazard.hazard or "No hazard description", "new" if is_new else "old"]
+    #THIS PART HERE
+    # for each hazard from ai, check if it exists in db
+    # for each control in that hazard check if it exists in db
+    # return new or old for both hazard and control
+    try:
+        is_new = get_hazard_matches(queries)
+    except Exception as me:
+        print(f"Error matching new hazards: {me}")
+        is_new = {kind: [False] * len(texts) for kind, texts in queries.items()}
+
+    results = []
+    hazard_type_lookup = {ht.hazard_type_id: getattr(ht, 'hazard_type', None) or "Unknown type" for ht in HazardType.query.all()}
+    for row in hazard_rows:
+        hazard = row['hazard']
+        activity = row['activity']
+        process = row['process']
+        form = row['form']
+        risk = row['risk']
+        try:
+            # hazard matching
+            hazard_field = [hazard.hazard or "No hazard description", "new" if is_new["hazard"][row['hazard_at']] else "old"]
 
             #risk matching
-            # existing_risk_control may contain multiple controls concatenated with '&&'
             existing_risk_control_field = []
-            try:
-                raw_controls = (risk.existing_risk_control or "") if risk else ""
-                # Split by '&&' and trim each part, ignore empty parts
-                control_parts = [p.strip() for p in raw_controls.split('&&') if p and p.strip()]
-                if not control_parts:
-                    # No meaningful control text found
-                    existing_risk_control_field = ["No risk control description", "old"]
-                else:
-                    for part in control_parts:
-                        try:
-                            is_new_part = bool(get_hazard_match(part, knowledge_base_control, kb_embeddings_control))
-                        except Exception:
-                            is_new_part = False
-                        existing_risk_control_field.append(part)
-                        existing_risk_control_field.append("new" if is_new_part else "old")
-            except Exception as me:
-                # Fallback: preserve the raw string if something unexpected happens
-                print(f"Error processing existing_risk_control for hazard {getattr(hazard, 'hazard_id', None)}: {me}")
-                existing_risk_control_field = [risk.existing_risk_control or "No risk control description", "old"]
+            if not row['control_parts']:
+                # No meaningful control text found
+                existing_risk_control_field = ["No risk control description", "old"]
+            for offset, part in enumerate(row['control_parts']):
+                existing_risk_control_field.append(part)
+                existing_risk_control_field.append("new" if is_new["control"][row['control_at'] + offset] else "old")
 
             #activities matching
-            try:
-                is_new_activity = bool(get_hazard_match(activity.work_activity, knowledge_base_activity, kb_embeddings_activity))
-            except Exception as me:
-                print(f"Error matching activity {getattr(activity, 'activity_id', None)}: {me}")
-                is_new_activity = False
-            existing_activity_field = [activity.work_activity or "No activity description", "new" if is_new_activity else "old"]
+            work_activity = activity.work_activity if activity else None
+            existing_activity_field = [work_activity or "No activity description", "new" if is_new["activity"][row['activity_at']] else "old"]
 
             # injury matching - support multiple injuries concatenated with '&&'
             existing_injury_field = []
-            try:
-                raw_injuries = (hazard.injury or "") if hazard else ""
-                injury_parts = [p.strip() for p in raw_injuries.split('&&') if p and p.strip()]
-                if not injury_parts:
-                    existing_injury_field = ["No injury description", "old"]
-                else:
-                    for part in injury_parts:
-                        try:
-                            is_new_inj = bool(get_hazard_match(part, knowledge_base_injury, kb_embeddings_injury))
-                        except Exception:
-                            is_new_inj = False
-                        existing_injury_field.append(part)
-                        existing_injury_field.append("new" if is_new_inj else "old")
-            except Exception as me:
-                print(f"Error processing injury for hazard {getattr(hazard, 'hazard_id', None)}: {me}")
-                existing_injury_field = [hazard.injury or "No injury description", "old"]
+            if not row['injury_parts']:
+                existing_injury_field = ["No injury description", "old"]
+            for offset, part in enumerate(row['injury_parts']):
+                existing_injury_field.append(part)
+                existing_injury_field.append("new" if is_new["injury"][row['injury_at'] + offset] else "old")
 
             results.append({
                 'hazard_id': hazard.hazard_id,
@@ -381,10 +395,8 @@ def get_new_hazard():
                 'approval': hazard.approval,
                 # 'work_activity': activity.work_activity if activity else "Unknown activity",
                 'work_activity': existing_activity_field,
-                # 'hazard_type': hazard_type.hazard_type if hazard_type else "Unknown type",
                 "form_title": form.title if form else "Unknown form",
                 "form_date": form.last_access_date.isoformat() if form and form.last_access_date else None,
-                # "owner": user.user_name if user else "Unknown user",
                 # "existing_risk_control": risk.existing_risk_control if risk else "None specified",
                 "existing_risk_control": existing_risk_control_field,
                 "additional_risk_control": risk.additional_risk_control if risk else "None specified",
@@ -849,7 +861,14 @@ def retrieve_forms():
         division_filter = request.args.get('division', '', type=str)
         user_filter = request.args.get('user_id', '', type=str)  # Filter by user_id
 
-        query = db.session.query(Form, User).join(
+        # Optional keyset cursor (pagination.next_cursor of the previous page);
+        # without one the page number is used as an offset
+        cursor = request.args.get('cursor', '', type=str)
+        page = max(page, 1)
+        per_page = max(per_page, 1)
+        now = datetime.now()
+
+        query = db.session.query(Form).join(
             User, Form.form_user_id == User.user_id
         )
 
@@ -873,64 +892,69 @@ def retrieve_forms():
         if user_filter:
             query = query.filter(Form.form_user_id == int(user_filter))
 
-        all_forms_with_users = query.all()
-
-        # Filter by status if specified
-        filtered_forms = []
-        for form, user in all_forms_with_users:
-            # Create status based on approval and dates
-            status = "Incomplete"  # Default status
-            if form.approval == 1:
-                status = "Completed"
-                print(f"status:", status)
-
-            # Check if review is due
-            if form.next_review_date:
-                from datetime import datetime
-                if form.next_review_date < datetime.now():
-                    status = "review due"
-            
-            # Apply status filter
-            if status_filter and status.lower() != status_filter.lower():
-                continue
-                
-            filtered_forms.append((form, user, status))
+        # Status is computed in SQL (see form_listing.py)
+        if status_filter:
+            query = query.filter(form_status_condition(status_filter, now))
 
-        # Apply pagination to filtered results
-        total_forms = len(filtered_forms)
+        # Totals are cached per filter set for FORM_COUNT_TTL seconds
+        total_forms = count_forms(query, {
+            'search': search, 'division': division_filter, 'user_id': user_filter, 'status': status_filter.lower()
+        })
         total_pages = ceil(total_forms / per_page)
-        
+
+        # Owner, approver and division come from the same query
+        approver = db.aliased(User)
+        rows = query.outerjoin(
+            approver, approver.user_id == db.cast(Form.approved_by, db.Integer)
+        ).outerjoin(
+            Division, Division.division_id == Form.division
+        ).add_columns(
+            User.user_name,
+            approver.user_id,
+            approver.user_name,
+            Division.division_id,
+            Division.division_name,
+            form_status_case(now, review_due_label="review due").label('status'),
+        ).order_by(*NEWEST_FIRST)
+
         # Calculate pagination bounds
         start_index = (page - 1) * per_page
         end_index = start_index + per_page
-        paginated_forms = filtered_forms[start_index:end_index]
+        if cursor:
+            try:
+                rows = rows.filter(seek_after(cursor))
+            except ValueError as e:
+                return jsonify({'error': str(e)}), 400
+        else:
+            rows = rows.offset(start_index)
+        # one row past the page says whether another page follows
+        paginated_forms = rows.limit(per_page + 1).all()
+        more_rows = len(paginated_forms) > per_page
+        paginated_forms = paginated_forms[:per_page]
 
         print(f"Total forms after filtering: {total_forms}, Current page forms: {len(paginated_forms)}")
 
-        forms_list = []
-        for form, user, status in paginated_forms:
+        def format_date(date_obj):
+            return date_obj.isoformat() if date_obj else None
 
-            def format_date(date_obj):
-                return date_obj.isoformat() if date_obj else None
-            
+        forms_list = []
+        for form, owner_name, approver_id, approver_name, division_id, division_name, status in paginated_forms:
             # Get approved_by username if available
             approved_by_username = None
             if form.approved_by:
-                approved_by_user = User.query.filter_by(user_id=form.approved_by).first()
-                approved_by_username = approved_by_user.user_name if approved_by_user else f"User ID: {form.approved_by}"
+                approved_by_username = approver_name if approver_id is not None else f"User ID: {form.approved_by}"
             
             # Get division name if available
-            division_name = None
+            division_label = None
             if form.division:
-                division_obj = Division.query.filter_by(division_id=form.division).first()
-                division_name = division_obj.division_name if division_obj else f"Division ID: {form.division}"
+                division_label = division_name if division_id is not None else f"Division ID: {form.division}"
 
             forms_list.append({
                 'id': form.form_id,
                 'title': form.title or "Untitled Form",
                 'form_reference_number': form.form_reference_number,
                 'location': form.location,
-                'division': division_name,
+                'division': division_label,
                 'division_id': form.division,
                 'process': form.process,
                 'status': status,
@@ -943,27 +967,50 @@ def retrieve_forms():
                 'form_RA_team_id': form.form_RA_team_id,
                 'approved_by': form.approved_by,
                 'approved_by_username': approved_by_username,
-                'owner': user.user_name,  # Username of the form creator
-                'owner_email': user.email if hasattr(user, 'email') else None,  # Add email if available
+                'owner': owner_name,  # Username of the form creator
+                'owner_email': None,  # the user table has no email column under that name
                 # 'owner_department': user.department if hasattr(user, 'department') else None  # Add department if available
             })
 
-        has_next = page < total_pages
-        has_prev = page > 1
+        # Cursor for the page after this one
+        next_cursor = None
+        if more_rows:
+            last_form = paginated_forms[-1][0]
+            next_cursor = encode_cursor(last_form.last_access_date, last_form.form_id)
+
+        if cursor:
+            # a keyset page has no page number or absolute position; a
+            # cursor only ever comes from an earlier page
+            pagination = {
+                'current_page': None,
+                'has_next': next_cursor is not None,
+                'has_prev': True,
+                'next_page': None,
+                'prev_page': None,
+                'start_index': None,
+                'end_index': None,
+            }
+        else:
+            has_next = more_rows
+            has_prev = page > 1
+            pagination = {
+                'current_page': page,
+                'has_next': has_next,
+                'has_prev': has_prev,
+                'next_page': page + 1 if has_next else None,
+                'prev_page': page - 1 if has_prev else None,
+                'start_index': start_index + 1 if paginated_forms else 0,
+                'end_index': start_index + len(paginated_forms),
+            }
 
         response_data = {
             'forms': forms_list,
             'pagination': {
-                'current_page': page,
+                **pagination,
                 'per_page': per_page,
                 'total_forms': total_forms,
                 'total_pages': total_pages,
-                'has_next': has_next,
-                'has_prev': has_prev,
-                'next_page': page + 1 if has_next else None,
-                'prev_page': page - 1 if has_prev else None,
-                'start_index': start_index + 1 if total_forms > 0 else 0,
-                'end_index': min(end_index, total_forms)
+                'next_cursor': next_cursor
             },
             'filters': {
                 'search': search,
@@ -972,7 +1019,7 @@ def retrieve_forms():
             }
         }
 
-        print(f"Returning page {page} with {len(forms_list)} forms")
+        print(f"Returning page {cursor and 'after cursor' or page} with {len(forms_list)} forms")
         
         # Create response with no-cache headers
         response = make_response(jsonify(response_data))
@@ -1007,30 +1054,12 @@ def delete_form(form_id):
         if not form:
             return jsonify({'error': 'Form not found'}), 404
         
-        # Delete all processes and activities associated with the form
-        processes = Process.query.filter_by(process_form_id=form_id).all()
-        for process in processes:
-            # Delete all activities associated with this process
-            activities = Activity.query.filter_by(activity_process_id=process.process_id).all()
-        
-            for activity in activities:
-                # Delete hazards associated with this activity
-                hazards = Hazard.query.filter_by(hazard_activity_id=activity.activity_id).all()
-            
-                for hazard in hazards:
-                    # Delete risks associated with this hazard
-                    Risk.query.filter_by(risk_hazard_id=hazard.hazard_id).delete()
-                
-                # Delete the hazards
-                Hazard.query.filter_by(hazard_activity_id=activity.activity_id).delete()
-            
-            # Delete the activities
-            Activity.query.filter_by(activity_process_id=process.process_id).delete()
-        
-            # Finally, delete the process
-            db.session.delete(process)
-        db.session.delete(form)
+        # Delete the form with its processes, activities, hazards and risks,
+        # one statement per table (see form_tree.py)
+        deleted = delete_forms([form_id])
         db.session.commit()
+        invalidate_form_counts()
+        print(f"Deleted form {form_id}: {deleted}")
         
         return jsonify({
             'success': True,
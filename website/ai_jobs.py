@@ -0,0 +1,203 @@
+# Background AI generation jobs
+# /user/ai_generate and /user/get_activities hold a request thread for the
+# whole GPT call. A job instead records the request in the ai_job table and
+# runs it on a small local thread pool, so the request returns a job id at once
+# and the client polls (or long-polls) for the result. Job state lives in the
+# database, so any worker process can answer a status request; the job itself
+# runs in the process that accepted it. If that process dies (restart, crash,
+# OOM kill) its jobs would stay queued or running forever, so a job that has
+# not finished within AI_JOB_STALE_AFTER seconds is marked failed.
+import json
+import os
+import threading
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timedelta
+from models import db, AIJob
+from .rag import ai_function, get_matched_activities
+
+AI_JOB_WORKERS = int(os.getenv("AI_JOB_WORKERS", "4"))
+FINISHED_STATUSES = ("done", "failed", "cancelled")
+# far longer than a job can legitimately take: every OpenAI call it makes has
+# its own OPENAI_TIMEOUT
+AI_JOB_STALE_AFTER = int(os.getenv("AI_JOB_STALE_AFTER", "600"))
+STALE_JOB_ERROR = "Job was abandoned (the worker running it stopped)"
+# seconds between status reads while long-polling a job run by another process
+AI_JOB_POLL_INTERVAL = float(os.getenv("AI_JOB_POLL_INTERVAL", "0.5"))
+
+
+def _run_hazards(payload):
+    return {"hazard_data": ai_function(str(payload["input"]))}
+
+
+def _run_activities(payload):
+    activities, text = get_matched_activities(str(payload["title"]), str(payload["processName"]))
+    return {"activities": activities, "processName": str(payload["processName"]), "text": text}
+
+
+# job kind -> (required payload fields, function producing the JSON result)
+JOB_KINDS = {
+    "hazards": (("input",), _run_hazards),
+    "activities": (("title", "processName"), _run_activities),
+}
+
+_executor = ThreadPoolExecutor(max_workers=AI_JOB_WORKERS, thread_name_prefix="ai-job")
+# job id -> (future, finished event) for jobs started by this process
+_local_jobs = {}
+_local_lock = threading.Lock()
+
+
+def ensure_job_table(app):
+    with app.app_context():
+        AIJob.__table__.create(db.engine, checkfirst=True)
+        failed = fail_stale_jobs()
+        if failed:
+            print(f"Marked {failed} abandoned AI job(s) as failed")
+
+
+def _stale_condition(now):
+    cutoff = now - timedelta(seconds=AI_JOB_STALE_AFTER)
+    return db.or_(
+        db.and_(AIJob.status == "queued", AIJob.created_at < cutoff),
+        db.and_(AIJob.status == "running", AIJob.started_at < cutoff),
+    )
+
+
+# Fail every queued or running job that is past AI_JOB_STALE_AFTER, whichever
+# process accepted it. Returns the number of jobs failed.
+def fail_stale_jobs():
+    now = datetime.now()
+    failed = AIJob.query.filter(_stale_condition(now)).update(
+        {"status": "failed", "error": STALE_JOB_ERROR, "finished_at": now}, synchronize_session=False
+    )
+    db.session.commit()
+    return failed
+
+
+# Same for one job, when its status is asked for; True if it was failed now
+def fail_if_stale(job):
+    if job.status in FINISHED_STATUSES:
+        return False
+    now = datetime.now()
+    failed = AIJob.query.filter(AIJob.job_id == job.job_id, _stale_condition(now)).update(
+        {"status": "failed", "error": STALE_JOB_ERROR, "finished_at": now}, synchronize_session=False
+    )
+    db.session.commit()
+    if failed:
+        db.session.refresh(job)
+    return bool(failed)
+
+
+def job_to_dict(job, include_result=True):
+    data = {
+        "job_id": job.job_id,
+        "kind": job.kind,
+        "status": job.status,
+        "created_at": job.created_at.isoformat() if job.created_at else None,
+        "started_at": job.started_at.isoformat() if job.started_at else None,
+        "finished_at": job.finished_at.isoformat() if job.finished_at else None,
+    }
+    if job.status == "failed":
+        data["error"] = job.error
+    if include_result and job.status == "done":
+        data["result"] = json.loads(job.result)
+    return data
+
+
+def submit_job(app, kind, payload, user_id=None):
+    if kind not in JOB_KINDS:
+        raise ValueError(f"Unknown job kind: {kind}")
+    missing = [field for field in JOB_KINDS[kind][0] if not payload.get(field)]
+    if missing:
+        raise ValueError(f"Missing {', '.join(missing)}")
+
+    job = AIJob(
+        job_id=uuid.uuid4().hex,
+        job_user_id=user_id,
+        kind=kind,
+        status="queued",
+        payload=json.dumps(payload),
+        created_at=datetime.now(),
+    )
+    db.session.add(job)
+    db.session.commit()
+
+    finished = threading.Event()
+    with _local_lock:
+        future = _executor.submit(_run_job, app, job.job_id, finished)
+        _local_jobs[job.job_id] = (future, finished)
+    return job
+
+
+def _update_job(job_id, only_if, **fields):
+    # conditional update, so a job cancelled meanwhile is never overwritten
+    updated = AIJob.query.filter(AIJob.job_id == job_id, AIJob.status.in_(only_if)).update(
+        fields, synchronize_session=False
+    )
+    db.session.commit()
+    return updated
+
+
+def _run_job(app, job_id, finished):
+    try:
+        with app.app_context():
+            if not _update_job(job_id, ("queued",), status="running", started_at=datetime.now()):
+                return  # cancelled before it started
+            job = db.session.get(AIJob, job_id)
+            payload = json.loads(job.payload)
+            run = JOB_KINDS[job.kind][1]
+            try:
+                result = run(payload)
+            except Exception as e:
+                db.session.rollback()
+                print(f"AI job {job_id} failed: {e}")
+                _update_job(job_id, ("running",), status="failed", error=str(e), finished_at=datetime.now())
+                return
+            _update_job(job_id, ("running",), status="done", result=json.dumps(result), finished_at=datetime.now())
+            print(f"AI job {job_id} done")
+    except Exception as e:
+        print(f"AI job {job_id} could not be run: {e}")
+    finally:
+        finished.set()
+        with _local_lock:
+            _local_jobs.pop(job_id, None)
+
+
+# Block for up to timeout seconds until the job finishes: on its event if it
+# runs in this process, otherwise by re-reading its row
+def wait_for_job(job_id, timeout):
+    if timeout <= 0:
+        return
+    with _local_lock:
+        local = _local_jobs.get(job_id)
+    if local is not None:
+        local[1].wait(timeout)
+        return
+    deadline = time.monotonic() + timeout
+    while True:
+        # end the read transaction so the next read sees other workers' commits
+        db.session.rollback()
+        status = db.session.query(AIJob.status).filter(AIJob.job_id == job_id).scalar()
+        remaining = deadline - time.monotonic()
+        if status is None or status in FINISHED_STATUSES or remaining <= 0:
+            return
+        time.sleep(min(AI_JOB_POLL_INTERVAL, remaining))
+
+
+def cancel_job(job):
+    if job.status in FINISHED_STATUSES:
+        return False
+    # a running GPT call cannot be interrupted, but its result is discarded
+    cancelled = _update_job(
+        job.job_id, ("queued", "running"), status="cancelled", finished_at=datetime.now()
+    )
+    with _local_lock:
+        local = _local_jobs.get(job.job_id)
+    if local is not None:
+        if local[0].cancel():
+            # never started, so _run_job will not clean up after it
+            with _local_lock:
+                _local_jobs.pop(job.job_id, None)
+        local[1].set()
+    return bool(cancelled)
@@ -0,0 +1,132 @@
+# Approximate nearest-neighbour search for large knowledge bases
+# IVF (inverted file) index: spherical k-means splits the unit-length KB rows
+# into nlist clusters, and a query only scores the rows of the nprobe clusters
+# whose centroids are closest to it. nprobe trades recall for latency:
+# nprobe == nlist is an exact search. Pure NumPy, persisted as a .npz next to
+# the embedding store.
+import os
+import numpy as np
+
+# rows scored per matrix multiply while assigning rows to clusters
+_CHUNK = 4096
+
+
+def default_nlist(count):
+    return max(1, min(4096, int(2 * np.sqrt(count))))
+
+
+def _normalise(matrix):
+    norms = np.linalg.norm(matrix, axis=1, keepdims=True)
+    norms[norms == 0] = 1.0
+    return matrix / norms
+
+
+def _assign(matrix, centroids):
+    labels = np.empty(matrix.shape[0], dtype=np.int32)
+    for start in range(0, matrix.shape[0], _CHUNK):
+        block = np.asarray(matrix[start:start + _CHUNK], dtype=np.float32)
+        labels[start:start + _CHUNK] = np.argmax(block @ centroids.T, axis=1)
+    return labels
+
+
+def _train(matrix, nlist, iterations, seed):
+    rng = np.random.default_rng(seed)
+    count = matrix.shape[0]
+    # k-means on a sample is plenty for choosing the cells
+    sample_size = min(count, max(nlist * 32, 10000))
+    sample = np.asarray(matrix[np.sort(rng.choice(count, sample_size, replace=False))], dtype=np.float32)
+    centroids = sample[rng.choice(sample_size, nlist, replace=False)].copy()
+    for _ in range(iterations):
+        labels = _assign(sample, centroids)
+        counts = np.bincount(labels, minlength=nlist)
+        order = np.argsort(labels, kind="stable")
+        sums = np.zeros_like(centroids)
+        present = np.flatnonzero(counts)
+        starts = np.concatenate([[0], np.cumsum(counts)])[present]
+        sums[present] = np.add.reduceat(sample[order], starts, axis=0)
+        empty = np.flatnonzero(counts == 0)
+        if len(empty):
+            # reseed empty cells with the rows that fit their cell worst
+            fit = np.einsum("ij,ij->i", sample, centroids[labels])
+            sums[empty] = sample[np.argsort(fit)[:len(empty)]]
+        centroids = _normalise(sums).astype(np.float32)
+    return centroids
+
+
+class IVFIndex:
+    def __init__(self, centroids, labels, count, trained_count, content_hash=None):
+        self.centroids = np.ascontiguousarray(centroids, dtype=np.float32)
+        self.labels = np.asarray(labels, dtype=np.int32)
+        self.count = count
+        self.trained_count = trained_count
+        self.content_hash = content_hash
+        self._build_lists()
+
+    def _build_lists(self):
+        # row ids grouped by cell: ids[offsets[c]:offsets[c + 1]] belong to cell c
+        self.ids = np.argsort(self.labels, kind="stable").astype(np.int64)
+        counts = np.bincount(self.labels, minlength=len(self.centroids))
+        self.offsets = np.concatenate([[0], np.cumsum(counts)])
+
+    @property
+    def nlist(self):
+        return len(self.centroids)
+
+    @classmethod
+    def build(cls, matrix, nlist=None, iterations=10, seed=0, content_hash=None):
+        count = matrix.shape[0]
+        nlist = min(nlist or default_nlist(count), count)
+        centroids = _train(matrix, nlist, iterations, seed)
+        return cls(centroids, _assign(matrix, centroids), count, count, content_hash)
+
+    # Add rows appended to the matrix since the index was built, without retraining
+    def extend(self, matrix, content_hash=None):
+        if matrix.shape[0] > self.count:
+            new_labels = _assign(matrix[self.count:], self.centroids)
+            self.labels = np.concatenate([self.labels, new_labels])
+            self.count = matrix.shape[0]
+            self._build_lists()
+        self.content_hash = content_hash
+        return self
+
+    def candidates(self, query, nprobe):
+        nprobe = max(1, min(nprobe, self.nlist))
+        cells = np.argpartition(-(self.centroids @ query), nprobe - 1)[:nprobe]
+        return np.concatenate([self.ids[self.offsets[c]:self.offsets[c + 1]] for c in cells])
+
+    # Returns (row ids, scores) of the best top_k rows, best first
+    def search(self, matrix, query, top_k=1, nprobe=8):
+        query = np.asarray(query, dtype=np.float32)
+        ids = self.candidates(query, nprobe)
+        if len(ids) == 0:
+            return ids, np.empty(0, dtype=np.float32)
+        ids.sort()  # sequential reads from a memory-mapped matrix
+        scores = np.asarray(matrix[ids], dtype=np.float32) @ query
+        top_k = min(top_k, len(ids))
+        best = np.argpartition(-scores, top_k - 1)[:top_k]
+        best = best[np.argsort(-scores[best], kind="stable")]
+        return ids[best], scores[best]
+
+    def save(self, path):
+        tmp_path = f"{path}.tmp"
+        with open(tmp_path, "wb") as f:
+            np.savez(
+                f,
+                centroids=self.centroids,
+                labels=self.labels,
+                count=np.int64(self.count),
+                trained_count=np.int64(self.trained_count),
+                content_hash=np.array(self.content_hash or ""),
+            )
+        os.replace(tmp_path, path)
+
+    @classmethod
+    def load(cls, path):
+        with np.load(path, allow_pickle=False) as data:
+            return cls(
+                data["centroids"],
+                data["labels"],
+                int(data["count"]),
+                int(data["trained_count"]),
+                str(data["content_hash"]) or None,
+            )
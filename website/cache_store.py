@@ -0,0 +1,206 @@
+# Small on-disk key/value cache shared by every worker process on a host
+# Backed by SQLite in WAL mode so concurrent readers and writers from several
+# gunicorn/flask workers are safe. Entries are evicted least-recently-used
+# first once the entry or byte limit is exceeded, and may carry a TTL.
+import hashlib
+import os
+import re
+import sqlite3
+import threading
+import time
+import unicodedata
+
+
+def normalise_text(text):
+    text = unicodedata.normalize("NFKC", str(text))
+    return re.sub(r"\s+", " ", text).strip().casefold()
+
+
+def text_key(namespace, text):
+    digest = hashlib.sha256(normalise_text(text).encode("utf-8")).hexdigest()
+    return f"{namespace}:{digest}"
+
+
+# Rows keep the value blob in the last column, so scans that only need the
+# key, size or timestamps never read a blob's overflow pages. Entry and byte
+# totals live in a one-row meta table kept up to date by triggers, so a write
+# does not have to sum the table to know whether to evict.
+SCHEMA = (
+    "DROP TABLE IF EXISTS cache_entry",  # pre-meta layout (blob before size)
+    "CREATE TABLE IF NOT EXISTS cache_item ("
+    " key TEXT PRIMARY KEY,"
+    " size INTEGER NOT NULL,"
+    " accessed REAL NOT NULL,"
+    " expires REAL,"
+    " value BLOB NOT NULL)",
+    "CREATE INDEX IF NOT EXISTS cache_item_accessed ON cache_item (accessed)",
+    "CREATE INDEX IF NOT EXISTS cache_item_expires ON cache_item (expires) WHERE expires IS NOT NULL",
+    "CREATE TABLE IF NOT EXISTS cache_meta ("
+    " id INTEGER PRIMARY KEY CHECK (id = 1),"
+    " entries INTEGER NOT NULL,"
+    " bytes INTEGER NOT NULL)",
+    "INSERT OR IGNORE INTO cache_meta (id, entries, bytes)"
+    " SELECT 1, COUNT(*), COALESCE(SUM(size), 0) FROM cache_item",
+    "CREATE TRIGGER IF NOT EXISTS cache_item_insert AFTER INSERT ON cache_item BEGIN"
+    " UPDATE cache_meta SET entries = entries + 1, bytes = bytes + new.size WHERE id = 1; END",
+    "CREATE TRIGGER IF NOT EXISTS cache_item_delete AFTER DELETE ON cache_item BEGIN"
+    " UPDATE cache_meta SET entries = entries - 1, bytes = bytes - old.size WHERE id = 1; END",
+    "CREATE TRIGGER IF NOT EXISTS cache_item_resize AFTER UPDATE OF size ON cache_item BEGIN"
+    " UPDATE cache_meta SET bytes = bytes - old.size + new.size WHERE id = 1; END",
+)
+
+
+class SQLiteCache:
+    def __init__(self, path, max_entries=50000, max_bytes=256 * 1024 * 1024, default_ttl=None):
+        self.path = path
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.default_ttl = default_ttl
+        self.hits = 0
+        self.misses = 0
+        self._local = threading.local()
+        self._counter_lock = threading.Lock()
+        # a broken cache only costs us cache misses, never a failed request
+        try:
+            directory = os.path.dirname(path)
+            if directory:
+                os.makedirs(directory, exist_ok=True)
+        except OSError as e:
+            print(f"Cache unavailable ({path}): {e}")
+
+    # Connections are opened lazily, per thread and per process: a worker
+    # forked from a preloaded parent must not reuse the parent's connection
+    def _connect(self):
+        conn = getattr(self._local, "conn", None)
+        if conn is None or self._local.pid != os.getpid():
+            conn = sqlite3.connect(self.path, timeout=5, isolation_level=None)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            with conn:
+                conn.execute("BEGIN IMMEDIATE")
+                for statement in SCHEMA:
+                    conn.execute(statement)
+            self._local.conn = conn
+            self._local.pid = os.getpid()
+        return conn
+
+    def _count(self, hits, misses):
+        with self._counter_lock:
+            self.hits += hits
+            self.misses += misses
+
+    def get(self, key):
+        return self.get_many([key]).get(key)
+
+    def get_many(self, keys):
+        keys = list(dict.fromkeys(keys))
+        if not keys:
+            return {}
+        found = {}
+        now = time.time()
+        try:
+            conn = self._connect()
+            # stay well below SQLite's bound-parameter limit
+            for i in range(0, len(keys), 500):
+                chunk = keys[i:i + 500]
+                marks = ",".join("?" * len(chunk))
+                rows = conn.execute(
+                    f"SELECT key, value FROM cache_item WHERE key IN ({marks})"
+                    " AND (expires IS NULL OR expires > ?)",
+                    (*chunk, now),
+                ).fetchall()
+                found.update(rows)
+                if rows:
+                    conn.execute(
+                        f"UPDATE cache_item SET accessed = ? WHERE key IN ({','.join('?' * len(rows))})",
+                        (now, *[row[0] for row in rows]),
+                    )
+        except sqlite3.Error as e:
+            print(f"Cache read failed ({self.path}): {e}")
+            found = {}
+        self._count(len(found), len(keys) - len(found))
+        return found
+
+    def set(self, key, value, ttl=None):
+        self.set_many({key: value}, ttl=ttl)
+
+    def set_many(self, items, ttl=None):
+        if not items:
+            return
+        ttl = self.default_ttl if ttl is None else ttl
+        now = time.time()
+        expires = now + ttl if ttl else None
+        try:
+            conn = self._connect()
+            # an upsert rather than INSERT OR REPLACE, so the triggers see an
+            # UPDATE of an existing key instead of a silent delete
+            conn.executemany(
+                "INSERT INTO cache_item (key, size, accessed, expires, value) VALUES (?, ?, ?, ?, ?)"
+                " ON CONFLICT (key) DO UPDATE SET size = excluded.size, accessed = excluded.accessed,"
+                " expires = excluded.expires, value = excluded.value",
+                [(key, len(value), now, expires, value) for key, value in items.items()],
+            )
+            self._evict(conn, now)
+        except sqlite3.Error as e:
+            print(f"Cache write failed ({self.path}): {e}")
+
+    def delete(self, key):
+        try:
+            self._connect().execute("DELETE FROM cache_item WHERE key = ?", (key,))
+        except sqlite3.Error as e:
+            print(f"Cache delete failed ({self.path}): {e}")
+
+    def delete_prefix(self, prefix):
+        # keys are "<namespace>:...", so this drops a whole namespace
+        try:
+            cursor = self._connect().execute(
+                "DELETE FROM cache_item WHERE substr(key, 1, ?) = ?", (len(prefix), prefix)
+            )
+            return cursor.rowcount
+        except sqlite3.Error as e:
+            print(f"Cache delete failed ({self.path}): {e}")
+            return 0
+
+    def clear(self):
+        try:
+            self._connect().execute("DELETE FROM cache_item")
+        except sqlite3.Error as e:
+            print(f"Cache clear failed ({self.path}): {e}")
+
+    def _totals(self, conn):
+        return conn.execute("SELECT entries, bytes FROM cache_meta WHERE id = 1").fetchone()
+
+    def _evict(self, conn, now):
+        # uses the partial index on expires, so this is cheap when nothing expired
+        conn.execute("DELETE FROM cache_item WHERE expires IS NOT NULL AND expires <= ?", (now,))
+        count, total = self._totals(conn)
+        if count <= self.max_entries and total <= self.max_bytes:
+            return
+        # walk from least recently used until both limits hold again
+        excess_entries = count - self.max_entries
+        excess_bytes = total - self.max_bytes
+        doomed = []
+        cursor = conn.execute("SELECT key, size FROM cache_item ORDER BY accessed")
+        for key, size in cursor:
+            if excess_entries <= 0 and excess_bytes <= 0:
+                break
+            doomed.append((key,))
+            excess_entries -= 1
+            excess_bytes -= size
+        cursor.close()
+        conn.executemany("DELETE FROM cache_item WHERE key = ?", doomed)
+
+    def stats(self):
+        try:
+            count, total = self._totals(self._connect())
+        except sqlite3.Error:
+            count, total = None, None
+        return {
+            "path": self.path,
+            "entries": count,
+            "bytes": total,
+            "max_entries": self.max_entries,
+            "max_bytes": self.max_bytes,
+            "hits": self.hits,
+            "misses": self.misses,
+        }
@@ -0,0 +1,122 @@
+# Cross-request micro-batching of query embeddings
+# Each request embeds its one or two strings on its own. A dispatcher holds
+# every query that arrives within a short window (or until max_batch strings
+# are waiting), sends them as one embeddings request and hands each caller its
+# own vectors. Under load this turns many single-string API calls into a few
+# batched ones. Everything except stats() runs on the shared client's event
+# loop, so the pending queue needs no lock.
+import asyncio
+import os
+import time
+from . import openai_client
+
+BATCH_WINDOW = float(os.getenv("OPENAI_EMBED_BATCH_WINDOW_MS", "10")) / 1000
+BATCH_MAX = int(os.getenv("OPENAI_EMBED_BATCH_MAX", "256"))
+# the embeddings API accepts up to 2048 inputs per request
+API_MAX_INPUTS = 2048
+
+
+class EmbeddingDispatcher:
+    def __init__(self, model, window=BATCH_WINDOW, max_batch=BATCH_MAX):
+        self.model = model
+        self.window = window
+        self.max_batch = max_batch
+        self._pending = []  # (texts, future, time queued)
+        self._pending_count = 0
+        self._timer = None
+        self.batches = 0
+        self.callers = 0
+        self.inputs = 0
+        self.sent = 0
+        self.errors = 0
+        self.largest_batch = 0
+        self.total_wait = 0.0
+        self.longest_wait = 0.0
+
+    async def aembed(self, texts):
+        loop = asyncio.get_running_loop()
+        future = loop.create_future()
+        self._pending.append((list(texts), future, time.monotonic()))
+        self._pending_count += len(texts)
+        if self._pending_count >= self.max_batch or self.window <= 0:
+            self._flush()
+        elif self._timer is None:
+            self._timer = loop.call_later(self.window, self._flush)
+        return await future
+
+    def _flush(self):
+        if self._timer is not None:
+            self._timer.cancel()
+            self._timer = None
+        batch, self._pending, self._pending_count = self._pending, [], 0
+        if batch:
+            asyncio.ensure_future(self._send(batch))
+
+    async def _send(self, batch):
+        started = time.monotonic()
+        unique = list(dict.fromkeys(text for texts, _, _ in batch for text in texts))
+        self.batches += 1
+        self.callers += len(batch)
+        self.inputs += sum(len(texts) for texts, _, _ in batch)
+        self.sent += len(unique)
+        self.largest_batch = max(self.largest_batch, len(unique))
+        for _, _, queued in batch:
+            self.total_wait += started - queued
+            self.longest_wait = max(self.longest_wait, started - queued)
+        try:
+            chunks = await asyncio.gather(*(
+                openai_client.aembed(unique[i:i + API_MAX_INPUTS], self.model)
+                for i in range(0, len(unique), API_MAX_INPUTS)
+            ))
+        except Exception as e:
+            self.errors += 1
+            for _, future, _ in batch:
+                if not future.done():
+                    future.set_exception(e)
+            return
+        vector_of = dict(zip(unique, (vector for chunk in chunks for vector in chunk)))
+        for texts, future, _ in batch:
+            if not future.done():
+                future.set_result([vector_of[text] for text in texts])
+
+    # Blocks the calling thread until the batch holding texts has been sent
+    def embed(self, texts):
+        openai_client._ensure_loop()
+        return openai_client.run(self.aembed(texts), self.window + openai_client.wait_bound(1))
+
+    def stats(self):
+        batches = self.batches or 1
+        return {
+            "model": self.model,
+            "window_ms": self.window * 1000,
+            "max_batch": self.max_batch,
+            "batches": self.batches,
+            "callers": self.callers,
+            "inputs": self.inputs,
+            "sent": self.sent,
+            "errors": self.errors,
+            "avg_batch_size": round(self.sent / batches, 2),
+            "avg_callers_per_batch": round(self.callers / batches, 2),
+            "largest_batch": self.largest_batch,
+            "avg_wait_ms": round(self.total_wait * 1000 / (self.callers or 1), 2),
+            "max_wait_ms": round(self.longest_wait * 1000, 2),
+        }
+
+
+_dispatchers = {}
+
+# queued futures and timers belong to the parent's loop, which a forked child
+# does not have; the child starts with fresh dispatchers on its own loop
+if hasattr(os, "register_at_fork"):
+    os.register_at_fork(after_in_child=_dispatchers.clear)
+
+
+def get_dispatcher(model):
+    dispatcher = _dispatchers.get(model)
+    if dispatcher is None:
+        dispatcher = _dispatchers.setdefault(model, EmbeddingDispatcher(model))
+    return dispatcher
+
+
+def dispatcher_stats():
+    return {model: dispatcher.stats() for model, dispatcher in list(_dispatchers.items())}
@@ -0,0 +1,149 @@
+# Embedding providers for the RAG knowledge bases
+# OpenAIEmbeddingProvider calls the remote embeddings API. HashingNgramProvider
+# is a local CPU backend: hashed character n-gram TF-IDF, reduced with a
+# truncated SVD fitted on the knowledge base. It needs no network and embeds a
+# query in well under a millisecond, at some cost in semantic quality.
+# A provider's name is recorded in the embedding store manifest and in query
+# cache keys, so vectors from different providers are never mixed.
+import hashlib
+import os
+import zlib
+import numpy as np
+from . import openai_client
+from .cache_store import normalise_text
+from .embedding_dispatcher import get_dispatcher
+
+
+class EmbeddingProvider:
+    name = None
+    # remote providers are worth caching per query, local ones are not
+    cacheable = False
+
+    def embed(self, texts):
+        raise NotImplementedError
+
+    # Embedding for live queries; remote providers merge these across requests
+    def embed_queries(self, texts):
+        return self.embed(texts)
+
+
+class OpenAIEmbeddingProvider(EmbeddingProvider):
+    cacheable = True
+
+    def __init__(self, model="text-embedding-3-small", batch_size=100):
+        self.model = model
+        self.name = model
+        self.batch_size = batch_size
+
+    def embed(self, texts, batch_size=None):
+        batch_size = batch_size or self.batch_size
+        # batches are independent, so they are sent concurrently (bounded by
+        # the shared client's semaphore)
+        batches = openai_client.run_all(
+            openai_client.aembed(texts[i:i + batch_size], self.model)
+            for i in range(0, len(texts), batch_size)
+        )
+        embeddings = [embedding for batch in batches for embedding in batch]
+        return np.asarray(embeddings, dtype=np.float32).reshape(len(embeddings), -1)
+
+    # A few query strings go through the shared micro-batching dispatcher
+    # (see embedding_dispatcher.py); a large batch is already worth its own
+    # requests
+    def embed_queries(self, texts):
+        dispatcher = get_dispatcher(self.model)
+        if len(texts) > dispatcher.max_batch:
+            return self.embed(texts, batch_size=2048)
+        embeddings = dispatcher.embed(texts)
+        return np.asarray(embeddings, dtype=np.float32).reshape(len(embeddings), -1)
+
+
+class HashingNgramProvider(EmbeddingProvider):
+    def __init__(self, idf, components, n_features=4096, ngram_range=(3, 5)):
+        self.idf = np.asarray(idf, dtype=np.float32)
+        # (n_features, k) projection, or an empty array for no SVD
+        self.components = np.asarray(components, dtype=np.float32)
+        self.n_features = n_features
+        self.ngram_range = tuple(ngram_range)
+        digest = hashlib.sha256(self.idf.tobytes() + self.components.tobytes()).hexdigest()[:12]
+        self.name = f"local-ngram-{n_features}-{self.dimension}-{digest}"
+
+    @property
+    def dimension(self):
+        return self.components.shape[1] if self.components.size else self.n_features
+
+    def _hashed_counts(self, text):
+        padded = f" {normalise_text(text)} "
+        low, high = self.ngram_range
+        # crc32 rather than hash(): it must be stable across processes
+        buckets = [
+            zlib.crc32(padded[i:i + n].encode("utf-8")) % self.n_features
+            for n in range(low, high + 1)
+            for i in range(len(padded) - n + 1)
+        ]
+        return np.unique(np.asarray(buckets, dtype=np.int64), return_counts=True)
+
+    def _tfidf(self, texts, idf=None):
+        rows = np.zeros((len(texts), self.n_features), dtype=np.float32)
+        for row, text in enumerate(texts):
+            buckets, counts = self._hashed_counts(text)
+            rows[row, buckets] = 1.0 + np.log(counts)
+        if idf is not None:
+            rows *= idf
+        norms = np.linalg.norm(rows, axis=1, keepdims=True)
+        norms[norms == 0] = 1.0
+        return rows / norms
+
+    def embed(self, texts):
+        vectors = []
+        # chunked so a large knowledge base never needs the full dense tf-idf matrix
+        for i in range(0, len(texts), 2048):
+            chunk = self._tfidf(texts[i:i + 2048], self.idf)
+            if self.components.size:
+                chunk = chunk @ self.components
+                norms = np.linalg.norm(chunk, axis=1, keepdims=True)
+                norms[norms == 0] = 1.0
+                chunk = chunk / norms
+            vectors.append(chunk.astype(np.float32))
+        if not vectors:
+            return np.empty((0, self.dimension), dtype=np.float32)
+        return np.vstack(vectors)
+
+    @classmethod
+    def fit(cls, corpus, n_features=4096, components=256, ngram_range=(3, 5), sample_size=10000, seed=0):
+        model = cls(np.ones(n_features), np.empty((0, 0)), n_features, ngram_range)
+        rng = np.random.default_rng(seed)
+        if len(corpus) > sample_size:
+            corpus = [corpus[i] for i in np.sort(rng.choice(len(corpus), sample_size, replace=False))]
+
+        document_frequency = np.zeros(n_features, dtype=np.float64)
+        for text in corpus:
+            document_frequency[model._hashed_counts(text)[0]] += 1
+        idf = (np.log((1 + len(corpus)) / (1 + document_frequency)) + 1).astype(np.float32)
+
+        projection = np.empty((0, 0), dtype=np.float32)
+        k = min(components, len(corpus) - 1, n_features)
+        if k > 0:
+            # randomised truncated SVD (range finder + small dense SVD)
+            tfidf = model._tfidf(corpus, idf)
+            omega = rng.standard_normal((n_features, min(n_features, k + 20))).astype(np.float32)
+            basis, _ = np.linalg.qr(tfidf @ omega)
+            _, _, vt = np.linalg.svd(basis.T @ tfidf, full_matrices=False)
+            projection = vt[:k].T
+        return cls(idf, projection, n_features, ngram_range)
+
+    def save(self, path):
+        tmp_path = f"{path}.tmp"
+        with open(tmp_path, "wb") as f:
+            np.savez(
+                f,
+                idf=self.idf,
+                components=self.components,
+                n_features=np.int64(self.n_features),
+                ngram_range=np.asarray(self.ngram_range, dtype=np.int64),
+            )
+        os.replace(tmp_path, path)
+
+    @classmethod
+    def load(cls, path):
+        with np.load(path, allow_pickle=False) as data:
+            return cls(data["idf"], data["components"], int(data["n_features"]), tuple(data["ngram_range"]))
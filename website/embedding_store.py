@@ -0,0 +1,116 @@
+# On-disk format for knowledge base embeddings
+# <base>.vectors.npy   raw row-normalised float32 (or float16) matrix, no pickle
+# <base>.phrases.json  the phrases, one per row
+# <base>.manifest.json phrase count, dimension, dtype, model, content hash and
+#                      the knowledge base version the snapshot was taken at
+# The matrix is opened with mmap_mode='r', so pre-forked workers share the same
+# page-cache pages instead of each holding a private copy. The manifest is
+# written last and is what makes a new matrix "current".
+import hashlib
+import json
+import os
+import time
+import numpy as np
+
+FORMAT_VERSION = 1
+SUPPORTED_DTYPES = ("float32", "float16")
+
+
+class EmbeddingStoreError(ValueError):
+    pass
+
+
+def vectors_path(base):
+    return f"{base}.vectors.npy"
+
+
+def manifest_path(base):
+    return f"{base}.manifest.json"
+
+
+def phrases_path(base):
+    return f"{base}.phrases.json"
+
+
+def content_hash(phrases):
+    digest = hashlib.sha256()
+    for phrase in phrases:
+        digest.update(phrase.encode("utf-8"))
+        digest.update(b"\0")
+    return digest.hexdigest()
+
+
+def _replace_atomically(path, write):
+    tmp_path = f"{path}.tmp"
+    with open(tmp_path, "wb") as f:
+        write(f)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp_path, path)
+
+
+def save_store(base, phrases, embeddings, model, dtype="float32", version=None):
+    if dtype not in SUPPORTED_DTYPES:
+        raise EmbeddingStoreError(f"Unsupported embedding dtype: {dtype}")
+    matrix = np.asarray(embeddings, dtype=np.float32)
+    if matrix.ndim != 2 or matrix.shape[0] != len(phrases):
+        raise EmbeddingStoreError(
+            f"{base}: {len(phrases)} phrases but embeddings of shape {matrix.shape}"
+        )
+    norms = np.linalg.norm(matrix, axis=1, keepdims=True)
+    norms[norms == 0] = 1.0
+    matrix = np.ascontiguousarray(matrix / norms, dtype=dtype)
+
+    manifest = {
+        "format_version": FORMAT_VERSION,
+        "count": int(matrix.shape[0]),
+        "dim": int(matrix.shape[1]),
+        "dtype": dtype,
+        "model": model,
+        "normalized": True,
+        "content_hash": content_hash(phrases),
+        "version": version,
+        "updated_at": time.time(),
+    }
+    _replace_atomically(vectors_path(base), lambda f: np.save(f, matrix, allow_pickle=False))
+    _replace_atomically(phrases_path(base), lambda f: f.write(json.dumps(list(phrases)).encode("utf-8")))
+    _replace_atomically(manifest_path(base), lambda f: f.write(json.dumps(manifest, indent=2).encode("utf-8")))
+    return manifest
+
+
+def load_manifest(base):
+    path = manifest_path(base)
+    if not os.path.exists(path):
+        return None
+    with open(path, "r", encoding="utf-8") as f:
+        return json.load(f)
+
+
+# Returns (matrix, manifest), or (None, None) if there is no store yet.
+# Raises EmbeddingStoreError if the files disagree with each other.
+def load_store(base, mmap=True):
+    manifest = load_manifest(base)
+    if manifest is None or not os.path.exists(vectors_path(base)):
+        return None, None
+    if manifest.get("format_version") != FORMAT_VERSION:
+        raise EmbeddingStoreError(f"{base}: unsupported store format {manifest.get('format_version')}")
+    matrix = np.load(vectors_path(base), mmap_mode="r" if mmap else None, allow_pickle=False)
+    expected = (manifest["count"], manifest["dim"])
+    if matrix.shape != expected or str(matrix.dtype) != manifest["dtype"]:
+        raise EmbeddingStoreError(
+            f"{base}: manifest says {expected} {manifest['dtype']} but vectors are {matrix.shape} {matrix.dtype}"
+        )
+    return matrix, manifest
+
+
+# The phrases saved with the store, or None if they are missing or do not
+# match the manifest
+def load_phrases(base, manifest):
+    path = phrases_path(base)
+    if not os.path.exists(path):
+        return None
+    with open(path, "r", encoding="utf-8") as f:
+        phrases = json.load(f)
+    if len(phrases) != manifest["count"] or content_hash(phrases) != manifest["content_hash"]:
+        return None
+    return phrases
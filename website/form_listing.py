@@ -0,0 +1,128 @@
+# SQL side of the form listings (/user/retrieveForms and /admin/retrieveForms)
+# A form's status ("Completed", "Review Due" or "Incomplete") is derived from
+# its approval flag and next_review_date. Expressing it in SQL lets the status
+# filter, ordering, paging and counting all run in the database, so a page
+# costs the same however many forms match. The admin listing also pages by
+# keyset (seek) on (last_access_date, form_id) and caches its total counts.
+import base64
+import hashlib
+import json
+import os
+from datetime import datetime
+from sqlalchemy import and_, case, false, not_, or_
+from models import db, Form, User
+from .cache_store import SQLiteCache
+
+FORM_STATUSES = ("Completed", "Review Due", "Incomplete")
+
+# Totals per filter set are shared by every worker for a short while; a new
+# or deleted form shows up in the count within FORM_COUNT_TTL seconds
+FORM_COUNT_TTL = int(os.getenv("FORM_COUNT_TTL", "30"))
+form_count_cache = SQLiteCache(
+    os.getenv("FORM_COUNT_CACHE_PATH")
+    or os.path.join(os.path.dirname(os.path.abspath(__file__)), "cache", "form_counts.sqlite3"),
+    max_entries=2000,
+    max_bytes=4 * 1024 * 1024,
+    default_ttl=FORM_COUNT_TTL,
+)
+
+# Listing order for keyset paging. DESC puts NULL dates last on MySQL and
+# SQLite alike, which seek_after relies on.
+NEWEST_FIRST = (Form.last_access_date.desc(), Form.form_id.desc())
+
+
+def ensure_form_indexes(app):
+    with app.app_context():
+        for index in Form.__table__.indexes:
+            index.create(db.engine, checkfirst=True)
+
+
+def review_due(now):
+    return and_(Form.next_review_date.isnot(None), Form.next_review_date < now)
+
+
+# The status as a column; an overdue review wins over approval
+def form_status_case(now, review_due_label="Review Due"):
+    return case(
+        (review_due(now), review_due_label),
+        (Form.approval == 1, "Completed"),
+        else_="Incomplete",
+    )
+
+
+# WHERE clause for a status name (case-insensitive). Written as plain
+# predicates rather than a comparison with the CASE so indexes can be used;
+# an unknown name matches nothing, as the old Python filter did.
+def form_status_condition(status, now):
+    status = status.strip().lower()
+    if status == "review due":
+        return review_due(now)
+    if status == "completed":
+        return and_(Form.approval == 1, not_(review_due(now)))
+    if status == "incomplete":
+        return and_(or_(Form.approval.is_(None), Form.approval != 1), not_(review_due(now)))
+    return false()
+
+
+# approved_by holds a user id as text; {value: user name} for every value
+# found, in one query
+def approver_names(approved_by_values):
+    ids = {}
+    for value in approved_by_values:
+        if value and str(value).strip().isdigit():
+            ids[value] = int(str(value).strip())
+    if not ids:
+        return {}
+    names = dict(
+        db.session.query(User.user_id, User.user_name).filter(User.user_id.in_(set(ids.values()))).all()
+    )
+    return {value: names[user_id] for value, user_id in ids.items() if user_id in names}
+
+
+def approver_label(names, approved_by):
+    if not approved_by:
+        return None
+    return names.get(approved_by, f"User ID: {approved_by}")
+
+
+# COUNT(*) of a listing query, cached per filter set
+def count_forms(query, filters):
+    digest = hashlib.sha256(json.dumps(filters, sort_keys=True).encode("utf-8")).hexdigest()
+    key = f"form_count:{digest}"
+    cached = form_count_cache.get(key)
+    if cached is not None:
+        return int(cached)
+    total = query.order_by(None).count()
+    form_count_cache.set(key, str(total).encode("utf-8"))
+    return total
+
+
+def invalidate_form_counts():
+    form_count_cache.delete_prefix("form_count:")
+
+
+# Opaque cursor for the row a page ended on
+def encode_cursor(last_access_date, form_id):
+    raw = json.dumps([last_access_date.isoformat() if last_access_date else None, form_id])
+    return base64.urlsafe_b64encode(raw.encode("utf-8")).decode("ascii")
+
+
+# (last_access_date or None, form_id); ValueError if the cursor is malformed
+def decode_cursor(cursor):
+    try:
+        date, form_id = json.loads(base64.urlsafe_b64decode(cursor.encode("ascii")))
+        return (datetime.fromisoformat(date) if date else None), int(form_id)
+    except Exception:
+        raise ValueError(f"Invalid cursor: {cursor!r}")
+
+
+# Rows that come after the cursor in NEWEST_FIRST order
+def seek_after(cursor):
+    date, form_id = decode_cursor(cursor)
+    if date is None:
+        return and_(Form.last_access_date.is_(None), Form.form_id < form_id)
+    return or_(
+        Form.last_access_date < date,
+        and_(Form.last_access_date == date, Form.form_id < form_id),
+        Form.last_access_date.is_(None),
+    )
@@ -0,0 +1,199 @@
+# Whole-form operations on the form tree (form -> process -> activity ->
+# hazard -> risk), each done in a fixed number of statements however large the
+# form is, instead of one query per row at every level.
+from datetime import datetime
+from sqlalchemy import delete, insert, select
+from sqlalchemy.orm import selectinload
+from models import db, Form, Process, Activity, Hazard, Risk
+
+TREE_DEPTHS = ("processes", "activities", "hazards")
+# rows per multi-row INSERT when cloning
+CLONE_CHUNK = 500
+
+
+# A form with its subtree down to depth ("processes", "activities" or
+# "hazards", the latter with each hazard's risk and hazard type), using one
+# SELECT per level. Returns None if the form does not exist.
+def load_form_tree(form_id, depth="hazards"):
+    level = TREE_DEPTHS.index(depth)
+    processes = selectinload(Form.processes)
+    if level >= 2:
+        processes = processes.selectinload(Process.activities).selectinload(Activity.hazards).options(
+            selectinload(Hazard.risk),
+            selectinload(Hazard.hazard_type),
+        )
+    elif level >= 1:
+        processes = processes.selectinload(Process.activities)
+    return Form.query.options(processes).filter_by(form_id=form_id).first()
+
+
+# Subtree deletes: one DELETE per table, each picking its rows with an
+# IN (subquery) on the parent level, so removing a form costs five statements
+# whatever its size and the transaction stays short. The caller commits.
+# Returns {table: rows deleted}.
+def _delete_rows(model, condition):
+    result = db.session.execute(
+        delete(model).where(condition).execution_options(synchronize_session=False)
+    )
+    return result.rowcount
+
+
+def _delete_activity_rows(activity_ids):
+    hazard_ids = select(Hazard.hazard_id).where(Hazard.hazard_activity_id.in_(activity_ids))
+    deleted = {}
+    deleted["risk"] = _delete_rows(Risk, Risk.risk_hazard_id.in_(hazard_ids))
+    deleted["hazard"] = _delete_rows(Hazard, Hazard.hazard_activity_id.in_(activity_ids))
+    return deleted
+
+
+def delete_activities(activity_ids):
+    activity_ids = list(activity_ids)
+    deleted = _delete_activity_rows(activity_ids)
+    deleted["activity"] = _delete_rows(Activity, Activity.activity_id.in_(activity_ids))
+    return deleted
+
+
+def delete_processes(process_ids):
+    process_ids = list(process_ids)
+    activity_ids = select(Activity.activity_id).where(Activity.activity_process_id.in_(process_ids))
+    deleted = _delete_activity_rows(activity_ids)
+    deleted["activity"] = _delete_rows(Activity, Activity.activity_process_id.in_(process_ids))
+    deleted["process"] = _delete_rows(Process, Process.process_id.in_(process_ids))
+    return deleted
+
+
+def delete_forms(form_ids):
+    form_ids = list(form_ids)
+    process_ids = select(Process.process_id).where(Process.process_form_id.in_(form_ids))
+    activity_ids = select(Activity.activity_id).where(Activity.activity_process_id.in_(process_ids))
+    deleted = _delete_activity_rows(activity_ids)
+    deleted["activity"] = _delete_rows(Activity, Activity.activity_process_id.in_(process_ids))
+    deleted["process"] = _delete_rows(Process, Process.process_form_id.in_(form_ids))
+    deleted["form"] = _delete_rows(Form, Form.form_id.in_(form_ids))
+    return deleted
+
+
+# Multi-row INSERTs of one level, then the new ids in insertion order.
+# MySQL has no INSERT ... RETURNING, but auto-increment ids grow in the order
+# the rows are inserted, and nothing else can have added rows under parents
+# that were created in this same transaction, so sorting the new children by
+# id pairs them with the source rows.
+def _insert_level(model, id_column, parent_column, parent_ids, rows):
+    if not rows:
+        return []
+    for i in range(0, len(rows), CLONE_CHUNK):
+        db.session.execute(insert(model.__table__).values(rows[i:i + CLONE_CHUNK]))
+    new_ids = db.session.execute(
+        select(id_column).where(parent_column.in_(parent_ids)).order_by(id_column)
+    ).scalars().all()
+    if len(new_ids) != len(rows):
+        raise RuntimeError(f"Expected {len(rows)} new {model.__tablename__} rows, found {len(new_ids)}")
+    return new_ids
+
+
+# Deep copy of a form (processes, activities, hazards and their risk) owned by
+# owner_id, with review state reset. The source tree is read with one query per
+# level and each level is written with bulk INSERTs, so the cost does not grow
+# with the number of round trips per row. Returns the new Form (flushed, not
+# committed), or None if the source form does not exist.
+def clone_form(source_form_id, owner_id, title):
+    source = load_form_tree(source_form_id)
+    if source is None:
+        return None
+
+    new_form = Form(
+        title=title,
+        division=source.division,
+        location=source.location,
+        process=source.process,
+        form_reference_number=None,
+        form_user_id=owner_id,
+        form_RA_team_id=source.form_RA_team_id,
+        approval=0,
+        approved_by=None,
+        last_access_date=datetime.now(),
+        last_review_date=None,  # Reset review dates
+        next_review_date=None
+    )
+    db.session.add(new_form)
+    db.session.flush()
+
+    processes = list(source.processes)
+    new_process_ids = _insert_level(Process, Process.process_id, Process.process_form_id, [new_form.form_id], [
+        {
+            "process_form_id": new_form.form_id,
+            "process_number": process.process_number,
+            "process_title": process.process_title,
+            "process_location": process.process_location,
+        }
+        for process in processes
+    ])
+
+    activities, activity_rows = [], []
+    for process, new_process_id in zip(processes, new_process_ids):
+        for activity in process.activities:
+            activities.append(activity)
+            activity_rows.append({
+                "activity_process_id": new_process_id,
+                "work_activity": activity.work_activity,
+                "activity_number": activity.activity_number,
+                "activity_remarks": activity.activity_remarks,
+            })
+    new_activity_ids = _insert_level(
+        Activity, Activity.activity_id, Activity.activity_process_id, new_process_ids, activity_rows
+    )
+
+    hazards, hazard_rows = [], []
+    for activity, new_activity_id in zip(activities, new_activity_ids):
+        for hazard in activity.hazards:
+            hazards.append(hazard)
+            hazard_rows.append({
+                "hazard_activity_id": new_activity_id,
+                "hazard": hazard.hazard,
+                "hazard_type_id": hazard.hazard_type_id,
+                "injury": hazard.injury,
+                "hazard_implementation_person": hazard.hazard_implementation_person,
+                "hazard_due_date": hazard.hazard_due_date,
+            })
+    new_hazard_ids = _insert_level(Hazard, Hazard.hazard_id, Hazard.hazard_activity_id, new_activity_ids, hazard_rows)
+
+    risk_rows = [
+        {
+            "risk_hazard_id": new_hazard_id,
+            "existing_risk_control": hazard.risk.existing_risk_control,
+            "additional_risk_control": hazard.risk.additional_risk_control,
+            "severity": hazard.risk.severity,
+            "likelihood": hazard.risk.likelihood,
+            "RPN": hazard.risk.RPN,
+            "newSeverity": hazard.risk.newSeverity,
+            "newLikelihood": hazard.risk.newLikelihood,
+            "newRPN": hazard.risk.newRPN,
+        }
+        for hazard, new_hazard_id in zip(hazards, new_hazard_ids)
+        if hazard.risk is not None
+    ]
+    for i in range(0, len(risk_rows), CLONE_CHUNK):
+        db.session.execute(insert(Risk.__table__).values(risk_rows[i:i + CLONE_CHUNK]))
+
+    print(
+        f"Cloned form {source_form_id} -> {new_form.form_id}: {len(processes)} processes, "
+        f"{len(activities)} activities, {len(hazards)} hazards, {len(risk_rows)} risks"
+    )
+    return new_form
+
+
+# First of title, "title (1)", "title (2)", ... that owner_id does not use yet,
+# from one query
+def unique_form_title(owner_id, title):
+    # case-insensitive, like the MySQL collation the titles are compared with
+    taken = {
+        existing.casefold()
+        for existing in db.session.execute(
+            select(Form.title).where(Form.form_user_id == owner_id, Form.title.startswith(title, autoescape=True))
+        ).scalars()
+    }
+    candidate, counter = title, 1
+    while candidate.casefold() in taken:
+        candidate = f"{title} ({counter})"
+        counter += 1
+    return candidate
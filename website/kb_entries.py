@@ -0,0 +1,188 @@
+# Database storage for the RAG knowledge bases
+# Every phrase is a kb_entry row holding its text, normalised text and
+# embedding. kb_version keeps one counter per kind: each append takes the
+# kind's row lock, bumps the counter and stamps its new entries with it, so a
+# worker that has seen version v only needs the entries with version > v.
+# A full re-embed also sets rebuilt_version, which tells workers to reload
+# everything rather than apply a delta.
+import hashlib
+from datetime import datetime
+import numpy as np
+from sqlalchemy import bindparam, delete, insert, select, update
+from sqlalchemy.exc import IntegrityError
+from models import db, KBEntry, KBVersion
+from .cache_store import normalise_text
+
+
+def ensure_kb_tables(app):
+    with app.app_context():
+        KBEntry.__table__.create(db.engine, checkfirst=True)
+        KBVersion.__table__.create(db.engine, checkfirst=True)
+
+
+def normalised_hash(text):
+    return hashlib.sha256(normalise_text(text).encode("utf-8")).hexdigest()
+
+
+def embedding_blob(row):
+    return np.asarray(row, dtype=np.float32).tobytes()
+
+
+# All reads and writes here use their own connection, never db.session, so
+# they neither commit nor see a request's unfinished work
+entries = KBEntry.__table__
+versions = KBVersion.__table__
+
+
+# (version, rebuilt_version), or None if the kind has never been seeded
+def kb_state(kind):
+    with db.engine.connect() as conn:
+        row = conn.execute(
+            select(versions.c.version, versions.c.rebuilt_version).where(versions.c.kind == kind)
+        ).first()
+    return tuple(row) if row is not None else None
+
+
+# Rows as (text, embedding bytes, model) in insertion order, optionally only
+# those added after / up to a version
+def load_entries(kind, after_version=None, up_to_version=None, with_embeddings=True):
+    columns = [entries.c.text, entries.c.embedding, entries.c.model] if with_embeddings else [entries.c.text]
+    query = select(*columns).where(entries.c.kind == kind)
+    if after_version is not None:
+        query = query.where(entries.c.version > after_version)
+    if up_to_version is not None:
+        query = query.where(entries.c.version <= up_to_version)
+    with db.engine.connect() as conn:
+        return conn.execute(query.order_by(entries.c.version, entries.c.entry_id)).all()
+
+
+def _lock_state(conn, kind):
+    row = conn.execute(
+        select(versions.c.version).where(versions.c.kind == kind).with_for_update()
+    ).first()
+    if row is None:
+        raise LookupError(f"{kind} knowledge base has not been seeded")
+    return row.version
+
+
+def _set_state(conn, kind, version, rebuilt=False):
+    values = {"version": version, "updated_at": datetime.now()}
+    if rebuilt:
+        values["rebuilt_version"] = version
+    conn.execute(update(versions).where(versions.c.kind == kind).values(**values))
+
+
+def _existing_hashes(conn, kind, hashes):
+    found = set()
+    hashes = list(hashes)
+    for i in range(0, len(hashes), 500):
+        found.update(
+            h for (h,) in conn.execute(
+                select(entries.c.text_hash).where(
+                    entries.c.kind == kind, entries.c.text_hash.in_(hashes[i:i + 500])
+                )
+            )
+        )
+    return found
+
+
+def _entry_rows(kind, phrases, embeddings, model, version):
+    now = datetime.now()
+    return [
+        {
+            "kind": kind,
+            "text": phrase,
+            "normalised_text": normalise_text(phrase),
+            "text_hash": normalised_hash(phrase),
+            "embedding": embedding_blob(embedding),
+            "model": model,
+            "version": version,
+            "created_at": now,
+        }
+        for phrase, embedding in zip(phrases, embeddings)
+    ]
+
+
+def _unique(phrases, embeddings):
+    by_hash = {}
+    for phrase, embedding in zip(phrases, embeddings):
+        by_hash.setdefault(normalised_hash(phrase), (phrase, embedding))
+    return by_hash
+
+
+# Claim the seeding of an empty kind by creating its state at version 0, before
+# any embedding work. Returns False if another worker already seeded (or is
+# seeding) it.
+def claim_seed(kind):
+    try:
+        with db.engine.begin() as conn:
+            conn.execute(insert(versions).values(kind=kind, version=0, rebuilt_version=0, updated_at=datetime.now()))
+    except IntegrityError:
+        return False
+    return True
+
+
+# Give up a claim, so the next worker tries again
+def release_seed(kind):
+    with db.engine.begin() as conn:
+        conn.execute(delete(versions).where(versions.c.kind == kind, versions.c.version == 0))
+
+
+# Fill a kind claimed with claim_seed from its phrase file as version 1
+def seed_entries(kind, phrases, embeddings, model):
+    try:
+        with db.engine.begin() as conn:
+            _lock_state(conn, kind)
+            unique = list(_unique(phrases, embeddings).values())
+            rows = _entry_rows(kind, [p for p, _ in unique], [e for _, e in unique], model, 1)
+            for i in range(0, len(rows), 1000):
+                conn.execute(insert(entries), rows[i:i + 1000])
+            _set_state(conn, kind, 1, rebuilt=True)
+    except Exception:
+        release_seed(kind)
+        raise
+    return True
+
+
+# Phrases of the list that are not in the knowledge base yet (by normalised text)
+def new_phrases(kind, phrases):
+    by_hash = {normalised_hash(p): p for p in phrases}
+    with db.engine.connect() as conn:
+        existing = _existing_hashes(conn, kind, by_hash)
+    return [p for h, p in by_hash.items() if h not in existing]
+
+
+# Append phrases with their embeddings as one new version. Phrases another
+# worker added in the meantime are skipped. Returns the number added.
+def add_entries(kind, phrases, embeddings, model):
+    with db.engine.begin() as conn:
+        version = _lock_state(conn, kind)
+        by_hash = _unique(phrases, embeddings)
+        existing = _existing_hashes(conn, kind, by_hash)
+        fresh = [value for h, value in by_hash.items() if h not in existing]
+        if fresh:
+            conn.execute(insert(entries), _entry_rows(kind, [p for p, _ in fresh], [e for _, e in fresh], model, version + 1))
+            _set_state(conn, kind, version + 1)
+    return len(fresh)
+
+
+# Replace every embedding of a kind after a full re-embed; texts must be in
+# load_entries order. Returns the new version.
+def replace_embeddings(kind, texts, embeddings, model):
+    with db.engine.begin() as conn:
+        version = _lock_state(conn, kind) + 1
+        ids = conn.execute(
+            select(entries.c.entry_id).where(entries.c.kind == kind).order_by(entries.c.version, entries.c.entry_id)
+        ).scalars().all()
+        if len(ids) != len(texts):
+            raise ValueError(f"{kind} knowledge base changed during the re-embed")
+        statement = update(entries).where(entries.c.entry_id == bindparam("b_id")).values(
+            embedding=bindparam("b_embedding"), model=bindparam("b_model")
+        )
+        for i in range(0, len(ids), 1000):
+            conn.execute(statement, [
+                {"b_id": entry_id, "b_embedding": embedding_blob(embedding), "b_model": model}
+                for entry_id, embedding in zip(ids[i:i + 1000], embeddings[i:i + 1000])
+            ])
+        _set_state(conn, kind, version, rebuilt=True)
+    return version
@@ -0,0 +1,172 @@
+# Resident vector index for the RAG knowledge bases
+# Each knowledge base (kb.txt, kbhazard.txt, ...) is held once per process as a
+# pre-normalised, contiguous float32 matrix so a top-k query is a single
+# matrix-vector product instead of re-reading files and looping in Python.
+import threading
+import numpy as np
+
+
+def normalise_rows(matrix):
+    matrix = np.asarray(matrix, dtype=np.float32)
+    if matrix.ndim == 1:
+        matrix = matrix.reshape(1, -1)
+    norms = np.linalg.norm(matrix, axis=1, keepdims=True)
+    norms[norms == 0] = 1.0
+    return np.ascontiguousarray(matrix / norms, dtype=np.float32)
+
+
+def top_k_indices(scores, top_k):
+    # argpartition keeps this O(n) for the common top_k=1 case
+    top_k = max(1, min(top_k, scores.shape[-1]))
+    if top_k == scores.shape[-1]:
+        candidates = np.arange(scores.shape[-1])
+    else:
+        candidates = np.argpartition(-scores, top_k - 1)[:top_k]
+    return candidates[np.argsort(-scores[candidates], kind="stable")]
+
+
+class KBIndex:
+    """Phrases of one knowledge base and their unit-length embeddings."""
+
+    def __init__(self, kind, phrases, embeddings, normalised=False, ann=None, nprobe=8, provider=None, lexical=None, version=None,
+                 quantized=None, rescore=64):
+        # rows that are already unit length (e.g. a memory-mapped embedding
+        # store) are used as-is so the pages stay shared between workers
+        if normalised and isinstance(embeddings, np.ndarray) and embeddings.ndim == 2:
+            matrix = embeddings
+        else:
+            matrix = normalise_rows(embeddings)
+        if matrix.shape[0] != len(phrases):
+            raise ValueError(
+                f"{kind} knowledge base has {len(phrases)} phrases but {matrix.shape[0]} embeddings"
+            )
+        self.kind = kind
+        self.phrases = list(phrases)
+        self.matrix = matrix
+        # optional approximate index (see ann_index.py); None means exact search
+        self.ann = ann
+        self.nprobe = nprobe
+        # embedding provider the rows were made with; queries must use the same one
+        self.provider = provider
+        # optional lexical first stage (see lexical_index.py)
+        self.lexical = lexical
+        # kb_version the index was built at
+        self.version = version
+        # optional int8 codes (see quantization.py) used to pick the rescore
+        # candidates of an exact search
+        self.quantized = quantized
+        self.rescore = rescore
+
+    def __len__(self):
+        return len(self.phrases)
+
+    @property
+    def dimension(self):
+        return self.matrix.shape[1]
+
+    def scores(self, query_embedding):
+        query = normalise_rows(query_embedding)[0]
+        return self.matrix @ query
+
+    def search(self, query_embedding, top_k=1):
+        if not self.phrases:
+            return []
+        if self.ann is not None:
+            query = normalise_rows(query_embedding)[0]
+            ids, scores = self.ann.search(self.matrix, query, top_k=top_k, nprobe=self.nprobe)
+            return [(self.phrases[i], float(score)) for i, score in zip(ids, scores)]
+        if self.quantized is not None:
+            return self.search_many(query_embedding, top_k=top_k)[0]
+        scores = self.scores(query_embedding)
+        return [(self.phrases[i], float(scores[i])) for i in top_k_indices(scores, top_k)]
+
+    def search_many(self, query_embeddings, top_k=1):
+        # one (queries x phrases) matrix multiply for the whole batch
+        if not self.phrases:
+            return [[] for _ in range(len(query_embeddings))]
+        if self.ann is not None:
+            return [self.search(query, top_k=top_k) for query in normalise_rows(query_embeddings)]
+        if self.quantized is not None:
+            results = self.quantized.search_many(self.matrix, normalise_rows(query_embeddings), top_k, self.rescore)
+            return [
+                [(self.phrases[i], float(score)) for i, score in zip(ids, scores)]
+                for ids, scores in results
+            ]
+        scores = normalise_rows(query_embeddings) @ self.matrix.T
+        return [
+            [(self.phrases[i], float(row[i])) for i in top_k_indices(row, top_k)]
+            for row in scores
+        ]
+
+
+class UnifiedIndex:
+    """Several exact-search knowledge bases searched as one stacked index.
+
+    The members' rows form one stacked row space in which each kind owns a
+    contiguous block (its offsets), so the offsets label every row with its
+    kind. A batch fills one stacked score matrix (queries x all rows) and takes
+    top-k per kind from each kind's block. Nothing is copied: each block is
+    scored straight from the member's own (memory-mapped) matrix, and only for
+    the queries that asked for that kind. Members must share an embedding
+    provider.
+    """
+
+    def __init__(self, members):
+        self.members = {index.kind: index for index in members}
+        self.offsets = {}
+        start = 0
+        for kind, index in self.members.items():
+            self.offsets[kind] = (start, start + len(index))
+            start += len(index)
+        self.size = start
+
+    def __len__(self):
+        return self.size
+
+    # Kind of a row of the stacked row space
+    def kind_of(self, row):
+        for kind, (start, end) in self.offsets.items():
+            if start <= row < end:
+                return kind
+        raise IndexError(row)
+
+    # rows_by_kind maps a member kind to the query rows it needs answered.
+    # Returns {kind: [matches, ...]} in the order of rows_by_kind[kind].
+    def search_many(self, query_embeddings, rows_by_kind, top_k=1):
+        query_rows = sorted({row for rows in rows_by_kind.values() for row in rows})
+        position = {row: i for i, row in enumerate(query_rows)}
+        queries = normalise_rows(np.asarray(query_embeddings)[query_rows])
+        scores = np.full((len(query_rows), self.size), -np.inf, dtype=np.float32)
+        for kind, rows in rows_by_kind.items():
+            start, end = self.offsets[kind]
+            if start < end:
+                wanted = sorted({position[row] for row in rows})
+                scores[wanted, start:end] = queries[wanted] @ self.members[kind].matrix.T
+        results = {}
+        for kind, rows in rows_by_kind.items():
+            start, end = self.offsets[kind]
+            phrases = self.members[kind].phrases
+            if start == end:
+                results[kind] = [[] for _ in rows]
+                continue
+            block = scores[:, start:end]
+            results[kind] = [
+                [(phrases[i], float(block[position[row], i])) for i in top_k_indices(block[position[row]], top_k)]
+                for row in rows
+            ]
+        return results
+
+
+_indexes = {}
+_lock = threading.Lock()
+
+
+def get_index(kind):
+    return _indexes.get(kind)
+
+
+def set_index(index):
+    # indexes are never mutated after construction, so readers can keep using
+    # the old object while it is being replaced
+    with _lock:
+        _indexes[index.kind] = index
@@ -0,0 +1,138 @@
+# Read-optimised copy of the known_data table
+# Every AI request looks up known_data right after retrieval (by activity name,
+# or by title + process). The table only changes when an admin approves a
+# hazard, so each process keeps all of it in memory, keyed the way it is looked
+# up. Rows are plain namedtuples with the same attribute names as KnownData, so
+# code written against model rows works unchanged.
+# Keys are case-folded and right-stripped to match the case-insensitive MySQL
+# collation the SQL lookups relied on.
+# The app only ever inserts rows, but rows are also corrected by hand in the
+# database, so staleness is judged on a checksum of every row, not just the
+# row count and highest id.
+import hashlib
+import os
+import threading
+import time
+from collections import namedtuple
+from sqlalchemy import func
+from models import db, KnownData
+
+KNOWN_DATA_COLUMNS = [column.name for column in KnownData.__table__.columns]
+KnownRow = namedtuple("KnownRow", KNOWN_DATA_COLUMNS)
+# seconds between checks for rows written by other processes
+KNOWN_DATA_CHECK_INTERVAL = float(os.getenv("KNOWN_DATA_CHECK_INTERVAL", "5"))
+
+
+def known_key(text):
+    return (text or "").rstrip().casefold()
+
+
+class KnownDataIndex:
+    def __init__(self, rows, fingerprint=None):
+        self.rows = rows
+        self.by_activity = {}
+        self.by_title_process = {}
+        for row in rows:
+            self._add(row)
+        self.count = len(rows)
+        self.max_id = max((row.id for row in rows), default=0)
+        # table_fingerprint() as of loading; None forces the next check to reload
+        self.fingerprint = fingerprint
+
+    def _add(self, row):
+        self.by_activity.setdefault(known_key(row.activity_name), []).append(row)
+        self.by_title_process.setdefault((known_key(row.title), known_key(row.process)), []).append(row)
+
+    def for_activity(self, activity_name):
+        return list(self.by_activity.get(known_key(activity_name), []))
+
+    def for_activities(self, activity_names):
+        return {name: self.for_activity(name) for name in activity_names}
+
+    def for_title_process(self, title, process):
+        return list(self.by_title_process.get((known_key(title), known_key(process)), []))
+
+    # Activity names containing fragment (the old ilike '%fragment%')
+    def activity_names_containing(self, fragment):
+        fragment = (fragment or "").casefold()
+        return [key for key in self.by_activity if fragment in key]
+
+
+_index = None
+_last_check = 0.0
+_lock = threading.Lock()
+
+
+def _row_tuple(row):
+    return KnownRow(*(getattr(row, column) for column in KNOWN_DATA_COLUMNS))
+
+
+def _load_rows():
+    columns = [getattr(KnownData, column) for column in KNOWN_DATA_COLUMNS]
+    return [KnownRow(*values) for values in db.session.query(*columns).order_by(KnownData.id).all()]
+
+
+def _rows_checksum(rows):
+    digest = hashlib.sha256()
+    for row in rows:
+        digest.update(repr(tuple(row)).encode("utf-8"))
+    return digest.hexdigest()
+
+
+# (row count, highest id, checksum of every column of every row). On MySQL the
+# checksum is a sum of per-row CRC32s computed by the database; elsewhere
+# (SQLite in development) the rows are read and hashed here.
+def table_fingerprint():
+    if db.engine.dialect.name == "mysql":
+        row_text = func.concat_ws(
+            "\x1f", *[func.ifnull(getattr(KnownData, column), "\\N") for column in KNOWN_DATA_COLUMNS]
+        )
+        count, max_id, checksum = db.session.query(
+            func.count(KnownData.id), func.max(KnownData.id), func.sum(func.crc32(row_text))
+        ).one()
+        return count, max_id or 0, str(checksum or 0)
+    rows = _load_rows()
+    return len(rows), max((row.id for row in rows), default=0), _rows_checksum(rows)
+
+
+def load_known_data_index():
+    global _index, _last_check
+    # fingerprint first: a row edited while the rows are read then shows up
+    # as a change on the next check instead of being missed
+    fingerprint = table_fingerprint()
+    index = KnownDataIndex(_load_rows(), fingerprint)
+    with _lock:
+        _index = index
+        _last_check = time.monotonic()
+    print(f"Loaded {index.count} known_data rows into memory")
+    return index
+
+
+def _is_stale(index):
+    return index.fingerprint is None or table_fingerprint() != index.fingerprint
+
+
+# The current index; needs an app context. Rows added or edited by other
+# processes are picked up within KNOWN_DATA_CHECK_INTERVAL seconds.
+def get_known_data_index():
+    global _last_check
+    index = _index
+    if index is None:
+        return load_known_data_index()
+    if time.monotonic() - _last_check >= KNOWN_DATA_CHECK_INTERVAL:
+        _last_check = time.monotonic()
+        if _is_stale(index):
+            return load_known_data_index()
+    return index
+
+
+# Call after committing new KnownData rows in this process
+def add_known_data(rows):
+    global _index
+    with _lock:
+        if _index is None:
+            return
+        # copy-on-write so readers never see a half-updated index; with no
+        # fingerprint the next check re-reads the table once
+        index = KnownDataIndex(_index.rows + [_row_tuple(row) for row in rows])
+        _index = index
@@ -0,0 +1,84 @@
+# Lexical retrieval over knowledge base phrases
+# A BM25 inverted index plus an exact-match table, used as a first stage in
+# front of the vector index: a query that matches a phrase exactly (after
+# normalise_text) or almost exactly needs no embedding call at all.
+import re
+import numpy as np
+from .cache_store import normalise_text
+
+TOKEN = re.compile(r"\w+")
+
+
+def tokenize(text):
+    return TOKEN.findall(normalise_text(text))
+
+
+class LexicalIndex:
+    def __init__(self, phrases, k1=1.2, b=0.75):
+        self.exact_positions = {}
+        self.phrase_positions = {}
+        self.vocabulary = {}
+        self.doc_terms = []
+        postings = {}
+        lengths = np.zeros(len(phrases), dtype=np.float32)
+        for position, phrase in enumerate(phrases):
+            self.exact_positions.setdefault(normalise_text(phrase), position)
+            self.phrase_positions.setdefault(phrase, position)
+            tokens = tokenize(phrase)
+            lengths[position] = len(tokens)
+            counts = {}
+            for token in tokens:
+                term = self.vocabulary.setdefault(token, len(self.vocabulary))
+                counts[term] = counts.get(term, 0) + 1
+            self.doc_terms.append(frozenset(counts))
+            for term, count in counts.items():
+                postings.setdefault(term, []).append((position, count))
+
+        self.count = len(phrases)
+        average_length = float(lengths.mean()) if self.count else 0.0
+        self.idf = np.zeros(len(self.vocabulary), dtype=np.float32)
+        # term id -> (doc positions, precomputed BM25 weight of the term in each doc)
+        self.postings = {}
+        for term, entries in postings.items():
+            docs = np.fromiter((doc for doc, _ in entries), dtype=np.int64, count=len(entries))
+            tf = np.fromiter((count for _, count in entries), dtype=np.float32, count=len(entries))
+            idf = np.log(1 + (self.count - len(entries) + 0.5) / (len(entries) + 0.5))
+            self.idf[term] = idf
+            norm = k1 * (1 - b + b * lengths[docs] / max(average_length, 1e-6))
+            self.postings[term] = (docs, (idf * tf * (k1 + 1) / (tf + norm)).astype(np.float32))
+
+    def exact(self, text):
+        return self.exact_positions.get(normalise_text(text))
+
+    def query_terms(self, text):
+        return frozenset(self.vocabulary[t] for t in tokenize(text) if t in self.vocabulary)
+
+    # Returns [(position, bm25 score)], best first
+    def search(self, text, top_k=10):
+        terms = self.query_terms(text)
+        if not terms or not self.count:
+            return []
+        scores = np.zeros(self.count, dtype=np.float32)
+        for term in terms:
+            docs, weights = self.postings[term]
+            scores[docs] += weights
+        hits = np.flatnonzero(scores)
+        if len(hits) > top_k:
+            hits = hits[np.argpartition(-scores[hits], top_k - 1)[:top_k]]
+        hits = hits[np.argsort(-scores[hits], kind="stable")]
+        return [(int(position), float(scores[position])) for position in hits]
+
+    # idf-weighted Dice overlap of the query's and a phrase's words, in [0, 1];
+    # 1.0 means the same words (in any order). Words the index has never seen
+    # count against the match.
+    def confidence(self, text, position):
+        tokens = set(tokenize(text))
+        if not tokens:
+            return 0.0
+        unknown = len([t for t in tokens if t not in self.vocabulary])
+        query = self.query_terms(text)
+        doc = self.doc_terms[position]
+        unseen_weight = float(self.idf.max()) if len(self.idf) else 1.0
+        overlap = float(self.idf[list(query & doc)].sum())
+        total = float(self.idf[list(query)].sum()) + unknown * unseen_weight + float(self.idf[list(doc)].sum())
+        return 2 * overlap / total if total else 0.0
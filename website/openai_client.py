@@ -0,0 +1,193 @@
+# Shared OpenAI client for the RAG layer
+# One AsyncOpenAI client (one httpx connection pool) runs on a background event
+# loop thread. Every call goes through a global semaphore, so a burst of users
+# can never have more than OPENAI_MAX_CONCURRENCY requests in flight, and every
+# call has a timeout. Flask views are synchronous, so embed/chat/chat_stream
+# below block the calling thread until the result is ready; run_all lets one
+# view overlap several independent calls.
+import asyncio
+import concurrent.futures
+import math
+import os
+import queue
+import threading
+import httpx
+from openai import AsyncOpenAI
+
+MAX_CONCURRENCY = int(os.getenv("OPENAI_MAX_CONCURRENCY", "8"))
+TIMEOUT = float(os.getenv("OPENAI_TIMEOUT", "60"))
+MAX_RETRIES = int(os.getenv("OPENAI_MAX_RETRIES", "2"))
+# extra seconds a blocked caller waits beyond what its calls can take before
+# giving up on the loop thread
+RUN_GRACE = 5.0
+
+_loop = None
+_client = None
+_semaphore = None
+_start_lock = threading.Lock()
+# calls waiting for or holding a slot (only changed on the loop thread)
+_outstanding = 0
+
+
+# A forked child (e.g. a gunicorn worker of a preloaded app) gets a copy of
+# the globals but not the loop thread, so it must start its own loop and client
+def _reset_after_fork():
+    global _loop, _client, _semaphore, _start_lock, _outstanding
+    _loop = None
+    _client = None
+    _semaphore = None
+    _start_lock = threading.Lock()
+    _outstanding = 0
+
+
+if hasattr(os, "register_at_fork"):
+    os.register_at_fork(after_in_child=_reset_after_fork)
+
+
+def _ensure_loop():
+    global _loop, _client, _semaphore
+    if _loop is not None:
+        return _loop
+    with _start_lock:
+        if _loop is None:
+            loop = asyncio.new_event_loop()
+            thread = threading.Thread(target=loop.run_forever, name="openai-client", daemon=True)
+            thread.start()
+
+            async def setup():
+                client = AsyncOpenAI(
+                    api_key=os.getenv("OPEN_AI_API_KEY"),
+                    timeout=TIMEOUT,
+                    max_retries=MAX_RETRIES,
+                    http_client=httpx.AsyncClient(
+                        limits=httpx.Limits(
+                            max_connections=MAX_CONCURRENCY,
+                            max_keepalive_connections=MAX_CONCURRENCY,
+                        ),
+                        timeout=TIMEOUT,
+                    ),
+                )
+                return client, asyncio.Semaphore(MAX_CONCURRENCY)
+
+            # the client and semaphore must be created on the loop that uses
+            # them; the loop is only published once both exist
+            try:
+                _client, _semaphore = asyncio.run_coroutine_threadsafe(setup(), loop).result()
+            except BaseException:
+                # stop the thread, so a failing setup does not leak one per call
+                loop.call_soon_threadsafe(loop.stop)
+                thread.join()
+                loop.close()
+                raise
+            _loop = loop
+    return _loop
+
+
+async def _limited(call, timeout):
+    global _outstanding
+    _outstanding += 1
+    try:
+        # the timeout covers the request itself, not the wait for a slot
+        async with _semaphore:
+            return await asyncio.wait_for(call(), timeout or TIMEOUT)
+    finally:
+        _outstanding -= 1
+
+
+# Longest a caller can legitimately block on n new calls: the calls already
+# queued and these n go through MAX_CONCURRENCY slots, each taking at most
+# timeout once it has one
+def wait_bound(n, timeout=None):
+    rounds = math.ceil((n + _outstanding) / MAX_CONCURRENCY)
+    return rounds * (timeout or TIMEOUT) + RUN_GRACE
+
+
+async def aembed(texts, model, timeout=None):
+    response = await _limited(lambda: _client.embeddings.create(input=texts, model=model), timeout)
+    return [d.embedding for d in response.data]
+
+
+async def achat(model, messages, timeout=None, **kwargs):
+    response = await _limited(
+        lambda: _client.chat.completions.create(model=model, messages=messages, **kwargs), timeout
+    )
+    return response.choices[0].message.content
+
+
+# Blocks until coro is done, for at most timeout seconds (None: no bound).
+# The calls above time themselves out, so the bound only matters if the loop
+# thread itself is stuck; see wait_bound.
+def run(coro, timeout=None):
+    future = asyncio.run_coroutine_threadsafe(coro, _ensure_loop())
+    try:
+        return future.result(timeout=timeout)
+    except concurrent.futures.TimeoutError:
+        if future.done():
+            raise  # a request timed out inside coro; not the loop's fault
+        future.cancel()
+        raise TimeoutError(f"No result from the OpenAI client loop after {timeout:g} s")
+
+
+# Run independent calls concurrently, e.g. run_all([aembed(a, m), aembed(b, m)]).
+# Results come back in order; the first failure is raised, unless
+# return_exceptions is set, in which case failures are returned in place.
+# timeout is the per-call timeout the coroutines were given, if not the default.
+def run_all(coros, return_exceptions=False, timeout=None):
+    coros = list(coros)
+    if not coros:
+        return []
+    _ensure_loop()
+
+    async def gather():
+        return await asyncio.gather(*coros, return_exceptions=return_exceptions)
+
+    return run(gather(), wait_bound(len(coros), timeout))
+
+
+def embed(texts, model, timeout=None):
+    _ensure_loop()
+    return run(aembed(texts, model, timeout), wait_bound(1, timeout))
+
+
+def chat(model, messages, timeout=None, **kwargs):
+    _ensure_loop()
+    return run(achat(model, messages, timeout, **kwargs), wait_bound(1, timeout))
+
+
+# Yields the completion text as it arrives. The timeout applies to each chunk,
+# and closing the generator early cancels the request.
+def chat_stream(model, messages, timeout=None, **kwargs):
+    loop = _ensure_loop()
+    timeout = timeout or TIMEOUT
+    chunks = queue.Queue()
+    done = object()
+
+    async def pump():
+        try:
+            async with _semaphore:
+                stream = await asyncio.wait_for(
+                    _client.chat.completions.create(model=model, messages=messages, stream=True, **kwargs),
+                    timeout,
+                )
+                async for chunk in stream:
+                    if chunk.choices and chunk.choices[0].delta.content:
+                        chunks.put(chunk.choices[0].delta.content)
+            chunks.put(done)
+        except BaseException as e:
+            chunks.put(e)
+            raise
+
+    future = asyncio.run_coroutine_threadsafe(pump(), loop)
+    try:
+        while True:
+            try:
+                item = chunks.get(timeout=timeout)
+            except queue.Empty:
+                raise TimeoutError(f"No response from OpenAI for {timeout} s")
+            if item is done:
+                return
+            if isinstance(item, BaseException):
+                raise item
+            yield item
+    finally:
+        future.cancel()
@@ -0,0 +1,79 @@
+# Speculative hazard generation after /user/get_activities
+# Opt-in twice over: only when AI_PREFETCH_ENABLED is set on the server and the
+# get_activities request asks for it are hazards for the returned activities
+# generated in the background (one ai_function_batch call) and
+# kept for a few minutes in a cache scoped per user. /user/ai_generate looks there
+# first, and if the prefetch for that activity is still running it waits for it
+# rather than starting a second GPT call.
+import json
+import os
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from .cache_store import SQLiteCache, text_key
+from .rag import ai_function_batch, base_dir
+
+# every prefetch is a speculative GPT call, so it is off unless configured
+PREFETCH_ENABLED = os.getenv("AI_PREFETCH_ENABLED", "false").strip().lower() in ("1", "true", "yes")
+PREFETCH_TTL = int(os.getenv("AI_PREFETCH_TTL", "900"))
+# longest /ai_generate will wait for a prefetch that is still running
+PREFETCH_WAIT = float(os.getenv("AI_PREFETCH_WAIT", "60"))
+
+prefetch_cache = SQLiteCache(
+    os.getenv("AI_PREFETCH_CACHE_PATH") or os.path.join(base_dir, "cache", "prefetch.sqlite3"),
+    max_entries=5000,
+    max_bytes=32 * 1024 * 1024,
+    default_ttl=PREFETCH_TTL,
+)
+
+_executor = ThreadPoolExecutor(max_workers=int(os.getenv("AI_PREFETCH_WORKERS", "2")), thread_name_prefix="ai-prefetch")
+# cache key -> event set when the prefetch for it has finished (this process only)
+_in_flight = {}
+_lock = threading.Lock()
+
+
+def prefetch_key(scope, activity):
+    return text_key(f"prefetch:{scope}", activity)
+
+
+def prefetch_hazards(app, scope, activities):
+    activities = [str(a) for a in dict.fromkeys(activities) if a and str(a).strip()]
+    with _lock:
+        pending = [a for a in activities if prefetch_key(scope, a) not in _in_flight]
+        cached = prefetch_cache.get_many([prefetch_key(scope, a) for a in pending])
+        pending = [a for a in pending if prefetch_key(scope, a) not in cached]
+        if not pending:
+            return 0
+        done = threading.Event()
+        for activity in pending:
+            _in_flight[prefetch_key(scope, activity)] = done
+    _executor.submit(_run_prefetch, app, scope, pending, done)
+    return len(pending)
+
+
+def _run_prefetch(app, scope, activities, done):
+    try:
+        with app.app_context():
+            results, errors = ai_function_batch(activities)
+        prefetch_cache.set_many({
+            prefetch_key(scope, activity): json.dumps(hazards).encode("utf-8")
+            for activity, hazards in results.items()
+        })
+        print(f"Prefetched hazards for {len(results)} activities ({len(errors)} failed)")
+    except Exception as e:
+        print(f"Hazard prefetch failed: {e}")
+    finally:
+        with _lock:
+            for activity in activities:
+                _in_flight.pop(prefetch_key(scope, activity), None)
+        done.set()
+
+
+# The prefetched hazard list for an activity, or None if there is none
+def get_prefetched(scope, activity, wait=PREFETCH_WAIT):
+    key = prefetch_key(scope, activity)
+    with _lock:
+        done = _in_flight.get(key)
+    if done is not None:
+        done.wait(wait)
+    cached = prefetch_cache.get(key)
+    return json.loads(cached) if cached is not None else None
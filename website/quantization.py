@@ -0,0 +1,135 @@
+# Compact int8 codes for knowledge base embeddings
+# Each unit-length row is optionally reduced to fewer dimensions (an
+# uncentred PCA projection, or plain Matryoshka truncation for models trained
+# for it such as text-embedding-3-*), then stored as int8 with one float32
+# scale per row. A query is scored against the codes to pick candidates, and
+# only those candidates are re-scored exactly against the float32 matrix, so
+# the full-precision pages are barely touched. Persisted as a .npz next to the
+# embedding store.
+import os
+import numpy as np
+
+# rows decoded per matrix multiply while scanning the codes
+_CHUNK = 2048
+
+
+def _encode(reduced):
+    scales = np.abs(reduced).max(axis=1) / 127.0
+    scales[scales == 0] = 1.0
+    codes = np.rint(reduced / scales[:, None]).astype(np.int8)
+    return codes, scales.astype(np.float32)
+
+
+class QuantizedMatrix:
+    def __init__(self, codes, scales, projection=None, dim=None, method="none", content_hash=None):
+        self.codes = np.ascontiguousarray(codes, dtype=np.int8)
+        self.scales = np.asarray(scales, dtype=np.float32)
+        # (d, k) projection for PCA, None for truncation or full dimension
+        self.projection = None if projection is None or not np.size(projection) else np.asarray(projection, dtype=np.float32)
+        self.dim = dim or self.codes.shape[1]
+        self.method = method
+        self.content_hash = content_hash
+
+    @property
+    def count(self):
+        return self.codes.shape[0]
+
+    @property
+    def nbytes(self):
+        return self.codes.nbytes + self.scales.nbytes + (self.projection.nbytes if self.projection is not None else 0)
+
+    def reduce(self, matrix):
+        matrix = np.asarray(matrix, dtype=np.float32)
+        if self.projection is not None:
+            reduced = matrix @ self.projection
+        elif self.dim < matrix.shape[-1]:
+            reduced = matrix[..., :self.dim]
+        else:
+            return matrix
+        norms = np.linalg.norm(reduced, axis=-1, keepdims=True)
+        norms[norms == 0] = 1.0
+        return reduced / norms
+
+    @classmethod
+    def build(cls, matrix, dim=None, method="pca", sample_size=10000, seed=0, content_hash=None):
+        count, full_dim = matrix.shape
+        projection = None
+        if dim and dim < full_dim and method == "pca":
+            rng = np.random.default_rng(seed)
+            rows = np.sort(rng.choice(count, min(count, sample_size), replace=False))
+            sample = np.asarray(matrix[rows], dtype=np.float32)
+            # top eigenvectors of the (d, d) Gram matrix; uncentred, so inner
+            # products (not distances) are what is preserved
+            _, vectors = np.linalg.eigh((sample.T @ sample).astype(np.float64))
+            projection = np.ascontiguousarray(vectors[:, ::-1][:, :dim], dtype=np.float32)
+        elif not dim or dim >= full_dim:
+            dim, method = full_dim, "none"
+        model = cls(np.empty((0, dim), dtype=np.int8), np.empty(0), projection, dim, method, content_hash)
+        return model.extend(matrix, content_hash)
+
+    # Encode rows appended to the matrix since the codes were built
+    def extend(self, matrix, content_hash=None):
+        new_codes, new_scales = [self.codes], [self.scales]
+        for start in range(self.count, matrix.shape[0], _CHUNK):
+            codes, scales = _encode(self.reduce(matrix[start:start + _CHUNK]))
+            new_codes.append(codes)
+            new_scales.append(scales)
+        self.codes = np.ascontiguousarray(np.concatenate(new_codes), dtype=np.int8)
+        self.scales = np.concatenate(new_scales).astype(np.float32)
+        self.content_hash = content_hash
+        return self
+
+    # Approximate scores of every row for (m, d) unit queries -> (m, n)
+    def approximate_scores(self, queries):
+        reduced = self.reduce(np.atleast_2d(queries)).T
+        scores = np.empty((reduced.shape[1], self.count), dtype=np.float32)
+        for start in range(0, self.count, _CHUNK):
+            block = self.codes[start:start + _CHUNK].astype(np.float32)
+            scores[:, start:start + _CHUNK] = (block @ reduced).T * self.scales[start:start + _CHUNK]
+        return scores
+
+    # Candidates from the codes, re-scored exactly against the float matrix.
+    # Returns (row ids, scores) of the best top_k, best first.
+    def search(self, matrix, query, top_k=1, rescore=64):
+        return self.search_many(matrix, np.atleast_2d(query), top_k, rescore)[0]
+
+    def search_many(self, matrix, queries, top_k=1, rescore=64):
+        queries = np.asarray(queries, dtype=np.float32)
+        approximate = self.approximate_scores(queries)
+        depth = min(max(rescore, top_k), self.count)
+        results = []
+        for query, row in zip(queries, approximate):
+            ids = np.argpartition(-row, depth - 1)[:depth] if depth < self.count else np.arange(self.count)
+            ids.sort()  # sequential reads from a memory-mapped matrix
+            scores = np.asarray(matrix[ids], dtype=np.float32) @ query
+            k = min(top_k, len(ids))
+            best = np.argpartition(-scores, k - 1)[:k]
+            best = best[np.argsort(-scores[best], kind="stable")]
+            results.append((ids[best], scores[best]))
+        return results
+
+    def save(self, path):
+        tmp_path = f"{path}.tmp"
+        with open(tmp_path, "wb") as f:
+            np.savez(
+                f,
+                codes=self.codes,
+                scales=self.scales,
+                projection=self.projection if self.projection is not None else np.empty((0, 0), dtype=np.float32),
+                dim=np.int64(self.dim),
+                method=np.array(self.method),
+                content_hash=np.array(self.content_hash or ""),
+            )
+        os.replace(tmp_path, path)
+
+    @classmethod
+    def load(cls, path):
+        with np.load(path, allow_pickle=False) as data:
+            return cls(
+                data["codes"],
+                data["scales"],
+                data["projection"],
+                int(data["dim"]),
+                str(data["method"]),
+                str(data["content_hash"]) or None,
+            )
@@ -1,9 +1,25 @@
 # RAG (Retrieval-Augmented Generation) Example
 import openai, os, re
+import hashlib
 import json
+import threading
+import time
+from contextlib import contextmanager
+from flask import has_app_context
 import numpy as np
 from models import KnownData
 from dotenv import load_dotenv
+from .kb_index import KBIndex, UnifiedIndex, get_index, set_index, normalise_rows, top_k_indices
+from .cache_store import SQLiteCache, normalise_text, text_key
+from .embedding_store import EmbeddingStoreError, content_hash, load_phrases, load_store, save_store
+from .ann_index import IVFIndex
+from .quantization import QuantizedMatrix
+from .embedding_providers import OpenAIEmbeddingProvider, HashingNgramProvider
+from . import openai_client
+from .single_flight import SingleFlight
+from .known_data_index import get_known_data_index
+from .lexical_index import LexicalIndex
+from .kb_entries import kb_state, load_entries, claim_seed, release_seed, seed_entries, new_phrases, add_entries, replace_embeddings
 
 load_dotenv()
 openai.api_key = os.getenv("OPEN_AI_API_KEY")
@@ -21,6 +37,111 @@ embedding_titleprocess_cache_path = os.path.join(base_dir, "kbtitleprocess_embed
 embedding_control_cache_path = os.path.join(base_dir, "kbcontrol_embeddings.npy")
 embedding_injury_cache_path = os.path.join(base_dir, "kbinjury_embeddings.npy")
 
+EMBEDDING_MODEL = "text-embedding-3-small"
+# float16 halves the store on disk and in the page cache, at the cost of an
+# upcast of the matrix on every query
+EMBEDDING_STORE_DTYPE = os.getenv("EMBEDDING_STORE_DTYPE", "float32")
+
+# "kind=value,kind=value" -> {kind: value}
+def parse_kind_options(value):
+    options = {}
+    for item in (value or "").split(","):
+        if "=" in item:
+            kind, option = item.split("=", 1)
+            options[kind.strip()] = option.strip()
+    return options
+
+# Per-KB search type: "exact", "ivf", or "auto" (ivf once the KB reaches
+# ANN_MIN_SIZE phrases), e.g. RAG_INDEX_TYPES="hazard=ivf,control=auto"
+KB_INDEX_TYPES = parse_kind_options(os.getenv("RAG_INDEX_TYPES"))
+ANN_MIN_SIZE = int(os.getenv("RAG_ANN_MIN_SIZE", "5000"))
+# cells scanned per query (higher = better recall, slower) and cell count (0 = ~2*sqrt(n))
+IVF_NPROBE = int(os.getenv("RAG_IVF_NPROBE", "8"))
+IVF_NLIST = int(os.getenv("RAG_IVF_NLIST", "0")) or None
+# appended rows join existing cells until the KB outgrows its training size by this factor
+IVF_RETRAIN_GROWTH = 1.25
+
+# Per-KB int8 codes for exact search: "int8" (full dimension), "int8:256"
+# (PCA to 256 dims) or "int8:trunc256" (keep the first 256 dims, for
+# Matryoshka-trained models), e.g. RAG_QUANTIZE="activity=int8:256,hazard=int8"
+KB_QUANTIZATION = parse_kind_options(os.getenv("RAG_QUANTIZE"))
+# candidates picked from the codes and re-scored in float32
+QUANTIZE_RESCORE = int(os.getenv("RAG_QUANTIZE_RESCORE", "64"))
+
+# "int8:256" -> (256, "pca"), "int8:trunc256" -> (256, "truncate"), "int8" -> (None, "none")
+def parse_quantization(option):
+    if not option or not option.startswith("int8"):
+        return None
+    _, _, dim = option.partition(":")
+    if dim.startswith("trunc"):
+        return int(dim[5:]), "truncate"
+    return (int(dim), "pca") if dim else (None, "none")
+
+# Per-KB embedding provider: "openai" (default) or "local" (hashed n-gram
+# TF-IDF + SVD, fitted on the KB, no network), e.g. RAG_EMBEDDERS="hazard=local"
+KB_EMBEDDERS = parse_kind_options(os.getenv("RAG_EMBEDDERS"))
+
+# Similarity cut-offs per KB:
+#   match    a query at least this similar reuses the matched phrase's known
+#            data instead of asking GPT (activity and titleprocess)
+#   novelty  a phrase at or below this similarity to its closest kb phrase
+#            counts as new
+# The "openai" defaults were tuned on OpenAI vectors. Hashed n-gram vectors
+# score unrelated phrases much higher (shared character n-grams), so local KBs
+# get stricter defaults. Either can be set per KB, e.g.
+# RAG_MATCH_THRESHOLDS="activity=0.55,titleprocess=0.6" RAG_NOVELTY_THRESHOLDS="hazard=0.9"
+DEFAULT_MATCH_THRESHOLDS = {
+    "openai": {"activity": 0.35, "titleprocess": 0.4},
+    "local": {"activity": 0.6, "titleprocess": 0.65},
+}
+DEFAULT_NOVELTY_THRESHOLDS = {"openai": 0.85, "local": 0.92}
+KB_MATCH_THRESHOLDS = {kind: float(v) for kind, v in parse_kind_options(os.getenv("RAG_MATCH_THRESHOLDS")).items()}
+KB_NOVELTY_THRESHOLDS = {kind: float(v) for kind, v in parse_kind_options(os.getenv("RAG_NOVELTY_THRESHOLDS")).items()}
+
+# Retrieval mode:
+#   vector    embedding search only
+#   fastpath  an exact (normalised) or high-confidence lexical match answers
+#             without an embedding call; everything else is a vector search
+#   hybrid    fastpath, then vector and BM25 rankings fused (reciprocal rank)
+RETRIEVAL_MODE = os.getenv("RAG_RETRIEVAL_MODE", "fastpath")
+# idf-weighted word overlap a lexical match needs to skip the embedding call
+LEXICAL_CONFIDENCE = float(os.getenv("RAG_LEXICAL_CONFIDENCE", "0.9"))
+FUSION_DEPTH = 20
+# how many queries each stage has answered in this process
+retrieval_stats = {"exact": 0, "lexical": 0, "vector": 0, "fusion": 0}
+_retrieval_stats_lock = threading.Lock()
+default_provider = OpenAIEmbeddingProvider(EMBEDDING_MODEL)
+
+# knowledge base kind -> (phrase file, legacy pickled embedding file)
+# The knowledge bases live in the kb_entry table (see kb_entries.py); these
+# files are only read once, to seed an empty table
+KB_SOURCES = {
+    "activity": (kb_path, embedding_cache_path),
+    "hazard": (kb_hazard_path, embedding_hazard_cache_path),
+    "titleprocess": (kb_titleprocess_path, embedding_titleprocess_cache_path),
+    "control": (kb_control_path, embedding_control_cache_path),
+    "injury": (kb_injury_path, embedding_injury_cache_path),
+}
+
+# Query embeddings are cached on disk, keyed by model + hash of the normalised
+# text, and shared by all worker processes on this host
+embedding_cache = SQLiteCache(
+    os.getenv("EMBEDDING_CACHE_PATH") or os.path.join(base_dir, "cache", "embeddings.sqlite3"),
+    max_entries=int(os.getenv("EMBEDDING_CACHE_MAX_ENTRIES", "50000")),
+    max_bytes=int(os.getenv("EMBEDDING_CACHE_MAX_MB", "256")) * 1024 * 1024,
+)
+
+# GPT completions are cached the same way, keyed by model + normalised prompt +
+# hash of the retrieved context, and expire after COMPLETION_CACHE_TTL seconds
+COMPLETION_MODEL = "gpt-4"
+completion_cache = SQLiteCache(
+    os.getenv("COMPLETION_CACHE_PATH") or os.path.join(base_dir, "cache", "completions.sqlite3"),
+    max_entries=int(os.getenv("COMPLETION_CACHE_MAX_ENTRIES", "20000")),
+    max_bytes=int(os.getenv("COMPLETION_CACHE_MAX_MB", "128")) * 1024 * 1024,
+    default_ttl=int(os.getenv("COMPLETION_CACHE_TTL", str(7 * 24 * 3600))),
+)
+COMPLETION_NAMESPACES = ("answer", "activities")
+
 # load existing data from file
 def load_knowledge_base_from_file(filepath):
     with open(filepath, "r", encoding="utf-8") as f:
@@ -35,36 +156,462 @@ def load_embeddings(filepath):
     return np.load(filepath, allow_pickle=True)
 
 # to embed user input
-def get_embedding(text, model="text-embedding-3-small"):
-    response = openai.embeddings.create(
-        input=[text],
-        model=model
-    )
-    return np.array(response.data[0].embedding)
+def get_embedding(text, model=EMBEDDING_MODEL):
+    return get_query_embeddings([text], model=model)[0]
 
 # to embed a batch of texts from the knowledge base
-def get_embeddings_batched(texts, model="text-embedding-3-small", batch_size=100):
-    embeddings = []
-    for i in range(0, len(texts), batch_size):
-        batch = texts[i:i + batch_size]
-        response = openai.embeddings.create(input=batch, model=model)
-        batch_embeddings = [np.array(d.embedding) for d in response.data]
-        embeddings.extend(batch_embeddings)
-    return embeddings
+def get_embeddings_batched(texts, model=EMBEDDING_MODEL, batch_size=100):
+    return list(OpenAIEmbeddingProvider(model, batch_size=batch_size).embed(texts))
+
+# to embed many user inputs with as few requests as possible
+def get_query_embeddings(texts, model=EMBEDDING_MODEL):
+    provider = default_provider if model == EMBEDDING_MODEL else OpenAIEmbeddingProvider(model)
+    return embed_queries(provider, texts)
+
+# Query embeddings from any provider; remote ones go through the on-disk cache
+def embed_queries(provider, texts):
+    if not provider.cacheable:
+        return provider.embed(texts)
+    keys = [text_key(provider.name, text) for text in texts]
+    cached = embedding_cache.get_many(keys)
+    missing = list(dict.fromkeys(text for text, key in zip(texts, keys) if key not in cached))
+    if missing:
+        fresh = provider.embed_queries(missing)
+        new_entries = {
+            text_key(provider.name, text): np.asarray(embedding, dtype=np.float32).tobytes()
+            for text, embedding in zip(missing, fresh)
+        }
+        embedding_cache.set_many(new_entries)
+        cached.update(new_entries)
+    return np.stack([np.frombuffer(cached[key], dtype=np.float32) for key in keys])
 
 # Compute cosine similarity between two vectors
 def cosine_similarity(vec1, vec2):
     return np.dot(vec1, vec2) / (np.linalg.norm(vec1) * np.linalg.norm(vec2))
 
-# Retrieve top-k most relevant strings 
+# Retrieve top-k most relevant strings. A KBIndex is queried with the provider
+# its rows were embedded with; plain arrays are assumed to hold OpenAI vectors.
 def retrieve_most_relevant(user_input, knowledge_base, kb_embeddings, top_k=1):
+    if isinstance(kb_embeddings, KBIndex):
+        user_embedding = embed_queries(index_provider(kb_embeddings), [user_input])[0]
+        return kb_embeddings.search(user_embedding, top_k=top_k)
     user_embedding = get_embedding(user_input)
-    similarities = [cosine_similarity(user_embedding, emb) for emb in kb_embeddings]
-    top_indices = np.argsort(similarities)[::-1][:top_k]
-    return [(knowledge_base[i], similarities[i]) for i in top_indices]
+    similarities = normalise_rows(kb_embeddings) @ normalise_rows(user_embedding)[0]
+    return [(knowledge_base[i], float(similarities[i])) for i in top_k_indices(similarities, top_k)]
+
+# <dir>/kbhazard.txt -> <dir>/kbhazard.vectors.npy + <dir>/kbhazard.manifest.json
+def kb_store_base(kind):
+    return os.path.splitext(KB_SOURCES[kind][0])[0]
+
+# Load the persisted IVF index for a KB, extending or rebuilding it if the KB
+# changed. Returns None when the KB should be searched exactly.
+def load_or_build_ann(kind, knowledge_base, matrix, manifest):
+    index_type = KB_INDEX_TYPES.get(kind, "auto")
+    if index_type == "exact" or (index_type == "auto" and len(knowledge_base) < ANN_MIN_SIZE):
+        return None
+
+    path = f"{kb_store_base(kind)}.ivf.npz"
+    ann = None
+    if os.path.exists(path):
+        try:
+            ann = IVFIndex.load(path)
+        except (OSError, ValueError, KeyError) as e:
+            print(f"Ignoring broken {kind} IVF index: {e}")
+    if ann is not None:
+        if ann.count == len(knowledge_base) and ann.content_hash == manifest["content_hash"]:
+            return ann
+        if ann.count < len(knowledge_base) <= ann.trained_count * IVF_RETRAIN_GROWTH \
+                and ann.content_hash == content_hash(knowledge_base[:ann.count]):
+            print(f"Adding {len(knowledge_base) - ann.count} rows to the {kind} IVF index...")
+            ann.extend(matrix, manifest["content_hash"])
+            ann.save(path)
+            return ann
+
+    print(f"Building {kind} IVF index...")
+    ann = IVFIndex.build(matrix, nlist=IVF_NLIST, content_hash=manifest["content_hash"])
+    ann.save(path)
+    return ann
+
+# Load the persisted int8 codes for a KB, encoding only appended rows when the
+# KB has just grown. Returns None when the KB is not quantised.
+def load_or_build_quantized(kind, knowledge_base, matrix, manifest):
+    spec = parse_quantization(KB_QUANTIZATION.get(kind))
+    if spec is None or not len(knowledge_base):
+        return None
+    dim, method = spec
+
+    path = f"{kb_store_base(kind)}.int8.npz"
+    quantized = None
+    if os.path.exists(path):
+        try:
+            quantized = QuantizedMatrix.load(path)
+        except (OSError, ValueError, KeyError) as e:
+            print(f"Ignoring broken {kind} int8 codes: {e}")
+    if quantized is not None and quantized.method == method and quantized.dim == (dim or matrix.shape[1]):
+        if quantized.count == len(knowledge_base) and quantized.content_hash == manifest["content_hash"]:
+            return quantized
+        if quantized.count < len(knowledge_base) and quantized.content_hash == content_hash(knowledge_base[:quantized.count]):
+            print(f"Encoding {len(knowledge_base) - quantized.count} new {kind} rows as int8...")
+            quantized.extend(matrix, manifest["content_hash"])
+            quantized.save(path)
+            return quantized
+
+    print(f"Encoding {kind} embeddings as int8...")
+    quantized = QuantizedMatrix.build(matrix, dim=dim, method=method, content_hash=manifest["content_hash"])
+    quantized.save(path)
+    return quantized
+
+def is_local_kb(kind):
+    return KB_EMBEDDERS.get(kind, "openai") == "local"
+
+def embedder_type(kind):
+    return "local" if is_local_kb(kind) else "openai"
+
+def match_threshold(kind):
+    if kind in KB_MATCH_THRESHOLDS:
+        return KB_MATCH_THRESHOLDS[kind]
+    return DEFAULT_MATCH_THRESHOLDS[embedder_type(kind)][kind]
+
+def novelty_threshold(kind):
+    if kind in KB_NOVELTY_THRESHOLDS:
+        return KB_NOVELTY_THRESHOLDS[kind]
+    return DEFAULT_NOVELTY_THRESHOLDS[embedder_type(kind)]
+
+# The provider the stored vectors of a KB were made with; None for a local KB
+# that has not been fitted yet
+def load_kb_provider(kind):
+    if not is_local_kb(kind):
+        return default_provider
+    path = f"{kb_store_base(kind)}.embedder.npz"
+    return HashingNgramProvider.load(path) if os.path.exists(path) else None
+
+# A fresh provider for a full rebuild; local providers are refitted on the KB
+def fit_kb_provider(kind, knowledge_base):
+    if not is_local_kb(kind):
+        return default_provider
+    print(f"Fitting local {kind} embedder...")
+    provider = HashingNgramProvider.fit(knowledge_base)
+    provider.save(f"{kb_store_base(kind)}.embedder.npz")
+    return provider
+
+def make_kb_index(kind, knowledge_base, matrix, manifest, provider):
+    ann = load_or_build_ann(kind, knowledge_base, matrix, manifest)
+    quantized = load_or_build_quantized(kind, knowledge_base, matrix, manifest) if ann is None else None
+    lexical = LexicalIndex(knowledge_base) if RETRIEVAL_MODE != "vector" else None
+    index = KBIndex(
+        kind, knowledge_base, matrix, normalised=True, ann=ann, nprobe=IVF_NPROBE, provider=provider,
+        lexical=lexical, version=manifest.get("version"), quantized=quantized, rescore=QUANTIZE_RESCORE
+    )
+    set_index(index)
+    return index
+
+# Save a snapshot of the KB at a version and serve the index from the
+# memory-mapped copy, which every worker on this host shares
+def write_kb_store(kind, knowledge_base, kb_embeddings, provider, version):
+    base = kb_store_base(kind)
+    save_store(base, knowledge_base, kb_embeddings, provider.name, dtype=EMBEDDING_STORE_DTYPE, version=version)
+    matrix, manifest = load_store(base)
+    return make_kb_index(kind, knowledge_base, matrix, manifest, provider)
+
+# This host's snapshot of a KB as (phrases, matrix, manifest), or None if there
+# is none usable with the provider
+def load_snapshot(kind, provider):
+    if provider is None:
+        return None
+    base = kb_store_base(kind)
+    try:
+        matrix, manifest = load_store(base)
+        if manifest is None or manifest["model"] != provider.name or manifest.get("version") is None:
+            return None
+        knowledge_base = load_phrases(base, manifest)
+    except (EmbeddingStoreError, OSError, ValueError, KeyError) as e:
+        print(f"Ignoring broken {kind} embedding store: {e}")
+        return None
+    if knowledge_base is None:
+        return None
+    return knowledge_base, matrix, manifest
+
+# (texts, matrix) for kb_entry rows; stored vectors from another provider
+# (e.g. another node's local embedder) are re-embedded with this one
+def entry_embeddings(rows, provider):
+    texts = [row.text for row in rows]
+    matrix = np.zeros((len(rows), 0), dtype=np.float32)
+    usable = [row.embedding is not None and row.model == provider.name for row in rows]
+    stale = [row.text for row, ok in zip(rows, usable) if not ok]
+    fresh = iter(normalise_rows(provider.embed(stale))) if stale else iter(())
+    vectors = [np.frombuffer(row.embedding, dtype=np.float32) if ok else next(fresh) for row, ok in zip(rows, usable)]
+    if vectors:
+        matrix = np.vstack(vectors)
+    return texts, matrix
+
+# Fill an empty kb_entry table for a kind from its phrase file, reusing the
+# stored or legacy embeddings where they are still valid. The seeding is
+# claimed first, so on a cold start only one worker pays for embedding the KB.
+# Returns False if another worker has it.
+def seed_kb(kind):
+    if not claim_seed(kind):
+        return False
+    try:
+        kb_file, legacy_embedding_file = KB_SOURCES[kind]
+        knowledge_base = load_knowledge_base_from_file(kb_file) if os.path.exists(kb_file) else []
+        provider = load_kb_provider(kind)
+        kb_embeddings = None
+        try:
+            matrix, manifest = load_store(kb_store_base(kind))
+            if manifest is not None and provider is not None and manifest["model"] == provider.name \
+                    and manifest["content_hash"] == content_hash(knowledge_base):
+                kb_embeddings = matrix
+        except (EmbeddingStoreError, OSError, KeyError) as e:
+            print(f"Ignoring broken {kind} embedding store: {e}")
+        if kb_embeddings is None and not is_local_kb(kind) and os.path.exists(legacy_embedding_file):
+            print(f"Migrating legacy {kind} embeddings...")
+            kb_embeddings = load_embeddings(legacy_embedding_file)
+            if len(kb_embeddings) != len(knowledge_base):
+                print(f"{kind} legacy embeddings are stale ({len(kb_embeddings)} vectors for {len(knowledge_base)} phrases)")
+                kb_embeddings = None
+        if kb_embeddings is None:
+            print(f"Generating {kind} embeddings using batch processing...")
+            provider = fit_kb_provider(kind, knowledge_base)
+            kb_embeddings = provider.embed(knowledge_base)
+    except Exception:
+        release_seed(kind)
+        raise
+
+    print(f"Seeding {kind} knowledge base from {os.path.basename(kb_file)} ({len(knowledge_base)} phrases)...")
+    return seed_entries(kind, knowledge_base, normalise_rows(kb_embeddings) if len(knowledge_base) else [], provider.name)
+
+# (version, rebuilt_version) of a KB, seeding it first if the table is empty
+def seeded_kb_state(kind, timeout=300):
+    state = kb_state(kind)
+    if state is None and seed_kb(kind):
+        state = kb_state(kind)
+    deadline = time.monotonic() + timeout
+    # version 0 means another worker is still seeding
+    while state is None or state[0] == 0:
+        if time.monotonic() > deadline:
+            raise TimeoutError(f"Timed out waiting for the {kind} knowledge base to be seeded")
+        time.sleep(1)
+        state = kb_state(kind)
+    return state
+
+# Build the resident index for one knowledge base at its current version:
+# straight from this host's snapshot if it is current, else the snapshot plus
+# the entries added since it was taken, else every entry in kb_entry
+def build_kb_index(kind):
+    version, rebuilt_version = seeded_kb_state(kind)
+    snapshot = load_snapshot(kind, load_kb_provider(kind))
+    if snapshot is None or snapshot[2]["version"] != version:
+        with kb_write_lock(kind):
+            # another worker on this host may have just written it
+            provider = load_kb_provider(kind)
+            snapshot = load_snapshot(kind, provider)
+            if snapshot is None or snapshot[2]["version"] != version:
+                snapshot_version = snapshot[2]["version"] if snapshot is not None else None
+                if snapshot is not None and rebuilt_version <= snapshot_version < version:
+                    rows = load_entries(kind, after_version=snapshot_version, up_to_version=version)
+                    print(f"Adding {len(rows)} new {kind} entries (version {snapshot_version} -> {version})...")
+                    texts, matrix = entry_embeddings(rows, provider)
+                    knowledge_base = snapshot[0] + texts
+                    kb_embeddings = np.vstack([np.asarray(snapshot[1], dtype=np.float32), matrix])
+                else:
+                    rows = load_entries(kind, up_to_version=version)
+                    print(f"Loading {len(rows)} {kind} entries from the database...")
+                    if provider is None:
+                        provider = fit_kb_provider(kind, [row.text for row in rows])
+                    knowledge_base, kb_embeddings = entry_embeddings(rows, provider)
+                return write_kb_store(kind, knowledge_base, kb_embeddings, provider, version)
+
+    print(f"Loading {kind} embeddings (memory-mapped)...")
+    knowledge_base, matrix, manifest = snapshot
+    return make_kb_index(kind, knowledge_base, matrix, manifest, load_kb_provider(kind))
+
+# seconds between checks for entries added by other workers
+KB_VERSION_CHECK_INTERVAL = float(os.getenv("KB_VERSION_CHECK_INTERVAL", "5"))
+_kb_checked = {}
+
+def get_kb_index(kind):
+    index = get_index(kind)
+    if index is None:
+        return build_kb_index(kind)
+    if has_app_context() and time.monotonic() - _kb_checked.get(kind, 0) >= KB_VERSION_CHECK_INTERVAL:
+        _kb_checked[kind] = time.monotonic()
+        state = kb_state(kind)
+        if state is not None and state[0] != index.version:
+            return build_kb_index(kind)
+    return index
+
+# called once from create_app (inside an app context) so the first requests
+# do not have to build the indexes
+def init_kb_indexes():
+    for kind in KB_SOURCES:
+        try:
+            index = build_kb_index(kind)
+            print(f"Loaded {kind} index: {len(index)} phrases (version {index.version})")
+        except Exception as e:
+            # leave it to be built lazily on first use
+            print(f"Error loading {kind} index: {e}")
+
+def index_provider(index):
+    return index.provider or default_provider
+
+def count_stage(stage, n=1):
+    with _retrieval_stats_lock:
+        retrieval_stats[stage] += n
+
+# First stage: an exact phrase match (similarity 1.0) or a lexical match of at
+# least LEXICAL_CONFIDENCE (reported as the similarity). Returns (matches,
+# stage) or (None, None) when the vector index has to answer.
+def lexical_match(index, user_input, top_k=1):
+    # the lexical scores only stand in for cosine similarity on the best match
+    if index.lexical is None or top_k != 1:
+        return None, None
+    position = index.lexical.exact(user_input)
+    if position is not None:
+        return [(index.phrases[position], 1.0)], "exact"
+    hits = index.lexical.search(user_input, top_k=1)
+    if hits:
+        confidence = index.lexical.confidence(user_input, hits[0][0])
+        if confidence >= LEXICAL_CONFIDENCE:
+            return [(index.phrases[hits[0][0]], confidence)], "lexical"
+    return None, None
+
+# Reciprocal rank fusion of the vector and BM25 rankings; scores stay cosine
+# similarities so the callers' thresholds still apply
+def fuse_rankings(index, user_input, query_embedding, vector_matches, top_k=1):
+    position_of = index.lexical.phrase_positions
+    cosine = {position_of[phrase]: score for phrase, score in vector_matches}
+    fused = {}
+    for rank, position in enumerate(cosine):
+        fused[position] = fused.get(position, 0.0) + 1.0 / (60 + rank)
+    for rank, (position, _) in enumerate(index.lexical.search(user_input, top_k=FUSION_DEPTH)):
+        fused[position] = fused.get(position, 0.0) + 1.0 / (60 + rank)
+    best = sorted(fused, key=lambda position: -fused[position])[:top_k]
+    query = normalise_rows(query_embedding)[0]
+    return [
+        (index.phrases[p], cosine[p] if p in cosine else float(np.asarray(index.matrix[p], dtype=np.float32) @ query))
+        for p in best
+    ]
+
+# Vector stage for an already embedded query (fused in hybrid mode)
+def vector_match(index, user_input, query_embedding, top_k=1):
+    if RETRIEVAL_MODE == "hybrid" and index.lexical is not None:
+        matches = index.search(query_embedding, top_k=max(top_k, FUSION_DEPTH))
+        return fuse_rankings(index, user_input, query_embedding, matches, top_k), "fusion"
+    return index.search(query_embedding, top_k=top_k), "vector"
+
+# Returns (top matches, stage that answered: exact, lexical, vector or fusion)
+def search_kb_staged(kind, user_input, top_k=1):
+    index = get_kb_index(kind)
+    matches, stage = lexical_match(index, user_input, top_k)
+    if matches is None:
+        query_embedding = embed_queries(index_provider(index), [user_input])[0]
+        matches, stage = vector_match(index, user_input, query_embedding, top_k)
+    count_stage(stage)
+    return matches, stage
+
+def search_kb(kind, user_input, top_k=1):
+    return search_kb_staged(kind, user_input, top_k)[0]
+
+# Kbs searched with a plain exact scan (no ANN, no int8 codes and no fusion)
+# can be searched together through a UnifiedIndex
+def is_stackable(index):
+    return (
+        index.ann is None and index.quantized is None
+        and not (RETRIEVAL_MODE == "hybrid" and index.lexical is not None)
+    )
+
+# Batch retrieval: queries_by_kind maps a kb kind to a list of query strings.
+# Queries the lexical stage can answer are resolved first; every other distinct
+# string is embedded once per provider (kbs sharing a provider share one
+# request). A string asked of several exact-search kbs is scored against all
+# of them in one pass over a UnifiedIndex; the rest are scored by their own kb.
+# Either way only a kb's own memory-mapped rows are read, and only for the
+# queries that asked for it. Returns {kind: [top_matches, ...]} in the same
+# order; blank queries get an empty match list.
+def search_kb_batch(queries_by_kind, top_k=1):
+    results = {kind: [[] for _ in texts] for kind, texts in queries_by_kind.items()}
+    indexes = {kind: get_kb_index(kind) for kind in queries_by_kind}
+
+    pending = {}
+    for kind, texts in queries_by_kind.items():
+        pending[kind] = []
+        for i, text in enumerate(texts):
+            if not text or not text.strip():
+                continue
+            matches, stage = lexical_match(indexes[kind], text, top_k)
+            if matches is None:
+                pending[kind].append(i)
+            else:
+                results[kind][i] = matches
+                count_stage(stage)
+
+    # kbs sharing an embedding provider share one embedding request
+    kinds_by_provider = {}
+    for kind, index in indexes.items():
+        provider = index_provider(index)
+        kinds_by_provider.setdefault(provider.name, (provider, []))[1].append(kind)
+
+    for provider, kinds in kinds_by_provider.values():
+        unique_texts = list(dict.fromkeys(
+            queries_by_kind[kind][i].strip() for kind in kinds for i in pending[kind]
+        ))
+        if not unique_texts:
+            continue
+        embeddings = embed_queries(provider, unique_texts)
+        row_of = {text: i for i, text in enumerate(unique_texts)}
+        rows_by_kind = {
+            kind: [row_of[queries_by_kind[kind][i].strip()] for i in pending[kind]]
+            for kind in kinds if pending[kind]
+        }
+
+        # strings wanted by more than one exact-search kb go through the
+        # stacked index; each kb keeps its other strings to itself
+        stackable = [
+            kind for kind in rows_by_kind
+            if is_stackable(indexes[kind]) and indexes[kind].dimension == embeddings.shape[1]
+        ]
+        kinds_of_row = {}
+        for kind in stackable:
+            for row in set(rows_by_kind[kind]):
+                kinds_of_row.setdefault(row, []).append(kind)
+        shared = {row for row, row_kinds in kinds_of_row.items() if len(row_kinds) > 1}
+        if shared:
+            stacked_kinds = sorted({kind for row in shared for kind in kinds_of_row[row]})
+            stacked = {
+                kind: [(position, row) for position, row in zip(pending[kind], rows_by_kind[kind]) if row in shared]
+                for kind in stacked_kinds
+            }
+            unified = UnifiedIndex([indexes[kind] for kind in stacked_kinds])
+            matches = unified.search_many(
+                embeddings, {kind: [row for _, row in pairs] for kind, pairs in stacked.items()}, top_k=top_k
+            )
+            for kind, pairs in stacked.items():
+                for (position, _), match in zip(pairs, matches[kind]):
+                    results[kind][position] = match
+                count_stage("vector", len(pairs))
+
+        for kind, rows in rows_by_kind.items():
+            texts = queries_by_kind[kind]
+            positions = pending[kind]
+            if kind in stackable and shared:
+                kept = [(position, row) for position, row in zip(positions, rows) if row not in shared]
+                if not kept:
+                    continue
+                positions, rows = [position for position, _ in kept], [row for _, row in kept]
+            index = indexes[kind]
+            if RETRIEVAL_MODE == "hybrid" and index.lexical is not None:
+                for position, row in zip(positions, rows):
+                    results[kind][position] = vector_match(index, texts[position], embeddings[row], top_k)[0]
+                count_stage("fusion", len(positions))
+            else:
+                matches = index.search_many(embeddings[rows], top_k=top_k)
+                for position, match in zip(positions, matches):
+                    results[kind][position] = match
+                count_stage("vector", len(positions))
+    return results
 
 # Generate answer using GPT with Prompt engineering and RAG
-def generate_answer(user_input, context):
+def build_answer_messages(user_input, context):
     user_prompt = (
         f"""
             You are a workplace safety risk assessor.
@@ -103,223 +650,345 @@ def generate_answer(user_input, context):
             """
     )
 
-    response = openai.chat.completions.create(
-        model="gpt-4",
-        messages=[
-            {"role": "system", "content": "You are a workplace safety and health risk assessor that only knows 5 types of hazards: Physical, Chemical, Biological, Mechanical and Electrical."},
-            {"role": "user", "content": user_prompt}
-        ]
+    return [
+        {"role": "system", "content": "You are a workplace safety and health risk assessor that only knows 5 types of hazards: Physical, Chemical, Biological, Mechanical and Electrical."},
+        {"role": "user", "content": user_prompt}
+    ]
+
+# Cache key for one completion: namespace, model, the normalised prompt and a
+# hash of the retrieved context it was built from
+def completion_key(namespace, model, messages, context=None):
+    digest = hashlib.sha256(model.encode("utf-8"))
+    for message in messages:
+        digest.update(b"\0" + message["role"].encode("utf-8") + b"\0")
+        digest.update(normalise_text(message["content"]).encode("utf-8"))
+    context_hash = hashlib.sha256(json.dumps(context, sort_keys=True, default=str).encode("utf-8")).hexdigest()
+    digest.update(b"\0" + context_hash.encode("utf-8"))
+    return f"{namespace}:{digest.hexdigest()}"
+
+def get_cached_completion(key):
+    cached = completion_cache.get(key)
+    return cached.decode("utf-8") if cached is not None else None
+
+def set_cached_completion(key, content):
+    if content:
+        completion_cache.set(key, content.encode("utf-8"))
+
+# Answers that parse to no hazard at all (a refusal, a truncated or oddly
+# formatted reply) are not cached, so the next request asks GPT again
+def set_cached_answer(key, content):
+    if content and parse_multiple_risk_assessments(content):
+        set_cached_completion(key, content)
+
+# Drop cached completions, either one namespace (answer/activities) or all
+def invalidate_completion_cache(namespace=None):
+    if namespace:
+        return completion_cache.delete_prefix(f"{namespace}:")
+    before = completion_cache.stats()["entries"] or 0
+    completion_cache.clear()
+    return before
+
+def generate_answer(user_input, context):
+    messages = build_answer_messages(user_input, context)
+    key = completion_key("answer", COMPLETION_MODEL, messages, context)
+    content = get_cached_completion(key)
+    if content is not None:
+        return content
+
+    content = openai_client.chat(COMPLETION_MODEL, messages)
+    set_cached_answer(key, content)
+    return content
+
+# generate_answer for many (user_input, context) pairs: cache misses are sent
+# to GPT concurrently. A failed completion is returned as its exception.
+def generate_answers(items):
+    keyed = []
+    for user_input, context in items:
+        messages = build_answer_messages(user_input, context)
+        keyed.append((completion_key("answer", COMPLETION_MODEL, messages, context), messages))
+
+    contents = [get_cached_completion(key) for key, _ in keyed]
+    missing = list({key: messages for (key, messages), content in zip(keyed, contents) if content is None}.items())
+    fresh = openai_client.run_all(
+        (openai_client.achat(COMPLETION_MODEL, messages) for _, messages in missing),
+        return_exceptions=True,
     )
+    fresh_by_key = {}
+    for (key, _), content in zip(missing, fresh):
+        if not isinstance(content, Exception):
+            set_cached_answer(key, content)
+        fresh_by_key[key] = content
+    return [content if content is not None else fresh_by_key[key] for (key, _), content in zip(keyed, contents)]
+
+# Same as generate_answer but yields the completion text as it arrives
+def generate_answer_stream(user_input, context):
+    messages = build_answer_messages(user_input, context)
+    key = completion_key("answer", COMPLETION_MODEL, messages, context)
+    content = get_cached_completion(key)
+    if content is not None:
+        yield content
+        return
 
-    return response.choices[0].message.content
+    parts = []
+    for text in openai_client.chat_stream(COMPLETION_MODEL, messages):
+        parts.append(text)
+        yield text
+    # only a stream that ran to the end is cached
+    set_cached_answer(key, "".join(parts))
+
+HAZARD_BLOCK_START = re.compile(r"\bHazard Type:\s*")
 
 def parse_multiple_risk_assessments(response_text):
     # Split based on repeated "Hazard Type:"
-    blocks = re.split(r"\bHazard Type:\s*", response_text)[1:]  # skip empty first split
-
-    parsed = []
-    for block in blocks:
-        hazard_type = block.splitlines()[0].strip()
-
-        hazard_description = re.search(r"Hazard Description:\s*(.*)", block)
-        injuries = re.search(r"Possible Injuries:\s*(.*)", block)
-        risk_control_type = re.search(r"Risk Control Type:\s*(.*)", block)
-        risk_control = re.search(r"Risk Controls:\s*(.*)", block)
-        severity = re.search(r"Severity Score:\s*(\d+)", block)
-        likelihood = re.search(r"Likelihood Score:\s*(\d+)", block)
-        rpn = re.search(r"RPN:\s*(\d+)", block)
-
-        parsed.append({
-            "type": [t.strip() for t in hazard_type.split(",")],
-            "description": hazard_description.group(1).strip() if hazard_description else None,
-            "injuries": [injuries.group(1).strip()] if injuries else [],
-            "risk_type": risk_control_type.group(1).strip() if risk_control_type else None,
-            "existingControls": risk_control.group(1).strip() if risk_control else None,
-            "severity": int(severity.group(1)) if severity else None,
-            "likelihood": int(likelihood.group(1)) if likelihood else None,
-            "rpn": int(rpn.group(1)) if rpn else None,
-            "from": "AI" # for the summary purpose
-        })
-
-    return parsed
+    blocks = HAZARD_BLOCK_START.split(response_text)[1:]  # skip empty first split
+    return [parse_risk_assessment_block(block) for block in blocks]
 
-# Main but to change during integration
-# if __name__ == "__main__":
-def ai_function(activity):
-    # Load KB
-    knowledge_base = load_knowledge_base_from_file(kb_path)
-    # Precompute or load cached embeddings
-    if os.path.exists(embedding_cache_path):
-        print("Loading cached embeddings...")
-        kb_embeddings = load_embeddings(embedding_cache_path)
-    else:
-        print("Generating and caching embeddings using batch processing...")
-        kb_embeddings = get_embeddings_batched(knowledge_base)
-        save_embeddings(embedding_cache_path, kb_embeddings)
+# Incremental version of parse_multiple_risk_assessments: takes the completion
+# as text chunks and yields each hazard as soon as the next "Hazard Type:" (or
+# the end of the stream) shows that its block is complete
+def stream_risk_assessments(chunks):
+    buffer = ""
+    for chunk in chunks:
+        buffer += chunk
+        starts = list(HAZARD_BLOCK_START.finditer(buffer))
+        for current, following in zip(starts, starts[1:]):
+            yield parse_risk_assessment_block(buffer[current.end():following.start()])
+        if len(starts) > 1:
+            buffer = buffer[starts[-1].start():]
+    for block in HAZARD_BLOCK_START.split(buffer)[1:]:
+        yield parse_risk_assessment_block(block)
 
-    # Retrieve most relevant
-    top_matches = retrieve_most_relevant(activity, knowledge_base, kb_embeddings, top_k=1)
-    context_text, similarity = top_matches[0]
-    print(f"Context text: {context_text}, Similarity: {similarity}")
-    if similarity >= 0.35:
-        # Query all matching rows by activity_name
-        hazard_rows = KnownData.query.filter_by(activity_name=context_text).all()
+def parse_risk_assessment_block(block):
+    hazard_type = block.splitlines()[0].strip() if block.strip() else ""
+
+    hazard_description = re.search(r"Hazard Description:\s*(.*)", block)
+    injuries = re.search(r"Possible Injuries:\s*(.*)", block)
+    risk_control_type = re.search(r"Risk Control Type:\s*(.*)", block)
+    risk_control = re.search(r"Risk Controls:\s*(.*)", block)
+    severity = re.search(r"Severity Score:\s*(\d+)", block)
+    likelihood = re.search(r"Likelihood Score:\s*(\d+)", block)
+    rpn = re.search(r"RPN:\s*(\d+)", block)
+
+    return {
+        "type": [t.strip() for t in hazard_type.split(",")],
+        "description": hazard_description.group(1).strip() if hazard_description else None,
+        "injuries": [injuries.group(1).strip()] if injuries else [],
+        "risk_type": risk_control_type.group(1).strip() if risk_control_type else None,
+        "existingControls": risk_control.group(1).strip() if risk_control else None,
+        "severity": int(severity.group(1)) if severity else None,
+        "likelihood": int(likelihood.group(1)) if likelihood else None,
+        "rpn": int(rpn.group(1)) if rpn else None,
+        "from": "AI" # for the summary purpose
+    }
+
+def database_hazard_data(hazard_rows):
+    # If rows found, convert each row to a dict and store in a list
+    return [
+        {
+        "description": row.hazard_des,
+        "type": [t.strip() for t in row.hazard_type.split(",")] if row.hazard_type else [],
+        "injuries": [row.injury] if row.injury else [],
+        "risk_type": row.risk_type,
+        "existingControls": row.control,
+        "severity": row.severity,
+        "likelihood": row.likelihood,
+        "rpn": row.rpn,
+        "from": "Database" # for the summary purpose
+        }
+        for row in hazard_rows
+    ]
 
-        # If rows found, convert each row to a dict and store in a list
-        hazard_data = [
-            {
+# the similar past hazards handed to GPT as context
+def context_hazard_data(hazard_rows):
+    return [
+        {
             "description": row.hazard_des,
-            "type": [t.strip() for t in row.hazard_type.split(",")] if row.hazard_type else [],
+            "type": [row.hazard_type] if row.hazard_type else [],
             "injuries": [row.injury] if row.injury else [],
             "risk_type": row.risk_type,
             "existingControls": row.control,
             "severity": row.severity,
             "likelihood": row.likelihood,
-            "rpn": row.rpn,
-            "from": "Database" # for the summary purpose
-            }
-            for row in hazard_rows
-        ]
-        result = hazard_data
+            "rpn": row.rpn
+        }
+        for row in hazard_rows
+    ]
+
+# Concurrent identical generations (several people clicking "generate" on the
+# same activity) share one in-flight computation
+ai_flights = SingleFlight()
+
+def ai_function(activity):
+    return ai_flights.do(text_key("ai_function", activity), lambda: _ai_function(activity))
+
+# Main but to change during integration
+# if __name__ == "__main__":
+def _ai_function(activity):
+    # Retrieve most relevant
+    top_matches, stage = search_kb_staged("activity", activity, top_k=1)
+    context_text, similarity = top_matches[0]
+    print(f"Context text: {context_text}, Similarity: {similarity}, Stage: {stage}")
+    # All known_data rows for that activity_name
+    hazard_rows = get_known_data_index().for_activity(context_text)
+    if similarity >= match_threshold("activity"):
+        result = database_hazard_data(hazard_rows)
     else:
         # Generate response
-        hazard_rows = KnownData.query.filter_by(activity_name=context_text).all()
-
-        # If rows found, convert each row to a dict and store in a list
-        hazard_data = [
-            {
-                "description": row.hazard_des,
-                "type": [row.hazard_type] if row.hazard_type else [],
-                "injuries": [row.injury] if row.injury else [],
-                "risk_type": row.risk_type,
-                "existingControls": row.control,
-                "severity": row.severity,
-                "likelihood": row.likelihood,
-                "rpn": row.rpn
-            }
-            for row in hazard_rows
-        ]
-        response = generate_answer(activity, hazard_data)
+        response = generate_answer(activity, context_hazard_data(hazard_rows))
         print("Response from AI:", response)
         result = parse_multiple_risk_assessments(response)
 
     return result
 
-def reembed_kb():
-    # Load KB
-    knowledge_base = load_knowledge_base_from_file(kb_path)
+# Streaming version of ai_function: yields each hazard dict as soon as it is
+# known (all at once for a database match, block by block while GPT writes)
+def ai_function_stream(activity):
+    top_matches = search_kb("activity", activity, top_k=1)
+    context_text, similarity = top_matches[0]
+    print(f"Context text: {context_text}, Similarity: {similarity}")
+    hazard_rows = get_known_data_index().for_activity(context_text)
+    if similarity >= match_threshold("activity"):
+        yield from database_hazard_data(hazard_rows)
+    else:
+        yield from stream_risk_assessments(generate_answer_stream(activity, context_hazard_data(hazard_rows)))
 
-    print("Reembedding knowledge base...")
-    kb_embeddings = get_embeddings_batched(knowledge_base)
-    save_embeddings(embedding_cache_path, kb_embeddings)
+# ai_function for every activity of a process at once: one embedding request
+# for all of them, then the activities without a database match are generated
+# concurrently.
+# Returns ({activity: hazard list}, {activity: error message})
+def ai_function_batch(activities):
+    activities = list(dict.fromkeys(a for a in activities if a and str(a).strip()))
+    if not activities:
+        return {}, {}
+    matches = search_kb_batch({"activity": activities}, top_k=1)["activity"]
+    contexts = [match[0][0] if match else None for match in matches]
 
-    return True
+    rows_by_activity = get_known_data_index().for_activities(c for c in contexts if c)
 
-def reembed_kbhazard():
-    # Load KB
-    knowledge_base = load_knowledge_base_from_file(kb_hazard_path)
+    threshold = match_threshold("activity")
+    results, errors, to_generate = {}, {}, []
+    for activity, match, context_text in zip(activities, matches, contexts):
+        if not match:
+            errors[activity] = "No match in knowledge base"
+            continue
+        similarity = match[0][1]
+        print(f"Context text: {context_text}, Similarity: {similarity}")
+        hazard_rows = rows_by_activity.get(context_text, [])
+        if similarity >= threshold:
+            results[activity] = database_hazard_data(hazard_rows)
+        else:
+            to_generate.append((activity, context_hazard_data(hazard_rows)))
 
-    print("Reembedding knowledge base...")
-    kb_embeddings = get_embeddings_batched(knowledge_base)
-    save_embeddings(embedding_hazard_cache_path, kb_embeddings)
+    responses = generate_answers(to_generate)
+    for (activity, _), response in zip(to_generate, responses):
+        if isinstance(response, Exception):
+            print(f"Error generating hazards for {activity!r}: {response}")
+            errors[activity] = str(response)
+        else:
+            results[activity] = parse_multiple_risk_assessments(response)
+    return results, errors
 
-    return True
+_kb_write_lock = threading.Lock()
 
-def reembed_kbtitleprocess():
-    # Load KB
-    knowledge_base = load_knowledge_base_from_file(kb_titleprocess_path)
+# Serialises writes of this host's KB snapshot files between threads and,
+# where flock exists, between worker processes too
+@contextmanager
+def kb_write_lock(kind):
+    kb_file, _ = KB_SOURCES[kind]
+    with _kb_write_lock:
+        try:
+            import fcntl
+        except ImportError:  # Windows dev machines
+            yield
+            return
+        with open(f"{kb_file}.lock", "w") as lock_file:
+            fcntl.flock(lock_file, fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                fcntl.flock(lock_file, fcntl.LOCK_UN)
 
-    print("Reembedding knowledge base...")
-    kb_embeddings = get_embeddings_batched(knowledge_base)
-    save_embeddings(embedding_titleprocess_cache_path, kb_embeddings)
+# Full rebuild: re-embeds every phrase of the knowledge base
+def reembed_knowledge_base(kind):
+    seeded_kb_state(kind)
+    with kb_write_lock(kind):
+        knowledge_base = [row.text for row in load_entries(kind, with_embeddings=False)]
 
-    return True
+        print("Reembedding knowledge base...")
+        provider = fit_kb_provider(kind, knowledge_base)
+        kb_embeddings = normalise_rows(provider.embed(knowledge_base)) if knowledge_base else np.zeros((0, 0))
+        version = replace_embeddings(kind, knowledge_base, kb_embeddings, provider.name)
+        write_kb_store(kind, knowledge_base, kb_embeddings, provider, version)
 
-def reembed_kbcontrol():
-    # Load KB
-    knowledge_base = load_knowledge_base_from_file(kb_control_path)
+    return True
 
-    print("Reembedding knowledge base...")
-    kb_embeddings = get_embeddings_batched(knowledge_base)
-    save_embeddings(embedding_control_cache_path, kb_embeddings)
+# Incremental update: embeds only the new phrases and adds them to kb_entry as
+# one new version; phrases already in the knowledge base (by normalised text)
+# are skipped. Other workers pick the new entries up on their next version
+# check. Returns the number of phrases added.
+def append_to_knowledge_base(kind, phrases):
+    phrases = [p.strip() for p in phrases if p and p.strip()]
+    index = get_kb_index(kind)
+    phrases = new_phrases(kind, phrases)
+    if not phrases:
+        return 0
 
-    return True
+    # local embedders keep their fitted state so existing rows stay valid
+    provider = index_provider(index)
+    print(f"Embedding {len(phrases)} new {kind} phrase(s)...")
+    added = add_entries(kind, phrases, normalise_rows(provider.embed(phrases)), provider.name)
+    build_kb_index(kind)
+    return added
 
-def reembed_kbinjury():
-    # Load KB
-    knowledge_base = load_knowledge_base_from_file(kb_injury_path)
+def reembed_kb():
+    return reembed_knowledge_base("activity")
 
-    print("Reembedding knowledge base...")
-    kb_embeddings = get_embeddings_batched(knowledge_base)
-    save_embeddings(embedding_injury_cache_path, kb_embeddings)
+def reembed_kbhazard():
+    return reembed_knowledge_base("hazard")
 
-    return True
+def reembed_kbtitleprocess():
+    return reembed_knowledge_base("titleprocess")
 
+def reembed_kbcontrol():
+    return reembed_knowledge_base("control")
 
+def reembed_kbinjury():
+    return reembed_knowledge_base("injury")
 
+# the returned index can be passed as kb_embeddings to retrieve_most_relevant
 def load_hazard_kb_and_embeddings():
-    # Load KB
-    knowledge_base = load_knowledge_base_from_file(kb_hazard_path)
-    # Precompute or load cached embeddings
-    if os.path.exists(embedding_hazard_cache_path):
-        print("Loading cached embeddings...")
-        kb_embeddings = load_embeddings(embedding_hazard_cache_path)
-    else:
-        print("Generating and caching embeddings using batch processing...")
-        kb_embeddings = get_embeddings_batched(knowledge_base)
-        save_embeddings(embedding_hazard_cache_path, kb_embeddings)
-
-    return knowledge_base, kb_embeddings
+    index = get_kb_index("hazard")
+    return index.phrases, index
 
 def load_control_kb_and_embeddings():
-    # Load KB
-    knowledge_base = load_knowledge_base_from_file(kb_control_path)
-    # Precompute or load cached embeddings
-    if os.path.exists(embedding_control_cache_path):
-        print("Loading cached embeddings...")
-        kb_embeddings = load_embeddings(embedding_control_cache_path)
-    else:
-        print("Generating and caching embeddings using batch processing...")
-        kb_embeddings = get_embeddings_batched(knowledge_base)
-        save_embeddings(embedding_control_cache_path, kb_embeddings)
-
-    return knowledge_base, kb_embeddings
+    index = get_kb_index("control")
+    return index.phrases, index
 
 def load_activity_kb_and_embeddings():
-    # Load KB
-    knowledge_base = load_knowledge_base_from_file(kb_path)
-    # Precompute or load cached embeddings
-    if os.path.exists(embedding_cache_path):
-        print("Loading cached embeddings...")
-        kb_embeddings = load_embeddings(embedding_cache_path)
-    else:
-        print("Generating and caching embeddings using batch processing...")
-        kb_embeddings = get_embeddings_batched(knowledge_base)
-        save_embeddings(embedding_cache_path, kb_embeddings)
-
-    return knowledge_base, kb_embeddings
+    index = get_kb_index("activity")
+    return index.phrases, index
 
 def load_injury_kb_and_embeddings():
-    # Load KB
-    knowledge_base = load_knowledge_base_from_file(kb_injury_path)
-    # Precompute or load cached embeddings
-    if os.path.exists(embedding_injury_cache_path):
-        print("Loading cached embeddings...")
-        kb_embeddings = load_embeddings(embedding_injury_cache_path)
-    else:
-        print("Generating and caching embeddings using batch processing...")
-        kb_embeddings = get_embeddings_batched(knowledge_base)
-        save_embeddings(embedding_injury_cache_path, kb_embeddings)
-
-    return knowledge_base, kb_embeddings
+    index = get_kb_index("injury")
+    return index.phrases, index
 
 # db page gold mine
 def get_hazard_match(activity, knowledge_base, kb_embeddings):
     top_matches = retrieve_most_relevant(activity, knowledge_base, kb_embeddings, top_k=1)
     context_text, similarity = top_matches[0]
     print (f"activity: {activity}, similarity: {similarity}")
-    # return similarity <= 0.35
-    return similarity <= 0.85
+    if isinstance(kb_embeddings, KBIndex):
+        return similarity <= novelty_threshold(kb_embeddings.kind)
+    return similarity <= DEFAULT_NOVELTY_THRESHOLDS["openai"]
+
+# Batch version of get_hazard_match: {kind: [texts]} -> {kind: [is_new, ...]}
+# Blank texts are reported as not new.
+def get_hazard_matches(queries_by_kind):
+    results = search_kb_batch(queries_by_kind, top_k=1)
+    return {
+        kind: [bool(matches) and matches[0][1] <= novelty_threshold(kind) for matches in kind_matches]
+        for kind, kind_matches in results.items()
+    }
 
 def generate_ai_work_activities(title, processName, db_result):
     user_prompt = (
@@ -331,52 +1000,45 @@ def generate_ai_work_activities(title, processName, db_result):
             """
     )
 
-    response = openai.chat.completions.create(
-        model="gpt-4",
-        messages=[
-            {"role": "system", "content": "You are a work place safety hazard expert."},
-            {"role": "user", "content": user_prompt}
-        ]
-    )
-    content = response.choices[0].message.content
+    messages = [
+        {"role": "system", "content": "You are a work place safety hazard expert."},
+        {"role": "user", "content": user_prompt}
+    ]
+    # the prompt only uses processName, so that is all the key depends on
+    key = completion_key("activities", COMPLETION_MODEL, messages)
+    content = get_cached_completion(key)
+    if content is None:
+        content = openai_client.chat(COMPLETION_MODEL, messages)
     try:
         activities = json.loads(content)
+        # unparseable answers are not cached so the next request retries
+        set_cached_completion(key, content)
         return activities
     except json.JSONDecodeError:
         print("Failed to parse AI response as JSON. Response was:", content)
         return []
 
 def get_matched_activities(title, processName):
+    key = text_key("get_matched_activities", f"{title}\0{processName}")
+    return ai_flights.do(key, lambda: _get_matched_activities(title, processName))
+
+def _get_matched_activities(title, processName):
     '''
     Step 1: Check if the title and processName exists in the knowledge base (minimum similarity of 0.60)
     Step 2: If exists, return the activities associated with the title and processName
     Step 3: If not exists, generate a response using the AI model and return the generted activities
     '''
     print("Retrieving activities for title:", title, "and processName:", processName)
-    knowledge_base = load_knowledge_base_from_file(kb_titleprocess_path)
-
-    # Precompute or load cached embeddings
-    if os.path.exists(embedding_titleprocess_cache_path):
-        print("Loading cached embeddings...")
-        kb_embeddings = load_embeddings(embedding_titleprocess_cache_path)
-    else:
-        print("Generating and caching embeddings using batch processing...")
-        kb_embeddings = get_embeddings_batched(knowledge_base)
-        save_embeddings(embedding_titleprocess_cache_path, kb_embeddings)
-
     # Retrieve most relevant
     titleprocessName = f"{title} {processName}"
-    top_matches = retrieve_most_relevant(titleprocessName, knowledge_base, kb_embeddings, top_k=1)
+    top_matches = search_kb("titleprocess", titleprocessName, top_k=1)
     context_text, similarity = top_matches[0]
     title, process_Name = context_text.split("%%", 1)
-    query_result = KnownData.query.filter(
-            KnownData.title.ilike(title),
-            KnownData.process.ilike(process_Name)
-            ).all()
+    query_result = get_known_data_index().for_title_process(title, process_Name)
     db_result = [row.activity_name for row in query_result]
     db_result = list(dict.fromkeys(db_result))
 
-    if similarity >= 0.4:
+    if similarity >= match_threshold("titleprocess"):
         return db_result, "DB matched"
     else:
         print("Process name: ", processName)
@@ -386,26 +1048,11 @@ def get_matched_activities(title, processName):
     
 def get_matched_activities_only_db(title, processName):
 
-    knowledge_base = load_knowledge_base_from_file(kb_titleprocess_path)
-
-    # Precompute or load cached embeddings
-    if os.path.exists(embedding_titleprocess_cache_path):
-        print("Loading cached embeddings...")
-        kb_embeddings = load_embeddings(embedding_titleprocess_cache_path)
-    else:
-        print("Generating and caching embeddings using batch processing...")
-        kb_embeddings = get_embeddings_batched(knowledge_base)
-        save_embeddings(embedding_titleprocess_cache_path, kb_embeddings)
-
     # Retrieve most relevant
     titleprocessName = f"{title} {processName}"
-    top_matches = retrieve_most_relevant(titleprocessName, knowledge_base, kb_embeddings, top_k=1)
+    top_matches = search_kb("titleprocess", titleprocessName, top_k=1)
     context_text, similarity = top_matches[0]
     title, process_Name = context_text.split("%%", 1)
-    query_result = KnownData.query.filter(
-            KnownData.title.ilike(title),
-            KnownData.process.ilike(process_Name)
-            ).all()
-    
+    query_result = get_known_data_index().for_title_process(title, process_Name)
 
     return query_result
\ No newline at end of file
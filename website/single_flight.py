@@ -0,0 +1,58 @@
+# Request coalescing for slow, idempotent calls (e.g. a GPT generation)
+# While a call for a key is in flight, other threads asking for the same key
+# wait for it and get a copy of its result (or its exception) instead of
+# starting their own. Nothing is kept once the call finishes; this only merges
+# calls that overlap in time within one process.
+import copy
+import threading
+
+
+class _Call:
+    def __init__(self):
+        self.done = threading.Event()
+        self.result = None
+        self.error = None
+        self.waiters = 0
+
+
+class SingleFlight:
+    def __init__(self):
+        self._calls = {}
+        self._lock = threading.Lock()
+        self.leaders = 0
+        self.coalesced = 0
+
+    def do(self, key, fn):
+        with self._lock:
+            call = self._calls.get(key)
+            if call is None:
+                call = self._calls[key] = _Call()
+                self.leaders += 1
+                leader = True
+            else:
+                call.waiters += 1
+                self.coalesced += 1
+                leader = False
+
+        if leader:
+            try:
+                call.result = fn()
+            except Exception as e:
+                call.error = e
+            finally:
+                with self._lock:
+                    del self._calls[key]
+                call.done.set()
+        else:
+            call.done.wait()
+
+        if call.error is not None:
+            raise call.error
+        # every caller gets its own copy, so one request mutating the result
+        # cannot affect another
+        return copy.deepcopy(call.result)
+
+    def stats(self):
+        with self._lock:
+            in_flight = len(self._calls)
+        return {"in_flight": in_flight, "leaders": self.leaders, "coalesced": self.coalesced}
@@ -1,10 +1,10 @@
 from math import ceil
-from flask import Blueprint, jsonify, request, session, make_response, send_file, current_app   
+from flask import Blueprint, jsonify, request, session, make_response, send_file, current_app, Response, stream_with_context   
 from sqlalchemy import text
 from flask_cors import CORS
 from werkzeug.security import generate_password_hash
 from werkzeug.utils import secure_filename
-from models import RA_team, RA_team_member, User, Form, Activity, Process, Hazard, Risk, HazardType, KnownData, Division
+from models import RA_team, RA_team_member, User, Form, Activity, Process, Hazard, Risk, HazardType, KnownData, Division, AIJob
 from models import db
 import random
 import string
@@ -12,6 +12,11 @@ from flask_cors import CORS, cross_origin
 from datetime import datetime
 import json
 from .rag import *
+from .ai_jobs import submit_job, wait_for_job, cancel_job, job_to_dict, fail_if_stale, FINISHED_STATUSES
+from .prefetch import prefetch_hazards, get_prefetched, PREFETCH_ENABLED
+from .known_data_index import get_known_data_index
+from .form_tree import load_form_tree, delete_forms, delete_processes, delete_activities, clone_form, unique_form_title
+from .form_listing import form_status_case, form_status_condition, approver_names, approver_label, invalidate_form_counts
 import os
 from services import DocxTemplateGenerator
 from docx2pdf import convert
@@ -70,6 +75,7 @@ def retrieve_forms():
 
         print(f"username:", username)
 
+        now = datetime.now()
         query = Form.query.filter_by(form_user_id=session_user_id)
 
         # Apply filters if provided
@@ -87,72 +93,54 @@ def retrieve_forms():
         if division_filter:
             query = query.filter(Form.division == division_filter)
 
-        # Apply sorting
+        # Status is computed in SQL (see form_listing.py), so filtering,
+        # counting and paging all happen in the database
+        if status_filter:
+            query = query.filter(form_status_condition(status_filter, now))
+
+        # Apply sorting; form_id breaks ties so pages do not overlap
         if sort_by == 'last_access_date':
             if sort_order == 'desc':
-                query = query.order_by(Form.last_access_date.desc())
+                query = query.order_by(Form.last_access_date.desc(), Form.form_id.desc())
             else:
-                query = query.order_by(Form.last_access_date.asc())
+                query = query.order_by(Form.last_access_date.asc(), Form.form_id.asc())
         elif sort_by == 'created_at':
             if sort_order == 'desc':
                 query = query.order_by(Form.created_at.desc())
             else:
                 query = query.order_by(Form.created_at.asc())
-
-        # If limit is specified (for recent forms), apply it directly
-        if limit:
-            print(f"Applying limit: {limit}")
-            all_forms = query.limit(limit).all()
         else:
-            all_forms = query.all()
-
-        filtered_forms = []
-        for form in all_forms:
+            query = query.order_by(Form.form_id)
 
-            def format_date(date_obj):
-                return date_obj.isoformat() if date_obj else None
-            
-            # Create status based on approval and dates
-            status = "Incomplete"
-            if form.approval == 1:
-                status = "Completed"
-
-            # Check if review is due
-            if form.next_review_date:
-                from datetime import datetime
-                if form.next_review_date < datetime.now():
-                    status = "Review Due"
-
-            if status_filter and status.lower() != status_filter.lower():
-                continue
-                
-            filtered_forms.append((form, status))
+        rows = query.add_columns(form_status_case(now).label('status'))
 
-        # Only apply pagination if no limit is specified
+        # If limit is specified (for recent forms), apply it directly
         if limit:
-            # For recent forms request, no pagination needed
-            total_forms = len(filtered_forms)
-            paginated_forms = filtered_forms
+            print(f"Applying limit: {limit}")
+            paginated_forms = rows.limit(limit).all()
+            total_forms = len(paginated_forms)
             print(f"Recent forms request: returning {len(paginated_forms)} forms (limit: {limit})")
         else:
             # Apply pagination for full form lists
-            total_forms = len(filtered_forms)
+            page = max(page, 1)
+            per_page = max(per_page, 1)
+            total_forms = query.order_by(None).count()
             total_pages = ceil(total_forms / per_page)
             
             # Calculate pagination bounds
             start_index = (page - 1) * per_page
             end_index = start_index + per_page
-            paginated_forms = filtered_forms[start_index:end_index]
+            paginated_forms = rows.offset(start_index).limit(per_page).all()
             print(f"Paginated request: Total forms after filtering: {total_forms}, Current page forms: {len(paginated_forms)}")
 
-        forms_list = []
-        for form, status in paginated_forms:
+        def format_date(date_obj):
+            return date_obj.isoformat() if date_obj else None
 
-            approved_by_username = None
-            if form.approved_by:
-                approved_by_user = User.query.filter_by(user_id=form.approved_by).first()
-                approved_by_username = approved_by_user.user_name if approved_by_user else f"User ID: {form.approved_by}"
+        # every approver on the page in one query
+        approvers = approver_names(form.approved_by for form, _ in paginated_forms)
 
+        forms_list = []
+        for form, status in paginated_forms:
             forms_list.append({
                 'id': form.form_id,
                 'title': form.title or "Untitled Form",
@@ -169,6 +157,7 @@ def retrieve_forms():
                 'form_user_id': form.form_user_id,
                 'form_RA_team_id': form.form_RA_team_id,
                 'approved_by': form.approved_by,
+                'approved_by_username': approver_label(approvers, form.approved_by),
                 'owner': username  # Add username to the response
             })
 
@@ -229,27 +218,11 @@ def delete_process(process_id):
         if not process:
             return jsonify({'error': 'Process not found'}), 404
         
-        # Delete all activities associated with this process
-        # This will also cascade to delete hazards and risks if you have proper foreign key constraints
-        activities = Activity.query.filter_by(activity_process_id=process_id).all()
-        
-        for activity in activities:
-            # Delete hazards associated with this activity
-            hazards = Hazard.query.filter_by(hazard_activity_id=activity.activity_id).all()
-            
-            for hazard in hazards:
-                # Delete risks associated with this hazard
-                Risk.query.filter_by(risk_hazard_id=hazard.hazard_id).delete()
-                
-            # Delete the hazards
-            Hazard.query.filter_by(hazard_activity_id=activity.activity_id).delete()
-            
-        # Delete the activities
-        Activity.query.filter_by(activity_process_id=process_id).delete()
-        
-        # Delete the process
-        db.session.delete(process)
+        # Delete the process with its activities, hazards and risks, one
+        # statement per table (see form_tree.py)
+        deleted = delete_processes([process_id])
         db.session.commit()
+        print(f"Deleted process {process_id}: {deleted}")
         
         return jsonify({
             'success': True,
@@ -271,19 +244,11 @@ def delete_activity(activity_id):
         if not activity:
             return jsonify({'error': 'Activity not found'}), 404
         
-        # Delete hazards associated with this activity
-        hazards = Hazard.query.filter_by(hazard_activity_id=activity_id).all()
-        
-        for hazard in hazards:
-            # Delete risks associated with this hazard
-            Risk.query.filter_by(risk_hazard_id=hazard.hazard_id).delete()
-            
-        # Delete the hazards
-        Hazard.query.filter_by(hazard_activity_id=activity_id).delete()
-        
-        # Delete the activity
-        db.session.delete(activity)
+        # Delete the activity with its hazards and risks, one statement per
+        # table (see form_tree.py)
+        deleted = delete_activities([activity_id])
         db.session.commit()
+        print(f"Deleted activity {activity_id}: {deleted}")
         
         return jsonify({
             'success': True,
@@ -315,129 +280,12 @@ def share_form(formId):
             return jsonify({'error': 'Original form not found'}), 404
         
         # Generate unique title for shared form
-        base_title = f"{original_form.title} (Shared)"
-        shared_title = base_title
-        counter = 1
-        
-        # Check if a form with this title already exists for the target user
-        while Form.query.filter_by(form_user_id=target_user_id, title=shared_title).first():
-            shared_title = f"{base_title} ({counter})"
-            counter += 1
-        
-        # Create new form (shared copy) - using the same structure as duplicate
-        new_form = Form(
-            title=shared_title,
-            division=original_form.division,
-            location=original_form.location,
-            process=original_form.process,
-            form_reference_number=None,  
-            form_user_id=target_user_id,  # Assign to target user instead of current user
-            form_RA_team_id=original_form.form_RA_team_id, 
-            approval=0,  
-            approved_by=None,  
-            last_access_date=datetime.now(),
-            last_review_date=None,  
-            next_review_date=None
-        )
+        shared_title = unique_form_title(target_user_id, f"{original_form.title} (Shared)")
         
-        db.session.add(new_form)
-        db.session.flush()  # Get the new form ID
-        
-        print(f"Created new shared form with ID: {new_form.form_id}")
-
-        # Get all processes from the original form
-        original_processes = Process.query.filter_by(process_form_id=formId).all()
-        
-        # Dictionary to map old process IDs to new process IDs
-        process_id_mapping = {}
-        
-        for original_process in original_processes:
-            # Create new process
-            new_process = Process(
-                process_form_id=new_form.form_id,
-                process_number=original_process.process_number,
-                process_title=original_process.process_title,
-                process_location=original_process.process_location
-            )
-            
-            db.session.add(new_process)
-            db.session.flush()  # Get the new process ID
-            
-            # Store mapping for reference
-            process_id_mapping[original_process.process_id] = new_process.process_id
-            
-            print(f"Created new process: {original_process.process_id} -> {new_process.process_id}")
-            
-             # Get all activities for this process
-            original_activities = Activity.query.filter_by(
-                activity_process_id=original_process.process_id
-            ).all()
-            
-            # Dictionary to map old activity IDs to new activity IDs
-            activity_id_mapping = {}
-            
-            for original_activity in original_activities:
-                # Create new activity
-                new_activity = Activity(
-                    activity_process_id=new_process.process_id,
-                    work_activity=original_activity.work_activity,
-                    activity_number=original_activity.activity_number,
-                    activity_remarks=getattr(original_activity, 'activity_remarks', None)
-                )
-                
-                db.session.add(new_activity)
-                db.session.flush()  # Get the new activity ID
-                
-                # Store mapping for reference
-                activity_id_mapping[original_activity.activity_id] = new_activity.activity_id
-                
-                print(f"Created new activity: {original_activity.activity_id} -> {new_activity.activity_id}")
-                
-                # Get all hazards for this activity
-                original_hazards = Hazard.query.filter_by(
-                    hazard_activity_id=original_activity.activity_id
-                ).all()
-                
-                for original_hazard in original_hazards:
-                    # Create new hazard
-                    new_hazard = Hazard(
-                        hazard_activity_id=new_activity.activity_id,
-                        hazard=original_hazard.hazard,
-                        hazard_type_id=original_hazard.hazard_type_id,
-                        injury=original_hazard.injury,
-                        hazard_implementation_person=original_hazard.hazard_implementation_person,
-                        hazard_due_date=original_hazard.hazard_due_date
-                    )
-                    
-                    db.session.add(new_hazard)
-                    db.session.flush()  # Get the new hazard ID
-                    
-                    print(f"Created new hazard: {original_hazard.hazard_id} -> {new_hazard.hazard_id}")
-                    
-                    # Get the risk associated with this hazard
-                    original_risk = Risk.query.filter_by(
-                        risk_hazard_id=original_hazard.hazard_id
-                    ).first()
-                    
-                    if original_risk:
-                        # Create new risk
-                        new_risk = Risk(
-                            risk_hazard_id=new_hazard.hazard_id,
-                            existing_risk_control=original_risk.existing_risk_control,
-                            additional_risk_control=original_risk.additional_risk_control,
-                            severity=original_risk.severity,
-                            likelihood=original_risk.likelihood,
-                            RPN=original_risk.RPN,
-                            newSeverity=original_risk.newSeverity,
-                            newLikelihood=original_risk.newLikelihood,
-                            newRPN=original_risk.newRPN
-                        )
-                        
-                        db.session.add(new_risk)
-                        print(f"Created new risk for hazard: {new_hazard.hazard_id}")
-        
-        # Commit all changes
+        # Copy the whole tree for the target user (see form_tree.py)
+        new_form = clone_form(formId, target_user_id, shared_title)
         db.session.commit()
+        invalidate_form_counts()
         
         print(f"Successfully shared form {formId} -> {new_form.form_id} with user {target_user_id}")
 
@@ -466,120 +314,10 @@ def duplicate_form(formId):
         if not original_form:
             return jsonify({'error': 'Original form not found'}), 404
         
-        # Create new form (duplicate)
-        new_form = Form(
-            title=f"{original_form.title} (Copy)",  
-            division=original_form.division,
-            location=original_form.location,
-            process=original_form.process,
-            form_reference_number=None,  
-            form_user_id=userId,  
-            form_RA_team_id=original_form.form_RA_team_id, 
-            approval=0,  
-            approved_by=None,  
-            last_access_date=datetime.now(),
-            last_review_date=None,  # Reset review dates
-            next_review_date=None
-        )
-        
-        db.session.add(new_form)
-        db.session.flush()  # Get the new form ID
-        
-        print(f"Created new form with ID: {new_form.form_id}")
-
-        # Get all processes from the original form
-        original_processes = Process.query.filter_by(process_form_id=formId).all()
-        
-        # Dictionary to map old process IDs to new process IDs
-        process_id_mapping = {}
-        
-        for original_process in original_processes:
-            # Create new process
-            new_process = Process(
-                process_form_id=new_form.form_id,
-                process_number=original_process.process_number,
-                process_title=original_process.process_title,
-                process_location=original_process.process_location
-            )
-            
-            db.session.add(new_process)
-            db.session.flush()  # Get the new process ID
-            
-            # Store mapping for reference
-            process_id_mapping[original_process.process_id] = new_process.process_id
-            
-            print(f"Created new process: {original_process.process_id} -> {new_process.process_id}")
-            
-            # Get all activities for this process
-            original_activities = Activity.query.filter_by(
-                activity_process_id=original_process.process_id
-            ).all()
-            
-            # Dictionary to map old activity IDs to new activity IDs
-            activity_id_mapping = {}
-            
-            for original_activity in original_activities:
-                # Create new activity
-                new_activity = Activity(
-                    activity_process_id=new_process.process_id,
-                    work_activity=original_activity.work_activity,
-                    activity_number=original_activity.activity_number,
-                    activity_remarks=getattr(original_activity, 'activity_remarks', None)
-                )
-                
-                db.session.add(new_activity)
-                db.session.flush()  # Get the new activity ID
-                
-                # Store mapping for reference
-                activity_id_mapping[original_activity.activity_id] = new_activity.activity_id
-                
-                print(f"Created new activity: {original_activity.activity_id} -> {new_activity.activity_id}")
-                
-                # Get all hazards for this activity
-                original_hazards = Hazard.query.filter_by(
-                    hazard_activity_id=original_activity.activity_id
-                ).all()
-                
-                for original_hazard in original_hazards:
-                    # Create new hazard
-                    new_hazard = Hazard(
-                        hazard_activity_id=new_activity.activity_id,
-                        hazard=original_hazard.hazard,
-                        hazard_type_id=original_hazard.hazard_type_id,
-                        injury=original_hazard.injury,
-                        hazard_implementation_person=original_hazard.hazard_implementation_person,
-                        hazard_due_date=original_hazard.hazard_due_date
-                    )
-                    
-                    db.session.add(new_hazard)
-                    db.session.flush()  # Get the new hazard ID
-                    
-                    print(f"Created new hazard: {original_hazard.hazard_id} -> {new_hazard.hazard_id}")
-                    
-                    # Get the risk associated with this hazard
-                    original_risk = Risk.query.filter_by(
-                        risk_hazard_id=original_hazard.hazard_id
-                    ).first()
-                    
-                    if original_risk:
-                        # Create new risk
-                        new_risk = Risk(
-                            risk_hazard_id=new_hazard.hazard_id,
-                            existing_risk_control=original_risk.existing_risk_control,
-                            additional_risk_control=original_risk.additional_risk_control,
-                            severity=original_risk.severity,
-                            likelihood=original_risk.likelihood,
-                            RPN=original_risk.RPN,
-                            newSeverity=original_risk.newSeverity,
-                            newLikelihood=original_risk.newLikelihood,
-                            newRPN=original_risk.newRPN
-                        )
-                        
-                        db.session.add(new_risk)
-                        print(f"Created new risk for hazard: {new_hazard.hazard_id}")
-        
-        # Commit all changes
+        # Copy the whole tree for the current user (see form_tree.py)
+        new_form = clone_form(formId, userId, f"{original_form.title} (Copy)")
         db.session.commit()
+        invalidate_form_counts()
         
         print(f"Successfully duplicated form {formId} -> {new_form.form_id}")
 
@@ -1289,15 +1027,12 @@ def form3_temp_save():
   
 @user.route('/get_form2_data/<int:form_id>', methods=['GET'])
 def get_form2_data(form_id):
-    # Fetch the form
-    form = Form.query.get(form_id)
+    # Fetch the form with its processes, activities, hazards and risks
+    form = load_form_tree(form_id)
     
     if not form:
         return jsonify({"error": "Form not found"}), 404
     
-    # Fetch processes associated with this form
-    processes = Process.query.filter_by(process_form_id=form_id).all()
-    
     # Build the response with processes, activities, hazards and risks
     response_data = {
         "form_id": form.form_id,
@@ -1306,7 +1041,7 @@ def get_form2_data(form_id):
         "processes": []
     }
     
-    for process in processes:
+    for process in form.processes:
         proc_data = {
             "process_id": process.process_id,
             "id": process.process_id,
@@ -1316,10 +1051,7 @@ def get_form2_data(form_id):
             "activities": []
         }
         
-        # Get activities for this process
-        activities = Activity.query.filter_by(activity_process_id=process.process_id).all()
-        
-        for activity in activities:
+        for activity in process.activities:
             act_data = {
                 "activity_id": activity.activity_id,
                 "id": activity.activity_id,
@@ -1328,16 +1060,11 @@ def get_form2_data(form_id):
                 "hazards": []
             }
             
-            # Get hazards for this activity
-            hazards = Hazard.query.filter_by(hazard_activity_id=activity.activity_id).all()
             print(f"hazards found")
 
-            for hazard in hazards:
-                # Get risk information for this hazard
-                risk = Risk.query.filter_by(risk_hazard_id=hazard.hazard_id).first()
-                
-                # Get hazard type
-                hazard_type = HazardType.query.get(hazard.hazard_type_id)
+            for hazard in activity.hazards:
+                risk = hazard.risk
+                hazard_type = hazard.hazard_type
                 hazard_type_name = hazard_type.hazard_type if hazard_type else ""
                 
                 hazard_data = {
@@ -1678,7 +1405,7 @@ def form2_save():
 def get_form3_data(form_id):
     """Get specific Form3 data including RA team and approval info"""
     try:
-        form = Form.query.get(form_id)
+        form = load_form_tree(form_id, depth="processes")
         
         if not form:
             return jsonify({"error": "Form not found"}), 404
@@ -1691,8 +1418,7 @@ def get_form3_data(form_id):
         
         # Get all process locations for this form
         process_locations = []
-        processes = Process.query.filter_by(process_form_id=form_id).all()
-        for process in processes:
+        for process in form.processes:
             if process.process_location and process.process_location.strip():
                 process_locations.append(process.process_location.strip())
         
@@ -2146,7 +1872,7 @@ def complete_form():
 @user.route('/get_form/<int:form_id>', methods=['GET'])
 def get_form(form_id):
     try:
-        form = Form.query.get(form_id)
+        form = load_form_tree(form_id, depth="activities")
         
         if not form:
             return jsonify({"error": "Form not found"}), 404
@@ -2157,10 +1883,7 @@ def get_form(form_id):
         # Fetch processes, activities, hazards from the database
         processes = []
         
-        # Get all processes for this form
-        form_processes = Process.query.filter_by(process_form_id=form_id).order_by(Process.process_number).all()
-        
-        for process in form_processes:
+        for process in sorted(form.processes, key=lambda p: p.process_number):
             process_data = {
                 "id": process.process_id,
                 "process_id": process.process_id, # Include both formats for consistency
@@ -2170,12 +1893,7 @@ def get_form(form_id):
                 "activities": []
             }
             
-            # Get activities for THIS PROCESS specifically
-            activities = Activity.query.filter_by(
-                activity_process_id=process.process_id
-            ).order_by(Activity.activity_number).all()
-            
-            for activity in activities:
+            for activity in sorted(process.activities, key=lambda a: a.activity_number):
                 activity_data = {
                     "id": activity.activity_id,
                     "activity_id": activity.activity_id, # Include both formats
@@ -2339,30 +2057,12 @@ def delete_form(form_id):
         if not form:
             return jsonify({'error': 'Form not found'}), 404
         
-        # Delete all processes and activities associated with the form
-        processes = Process.query.filter_by(process_form_id=form_id).all()
-        for process in processes:
-            # Delete all activities associated with this process
-            activities = Activity.query.filter_by(activity_process_id=process.process_id).all()
-        
-            for activity in activities:
-                # Delete hazards associated with this activity
-                hazards = Hazard.query.filter_by(hazard_activity_id=activity.activity_id).all()
-            
-                for hazard in hazards:
-                    # Delete risks associated with this hazard
-                    Risk.query.filter_by(risk_hazard_id=hazard.hazard_id).delete()
-                
-                # Delete the hazards
-                Hazard.query.filter_by(hazard_activity_id=activity.activity_id).delete()
-            
-            # Delete the activities
-            Activity.query.filter_by(activity_process_id=process.process_id).delete()
-        
-            # Finally, delete the process
-            db.session.delete(process)
-        db.session.delete(form)
+        # Delete the form with its processes, activities, hazards and risks,
+        # one statement per table (see form_tree.py)
+        deleted = delete_forms([form_id])
         db.session.commit()
+        invalidate_form_counts()
+        print(f"Deleted form {form_id}: {deleted}")
         
         return jsonify({
             'success': True,
@@ -2374,6 +2074,17 @@ def delete_form(form_id):
         print(f"Error deleting form {form_id}: {str(e)}")
         return jsonify({'error': 'Failed to delete process'}), 500
     
+# Prefetched hazards are kept per user: Form1 asks for activities before a new
+# form has an id, so the form id cannot be part of the key
+def prefetch_scope():
+    return f"user{session.get('user_id')}"
+
+# Form2 sends the activity as a one-item list
+def prefetch_activity_name(user_input):
+    if isinstance(user_input, list) and len(user_input) == 1:
+        return str(user_input[0])
+    return str(user_input)
+
 # ctrl f tag AI
 @user.route('/ai_generate', methods=['POST'])
 def ai_generate():
@@ -2385,6 +2096,15 @@ def ai_generate():
         if not user_input:
             return jsonify({"error": "No input provided"}), 400
 
+        # hazards prefetched after /get_activities, if any
+        hazard_data = get_prefetched(prefetch_scope(), prefetch_activity_name(user_input))
+        if hazard_data is not None:
+            return jsonify({
+                "success": True,
+                "hazard_data": hazard_data,
+                "prefetched": True
+            }), 200
+
         hazard_data = ai_function(str(user_input)) # Call RAG.py function
         return jsonify({
             "success": True,
@@ -2395,6 +2115,59 @@ def ai_generate():
         print(f"Error generating hazard data: {str(e)}")
         return jsonify({"error": str(e)}), 500
 
+# ctrl f tag AI
+# /ai_generate for every activity of a process in one request
+@user.route('/ai_generate_batch', methods=['POST'])
+def ai_generate_batch():
+    try:
+        data = request.get_json(silent=True) or {}
+        activities = data.get('activities')
+
+        if not activities or not isinstance(activities, list):
+            return jsonify({"error": "No activities provided"}), 400
+
+        results, errors = ai_function_batch([str(activity) for activity in activities])
+        return jsonify({
+            "success": not errors,
+            "hazard_data": results,
+            "errors": errors
+        }), 200
+
+    except Exception as e:
+        print(f"Error generating hazard data: {str(e)}")
+        return jsonify({"error": str(e)}), 500
+
+# ctrl f tag AI
+# Same as /ai_generate but sent as server-sent events: one "hazard" event per
+# hazard as soon as its block is complete, then "done" (or "error")
+@user.route('/ai_generate_stream', methods=['POST'])
+def ai_generate_stream():
+    data = request.get_json(silent=True) or {}
+    user_input = data.get('input')
+
+    if not user_input:
+        return jsonify({"error": "No input provided"}), 400
+
+    def sse(event, payload):
+        return f"event: {event}\ndata: {json.dumps(payload)}\n\n"
+
+    def generate():
+        count = 0
+        try:
+            for hazard in ai_function_stream(str(user_input)):
+                count += 1
+                yield sse("hazard", hazard)
+            yield sse("done", {"success": True, "count": count})
+        except Exception as e:
+            print(f"Error streaming hazard data: {str(e)}")
+            yield sse("error", {"error": str(e), "count": count})
+
+    response = Response(stream_with_context(generate()), mimetype='text/event-stream')
+    response.headers['Cache-Control'] = 'no-cache'
+    # stop nginx from buffering the whole stream
+    response.headers['X-Accel-Buffering'] = 'no'
+    return response
+
 # ctrl f tag AI
 @user.route('/get_activities', methods=['POST'])
 def get_activities():
@@ -2407,6 +2180,9 @@ def get_activities():
         #     return jsonify({"error": "No process name provided"}), 400
 
         activities, text = get_matched_activities(str(data.get('title')), str(data.get('processName')))  # Call RAG.py function
+        # opt-in: start generating hazards for these activities in the background
+        if PREFETCH_ENABLED and data.get('prefetch') and activities:
+            prefetch_hazards(current_app._get_current_object(), prefetch_scope(), activities)
         return jsonify({
             "success": True,
             "activities": activities,
@@ -2418,6 +2194,76 @@ def get_activities():
         print(f"Error getting activities: {str(e)}")
         return jsonify({"error": str(e)}), 500
     
+# ctrl f tag AI
+# Background versions of /ai_generate ("hazards") and /get_activities
+# ("activities"): submit returns a job id straight away, then poll the job
+@user.route('/jobs', methods=['POST'])
+def submit_ai_job():
+    user_id = session.get('user_id')
+    if not user_id:
+        return jsonify({"error": "Not authenticated"}), 401
+
+    data = request.get_json(silent=True) or {}
+    try:
+        job = submit_job(current_app._get_current_object(), data.get('kind'), data, user_id)
+    except ValueError as e:
+        return jsonify({"error": str(e)}), 400
+    except Exception as e:
+        db.session.rollback()
+        print(f"Error submitting AI job: {str(e)}")
+        return jsonify({"error": "Failed to submit job"}), 500
+
+    return jsonify({"success": True, "job_id": job.job_id, "status": job.status}), 202
+
+def get_own_job(job_id):
+    job = db.session.get(AIJob, job_id)
+    if job is None or job.job_user_id != session.get('user_id'):
+        return None
+    fail_if_stale(job)
+    return job
+
+# ?wait=N long-polls for up to N (max 25) seconds until the job finishes
+@user.route('/jobs/<job_id>', methods=['GET'])
+def get_ai_job(job_id):
+    if not session.get('user_id'):
+        return jsonify({"error": "Not authenticated"}), 401
+    job = get_own_job(job_id)
+    if job is None:
+        return jsonify({"error": "Job not found"}), 404
+
+    wait = min(request.args.get('wait', 0, type=float), 25)
+    if job.status not in FINISHED_STATUSES and wait > 0:
+        wait_for_job(job_id, wait)
+        db.session.refresh(job)
+
+    return jsonify({"success": True, "job": job_to_dict(job, include_result=False)}), 200
+
+@user.route('/jobs/<job_id>/result', methods=['GET'])
+def get_ai_job_result(job_id):
+    if not session.get('user_id'):
+        return jsonify({"error": "Not authenticated"}), 401
+    job = get_own_job(job_id)
+    if job is None:
+        return jsonify({"error": "Job not found"}), 404
+
+    if job.status == "failed":
+        return jsonify({"success": False, "status": job.status, "error": job.error}), 500
+    if job.status != "done":
+        return jsonify({"success": False, "status": job.status, "error": "Job has no result"}), 409
+    return jsonify({"success": True, **json.loads(job.result)}), 200
+
+@user.route('/jobs/<job_id>/cancel', methods=['POST'])
+def cancel_ai_job(job_id):
+    if not session.get('user_id'):
+        return jsonify({"error": "Not authenticated"}), 401
+    job = get_own_job(job_id)
+    if job is None:
+        return jsonify({"error": "Job not found"}), 404
+
+    if not cancel_job(job):
+        return jsonify({"success": False, "status": job.status, "error": "Job already finished"}), 409
+    return jsonify({"success": True, "status": "cancelled"}), 200
+
 # ctrl f tag AI
 @user.route('/filtered_activities', methods=['POST'])
 def filtered_activities():
@@ -2426,12 +2272,9 @@ def filtered_activities():
         data = request.get_json()
         activities = data.get("activities", [])  # a list
         filtered_activities = []
+        known_data = get_known_data_index()
         for activity in activities:
-            result = KnownData.query.filter(
-                KnownData.activity_name.ilike(f"%{activity}%"),
-                # KnownData.title.ilike(f"%{data.get('formTitle')}%"),
-                # KnownData.process.ilike(f"%{data.get('processName')}%")
-            ).all()
+            result = known_data.activity_names_containing(activity)
             if result:
                 filtered_activities.append(activity)
         return jsonify({
@@ -2785,14 +2628,11 @@ def get_form_data_for_document(formId):
     try:
         userId = session.get('user_id')
         
-        # Get the form
-        form = Form.query.get(formId)
+        # Get the form with its whole tree, one query per level
+        form = load_form_tree(formId)
         if not form:
             return jsonify({'error': 'Form not found'}), 404
         
-        # Get all data with a single query approach (more efficient)
-        processes = Process.query.filter_by(process_form_id=formId).all()
-        
         # Build simplified structure for document generation
         document_data = {
             'form': {
@@ -2838,10 +2678,8 @@ def get_form_data_for_document(formId):
 
         document_data['form']['team_data'] = team_data
         
-        for process in processes:
-            activities = Activity.query.filter_by(activity_process_id=process.process_id).all()
-            
-            for activity in activities:
+        for process in form.processes:
+            for activity in process.activities:
                 activity_entry = {
                     'location': process.process_location,
                     'process': process.process_title,
@@ -2850,11 +2688,8 @@ def get_form_data_for_document(formId):
                     'hazards': []
                 }
                 
-                # Get hazards for this activity
-                hazards = Hazard.query.filter_by(hazard_activity_id=activity.activity_id).all()
-                
-                for hazard in hazards:
-                    risk = Risk.query.filter_by(risk_hazard_id=hazard.hazard_id).first()
+                for hazard in activity.hazards:
+                    risk = hazard.risk
                     
                     hazard_entry = {
                         'hazard': hazard.hazard,